@@ -0,0 +1,160 @@
+"""Backfill benchmark: lambda-calendar-updater/backfill.py over a year of summaries.
+
+Seeds a fake S3 bucket with `--summaries` historical
+`whatsapp_summary_<timestamp>.json` objects (one a day, each scheduling the
+next `--days-ahead` days, some still wrapped in a markdown fence like raw
+Gemini output, uploaded out of order) and a fake Calendar with stale events,
+runs the backfill CLI against them and checks that the calendar ends up
+holding exactly the latest-wins state. With --per-object it also replays the
+same objects the old way, one Lambda invocation each, for comparison.
+
+    python benchmark/backfill_benchmark.py
+    python benchmark/backfill_benchmark.py --summaries 1000 --s3-latency-ms 40 --per-object
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import sys
+import time
+from unittest import mock
+
+import fakes
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UPDATER_DIR = os.path.join(REPO_ROOT, "lambda-calendar-updater")
+CALENDAR_ID = "bench@group.calendar.google.com"
+BUCKET = "bench-bucket"
+
+
+def seed_summaries(s3, rng, count, days_ahead, first_day):
+    """Puts the summaries in random order; returns the expected {date: location}."""
+    summaries = []
+    for i in range(count):
+        sent = first_day + datetime.timedelta(days=i)
+        written = datetime.datetime.combine(sent, datetime.time(rng.randrange(7, 22), rng.randrange(60)))
+        schedule = []
+        for offset in range(1, days_ahead + 1):
+            day = sent + datetime.timedelta(days=offset)
+            if day.weekday() in (4, 5):
+                continue
+            schedule.append({"date": day.isoformat(), "location": rng.choice(["Afeka", "Home"])})
+        summaries.append((written, schedule))
+
+    expected = {}
+    for _, schedule in summaries:
+        expected.update({entry["date"]: entry["location"] for entry in schedule})
+
+    shuffled = list(summaries)
+    rng.shuffle(shuffled)
+    for i, (written, schedule) in enumerate(shuffled):
+        body = json.dumps(schedule)
+        if i % 5 == 0:
+            body = f"```json\n{body}\n```"
+        s3.put_object(Bucket=BUCKET, Key=f"whatsapp_summary_{written.strftime('%Y-%m-%d-%H-%M-%S')}.json", Body=body)
+    return expected
+
+
+def seed_stale(calendar, updater, expected, days, unscheduled):
+    """Auto-added events with the wrong location, plus one on a day nothing schedules."""
+    for day in days:
+        calendar.add_event(CALENDAR_ID, updater.event_body(day, "Home" if expected[day] == "Afeka" else "Afeka"))
+    calendar.add_event(CALENDAR_ID, updater.event_body(unscheduled, "Afeka"))
+
+
+def calendar_state(calendar, updater):
+    state = {}
+    for event in calendar.events.get(CALENDAR_ID, {}).values():
+        if updater.is_auto_added(event):
+            state.setdefault(event["start"]["date"], []).append(event["summary"].split(": ", 1)[1])
+    return state
+
+
+def mismatches(calendar, updater, expected):
+    actual = calendar_state(calendar, updater)
+    return sorted(d for d in set(expected) | set(actual) if actual.get(d) != [expected.get(d)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--summaries", type=int, default=365, help="historical summary objects, one per day")
+    parser.add_argument("--days-ahead", type=int, default=14, help="days each summary schedules")
+    parser.add_argument("--s3-latency-ms", type=float, default=20, help="simulated latency of every S3 read")
+    parser.add_argument("--workers", type=int, default=16, help="passed on to backfill.py")
+    parser.add_argument("--calendar-qps", type=float, help="reject Calendar writes above this many per second")
+    parser.add_argument("--per-object", action="store_true", help="also time one Lambda invocation per object")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ.update({"BUCKET_NAME": BUCKET, "CALENDAR_ID": CALENDAR_ID, "METRICS_ENABLED": "false"})
+    # The fake Calendar has no quota unless --calendar-qps gives it one
+    os.environ["CALENDAR_WRITES_PER_SECOND"] = str(args.calendar_qps or 1000)
+    for name in ("TENANTS_CONFIG", "DRY_RUN", "CALENDAR_RETRY_DIR"):
+        os.environ.pop(name, None)
+    sys.path.insert(0, UPDATER_DIR)
+    import backfill
+    import lambda_function as updater
+
+    rng = random.Random(args.seed)
+    s3 = fakes.FakeS3()
+    s3.LIST_PAGE_SIZE = 100  # make the listing paginate
+    calendar = fakes.FakeCalendar(writes_per_second=args.calendar_qps)
+    secrets = fakes.FakeSecretsManager({"*": json.dumps({
+        "google_service_account_json": json.dumps({"client_email": "bench@example.com", "private_key_id": "bench"}),
+    })})
+    first_day = datetime.date.today() - datetime.timedelta(days=args.summaries)
+    expected = seed_summaries(s3, rng, args.summaries, args.days_ahead, first_day)
+    # Stale events: wrong locations, and a day no summary schedules any more
+    stale = sorted(expected)[::7]
+    unscheduled = next(d for d in (first_day + datetime.timedelta(days=i) for i in range(7, 14)) if d.weekday() == 4)
+    seed_stale(calendar, updater, expected, stale, unscheduled.isoformat())
+    s3.latency = args.s3_latency_ms / 1000
+
+    failed = False
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch("boto3.client", fakes.boto3_client_factory(s3, secrets)))
+        stack.enter_context(mock.patch(
+            "boto3.session.Session.client", lambda session, *a, **k: fakes.boto3_client_factory(s3, secrets)(*a, **k)))
+        service = calendar.build_service()
+        stack.enter_context(mock.patch.object(updater, "get_calendar_service", lambda *a, **k: service))
+
+        print(f"===== backfill.py: {args.summaries} summaries, {len(expected)} dates, "
+              f"{args.s3_latency_ms:g} ms per S3 read =====")
+        before = dict(s3.calls) | {f"calendar.{k}": v for k, v in calendar.calls.items()}
+        started = time.perf_counter()
+        with mock.patch.object(sys, "argv", ["backfill.py", "--bucket", BUCKET, "--workers", str(args.workers)]):
+            code = backfill.main()
+        elapsed = time.perf_counter() - started
+        after = dict(s3.calls) | {f"calendar.{k}": v for k, v in calendar.calls.items()}
+        calls = {k: v - before.get(k, 0) for k, v in sorted(after.items()) if v - before.get(k, 0)}
+        wrong = mismatches(calendar, updater, expected)
+        print(f"\nbackfill: {elapsed:.2f}s, exit code {code}, calls {calls}")
+        if wrong or code:
+            print(f"Calendar does not match the collapsed history on {len(wrong)} dates: {wrong[:5]}")
+            failed = True
+        else:
+            print("Calendar matches the collapsed history.")
+
+        if args.per_object:
+            calendar.events = {}
+            seed_stale(calendar, updater, expected, stale, unscheduled.isoformat())
+            updater.logger.setLevel("WARNING")
+            keys = [obj["Key"] for obj in sorted(backfill.list_objects(BUCKET, backfill.SUMMARY_PREFIX),
+                                                  key=backfill.object_order)]
+            before = calendar.calls.copy()
+            started = time.perf_counter()
+            for key in keys:
+                event = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]}
+                updater.handle_event(event)
+            per_object = time.perf_counter() - started
+            http = calendar.calls["http"] - before["http"]
+            print(f"\none Lambda invocation per object: {per_object:.2f}s for {len(keys)} invocations "
+                  f"({http} Calendar round trips), {per_object / elapsed:.1f}x the backfill")
+    calendar.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""End-to-end benchmark: bot -> calendar updater -> status checker, against local fakes.
+
+Seeds a synthetic WhatsApp chat (hundreds of messages and images) on a fake
+WAHA server, runs the bot with a fake `gemini` CLI (or, with --gemini fake,
+the in-process FakeBackend), feeds the resulting S3
+write to the calendar updater (fake S3 and Secrets Manager, fake Calendar v3
+server including the batch endpoint) and then queries the status checker.
+Reports per-stage latency, calls made to every fake, and memory.
+
+    python benchmark/e2e_benchmark.py --messages 500 --images 60 --json run.json
+    python benchmark/e2e_benchmark.py --baseline run.json
+
+Component output goes to components.log in a temporary work directory
+(kept with --keep).
+"""
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from unittest import mock
+
+import fakes
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_DIR = os.path.join(REPO_ROOT, "docker-waha-gemini-s3", "automation_bot")
+CHAT_ID = "120363000000000000@g.us"
+CALENDAR_ID = "bench@group.calendar.google.com"
+BUCKET = "bench-bucket"
+HEADER_SECRET = "bench-secret"
+
+
+def load_module(name, path):
+    """Imports a Lambda's lambda_function.py under a unique module name."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_schedule(first_day, days, flip=()):
+    """Weekday entries alternating Afeka/Home; dates in `flip` get the other location."""
+    schedule = []
+    for i in range(days):
+        day = first_day + datetime.timedelta(days=i)
+        if day.weekday() >= 5:
+            continue
+        location = "Afeka" if i % 2 == 0 else "Home"
+        if day.isoformat() in flip:
+            location = "Home" if location == "Afeka" else "Afeka"
+        schedule.append({"date": day.isoformat(), "location": location})
+    return schedule
+
+
+def fake_image(size, rng):
+    """A phone-screenshot-like timetable JPEG, or JPEG-framed random bytes of `size` bytes without Pillow."""
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        return b"\xff\xd8\xff\xe0" + rng.randbytes(max(size - 6, 0)) + b"\xff\xd9"
+    image = Image.new("RGB", (1080, 2400), (250, 250, 250))
+    draw = ImageDraw.Draw(image)
+    for row in range(14):
+        for col in range(5):
+            x, y = 60 + col * 192, 400 + row * 110
+            draw.rectangle([x, y, x + 180, y + 100], fill=(rng.randrange(150, 256), 220, rng.randrange(150, 256)), outline=(0, 0, 0))
+            draw.text((x + 10, y + 40), rng.choice(["Afeka", "Home", "Zoom", "-"]), fill=(0, 0, 0))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=95)
+    return out.getvalue()
+
+
+class Bench:
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.rng = random.Random(args.seed)
+        self.results = {}
+        self.log = open(os.path.join(workdir, "components.log"), "w", encoding="utf-8")
+        self.next_message = 0
+
+        self.waha = fakes.FakeWaha()
+        self.calendar = fakes.FakeCalendar(writes_per_second=args.calendar_qps)
+        self.s3 = fakes.FakeS3()
+        secret = json.dumps({
+            "SECRET_HEADER": HEADER_SECRET,
+            "google_service_account_json": json.dumps({"client_email": "bench@example.com", "private_key_id": "bench"}),
+        })
+        self.secrets = fakes.FakeSecretsManager({"*": secret})
+        fakes.write_fake_gemini_cli(workdir)
+        self.gemini_calls = os.path.join(workdir, "gemini_calls.txt")
+        self.gemini_response = os.path.join(workdir, "gemini_response.json")
+        open(self.gemini_calls, "w").close()
+
+    # --- setup ---
+
+    def configure_env(self):
+        os.environ.update({
+            "PATH": f"{self.workdir}{os.pathsep}{os.environ.get('PATH', '')}",
+            "WAHA_BASE_URL": self.waha.url,
+            "WAHA_API_KEY": "bench",
+            "WAHA_CHAT_ID": CHAT_ID,
+            "WAHA_READY_TIMEOUT": "10",
+            "AWS_BUCKET_NAME": BUCKET,
+            "BOT_STATE_FILE": os.path.join(self.workdir, "state", "cursors.json"),
+            "GEMINI_CACHE_DIR": os.path.join(self.workdir, "gemini_cache"),
+            "BOT_QUEUE": "true" if self.args.queue else "false",
+            "BOT_QUEUE_DB": os.path.join(self.workdir, "state", "jobs.db"),
+            "GEMINI_BACKEND": "cli",
+            "BENCH_GEMINI_CALLS": self.gemini_calls,
+            "BENCH_GEMINI_RESPONSE": self.gemini_response,
+            "BENCH_GEMINI_DELAY": str(self.args.gemini_delay),
+            "BUCKET_NAME": BUCKET,
+            "CALENDAR_ID": CALENDAR_ID,
+            "DECISION_INDEX_BUCKET": BUCKET,
+        })
+        for name in ("TENANTS_CONFIG", "WAHA_MEDIA_DIR", "DRY_RUN", "S3_WRITE_SHARDS"):
+            os.environ.pop(name, None)
+
+    def import_components(self):
+        sys.path.insert(0, BOT_DIR)
+        from utils import process_messages, waha_readiness
+        self.process_messages = process_messages
+        self.waha_readiness = waha_readiness
+        if self.args.gemini == "fake":
+            from utils import gemini_backends
+            self.gemini_backend = gemini_backends.FakeBackend(self.answer_gemini)
+            gemini_backends.set_backend(self.gemini_backend)
+        self.updater = load_module("bench_calendar_updater", os.path.join(REPO_ROOT, "lambda-calendar-updater", "lambda_function.py"))
+        self.checker = load_module("bench_status_checker", os.path.join(REPO_ROOT, "lambda-status-checker", "lambda_function.py"))
+
+    def seed(self):
+        """Chat messages and images, plus calendar events the updater must reconcile."""
+        now = int(time.time())
+        image_every = max(self.args.messages // max(self.args.images, 1), 1)
+        images = 0
+        for i in range(self.args.messages):
+            with_image = images < self.args.images and i % image_every == 0
+            images += with_image
+            self.add_message(now - 3600 + i * 3600 // self.args.messages, with_image)
+
+        self.first_day = datetime.date.today() + datetime.timedelta(days=1)
+        self.schedule = synthetic_schedule(self.first_day, self.args.days)
+        self.write_gemini_response(self.schedule)
+
+        # Some weekdays exist with the other location (patches), weekends hold stale entries (deletes)
+        first, last = self.schedule[0]["date"], self.schedule[-1]["date"]
+        for i in range(self.args.days):
+            day = self.first_day + datetime.timedelta(days=i)
+            if first <= day.isoformat() <= last and (day.weekday() >= 5 or i % 4 == 0):
+                location = "Home" if i % 2 == 0 else "Afeka"
+                self.calendar.add_event(CALENDAR_ID, self.updater.event_body(day.isoformat(), location))
+        # An event the user created themselves, never touched by the updater
+        self.calendar.add_event(CALENDAR_ID, {
+            "summary": "Dentist",
+            "start": {"dateTime": f"{self.first_day.isoformat()}T09:00:00+03:00"},
+            "end": {"dateTime": f"{self.first_day.isoformat()}T10:00:00+03:00"},
+        })
+
+    def add_message(self, timestamp, with_image):
+        self.next_message += 1
+        message = {
+            "id": f"false_{CHAT_ID}_{self.next_message:06d}",
+            "timestamp": timestamp,
+            "from": "972500000000@c.us",
+            "fromMe": False,
+            "body": f"Schedule update {self.next_message}: see attached" if with_image else f"Message {self.next_message}",
+            "hasMedia": False,
+        }
+        image = fake_image(self.args.image_kb * 1024, self.rng) if with_image else None
+        self.waha.add_message(CHAT_ID, message, image)
+
+    def write_gemini_response(self, schedule):
+        with open(self.gemini_response, "w", encoding="utf-8") as f:
+            json.dump(schedule, f)
+
+    def answer_gemini(self, prompt, entries):
+        """FakeBackend responder: the same canned schedule the fake CLI prints."""
+        time.sleep(self.args.gemini_delay)
+        with open(self.gemini_response, encoding="utf-8") as f:
+            return f.read()
+
+    # --- measurement ---
+
+    def counters(self):
+        if self.args.gemini == "fake":
+            gemini = len(self.gemini_backend.calls)
+        else:
+            with open(self.gemini_calls) as f:
+                gemini = sum(1 for _ in f)
+        snapshot = Counter({f"gemini_{self.args.gemini}": gemini})
+        for prefix, fake in (("waha", self.waha), ("calendar", self.calendar), ("s3", self.s3), ("secrets", self.secrets)):
+            for name, count in fake.calls.items():
+                snapshot[f"{prefix}.{name}"] = count
+        return snapshot
+
+    def stage(self, name, fn):
+        before = self.counters()
+        if self.args.memory:
+            tracemalloc.reset_peak()
+        print(f"\n===== {name} =====", file=self.log, flush=True)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(self.log), contextlib.redirect_stderr(self.log):
+            fn()
+        elapsed = time.perf_counter() - started
+        calls = self.counters()
+        calls.subtract(before)
+        result = {"ms": round(elapsed * 1000, 1), "calls": {k: v for k, v in sorted(calls.items()) if v}}
+        if self.args.memory:
+            result["peak_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024)
+        self.results[name] = result
+
+    # --- stages ---
+
+    def run_bot(self):
+        readiness = self.waha_readiness.wait_until_ready()
+        if not readiness.ready:
+            raise RuntimeError(f"Fake WAHA never became ready: {readiness}")
+        self.process_messages.process_messages()
+
+    def run_updater(self):
+        key = self.process_messages.s3_schedule_store.S3_SCHEDULE_KEY
+        # As from a versioned bucket: the event names the version the bot wrote
+        version_id = next(reversed(self.s3.versions[(BUCKET, key)]))
+        event = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "versionId": version_id}}}]}
+        response = self.updater.lambda_handler(event, None)
+        if response["statusCode"] != 200:
+            raise RuntimeError(f"Updater failed: {response}")
+        print(f"Updater: {response['body']}")
+
+    def run_replay(self):
+        """Replays the writes the rate-limited Calendar turned away until none are left."""
+        for _ in range(self.updater.RETRY_MAX_REPLAYS):
+            response = self.updater.lambda_handler({"replayRetries": True}, None)
+            print(f"Updater replay: {response['body']}")
+            if response["statusCode"] != 200:
+                raise RuntimeError(f"Updater replay failed: {response}")
+            if "queued" not in response["body"]:
+                return
+
+    def run_checker(self):
+        headers = {"x-secret-header": HEADER_SECRET}
+        for i in range(self.args.requests):
+            # Mostly scheduled days (decision index), every tenth one past the schedule (live Calendar)
+            offset = i % self.args.days if i % 10 else self.args.days + i % 7
+            at = f"{(self.first_day + datetime.timedelta(days=offset)).isoformat()}T08:00"
+            response = self.checker.lambda_handler({"headers": headers, "queryStringParameters": {"at": at}}, None)
+            if response["statusCode"] != 200:
+                raise RuntimeError(f"Checker failed: {response}")
+
+    def run_plan(self):
+        params = {"days": "14", "at": self.first_day.isoformat()}
+        response = self.checker.lambda_handler({"headers": {"x-secret-header": HEADER_SECRET}, "queryStringParameters": params}, None)
+        revalidated = self.checker.lambda_handler({
+            "headers": {"x-secret-header": HEADER_SECRET, "if-none-match": response["headers"]["ETag"]},
+            "queryStringParameters": params
+        }, None)
+        if revalidated["statusCode"] != 304:
+            raise RuntimeError(f"Plan was not revalidated: {revalidated['statusCode']}")
+
+    def add_incremental_messages(self):
+        """A few new messages that move some dates to the other location."""
+        now = int(time.time())
+        for i in range(5):
+            self.add_message(now + i, i == 0)
+        flip = {entry["date"] for entry in self.schedule[:3]}
+        self.write_gemini_response(synthetic_schedule(self.first_day, self.args.days, flip))
+
+    def check_consistency(self):
+        """The calendar's auto-added events must match the final schedule exactly."""
+        expected = {e["date"]: e["location"] for e in synthetic_schedule(
+            self.first_day, self.args.days, {entry["date"] for entry in self.schedule[:3]})}
+        actual = {}
+        for event in self.calendar.events[CALENDAR_ID].values():
+            if self.updater.is_auto_added(event):
+                actual.setdefault(event["start"]["date"], []).append(event["summary"].split(": ", 1)[1])
+        mismatched = sorted(d for d in set(expected) | set(actual) if actual.get(d) != [expected.get(d)])
+        return mismatched
+
+    def run(self):
+        patches = [
+            mock.patch("boto3.client", fakes.boto3_client_factory(self.s3, self.secrets)),
+            mock.patch("boto3.session.Session.client", lambda session, *a, **k: fakes.boto3_client_factory(self.s3, self.secrets)(*a, **k)),
+        ]
+        with contextlib.ExitStack() as stack:
+            for patch in patches:
+                stack.enter_context(patch)
+            self.import_components()
+            self.seed()
+            service = self.calendar.build_service()
+            stack.enter_context(mock.patch.object(self.updater, "get_calendar_service", lambda *a, **k: service))
+            stack.enter_context(mock.patch.object(self.checker, "get_calendar_service", lambda *a, **k: service))
+
+            self.stage("bot: first pass", self.run_bot)
+            self.stage("updater: first pass", self.run_updater)
+            self.stage(f"checker: {self.args.requests} requests", self.run_checker)
+            self.stage("checker: 14-day plan + 304", self.run_plan)
+            self.add_incremental_messages()
+            self.stage("bot: incremental", self.run_bot)
+            self.stage("updater: incremental", self.run_updater)
+            self.stage("bot: idle", self.run_bot)
+            if self.args.calendar_qps:
+                self.stage("updater: retry replay", self.run_replay)
+        return self.check_consistency()
+
+    def close(self):
+        self.waha.close()
+        self.calendar.close()
+        self.log.close()
+
+
+def print_report(results, baseline=None):
+    for name, result in results.items():
+        line = f"{name:<32} {result['ms']:>9.1f} ms"
+        if baseline and name in baseline and baseline[name]["ms"]:
+            change = (result["ms"] - baseline[name]["ms"]) / baseline[name]["ms"] * 100
+            line += f" ({change:+.0f}%)"
+        if "peak_kb" in result:
+            line += f"  peak {result['peak_kb']} KiB"
+        print(line)
+        for call, count in result["calls"].items():
+            previous = baseline.get(name, {}).get("calls", {}).get(call) if baseline else None
+            suffix = f" (was {previous})" if previous is not None and previous != count else ""
+            print(f"    {call:<28} {count:>6}{suffix}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=300, help="messages in the synthetic chat")
+    parser.add_argument("--images", type=int, default=40, help="how many of them carry an image")
+    parser.add_argument("--image-kb", type=int, default=200, help="size of each image when Pillow is not installed")
+    parser.add_argument("--days", type=int, default=60, help="days covered by the schedule")
+    parser.add_argument("--requests", type=int, default=200, help="status checker requests")
+    parser.add_argument("--gemini", choices=("cli", "fake"), default="cli",
+                        help="answer through the fake gemini CLI (a subprocess per call) or FakeBackend in process")
+    parser.add_argument("--gemini-delay", type=float, default=0.0, help="seconds the fake Gemini sleeps per call")
+    parser.add_argument("--calendar-qps", type=float, help="reject Calendar writes above this many per second (403 rateLimitExceeded)")
+    parser.add_argument("--queue", action="store_true", help="run the bot through its staged job queue (BOT_QUEUE=true)")
+    parser.add_argument("--memory", action="store_true", help="track peak Python memory per stage (slows every stage)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results written earlier with --json")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    args = parser.parse_args()
+
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["stages"]
+
+    workdir = tempfile.mkdtemp(prefix="e2e-bench-")
+    os.chdir(workdir)  # the bot keeps its temp images relative to the working directory
+    if args.memory:
+        tracemalloc.start()
+    bench = Bench(args, workdir)
+    bench.configure_env()
+    try:
+        mismatched = bench.run()
+    finally:
+        bench.close()
+
+    print_report(bench.results, baseline)
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"\nmax RSS: {max_rss_kb / 1024:.1f} MiB")
+    if mismatched:
+        print(f"Calendar does not match the schedule on {len(mismatched)} dates: {mismatched[:5]}")
+    else:
+        print("Calendar matches the schedule.")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "max_rss_kb": max_rss_kb, "stages": bench.results}, f, indent=2)
+    if args.keep:
+        print(f"Work directory and component log kept in {workdir}")
+    else:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+"""In-process stand-ins for the services the pipeline talks to.
+
+* FakeWaha: HTTP server with /api/sessions/{name}, /api/{session}/chats/{id}/messages
+  (limit/offset/filter.timestamp.gte paging) and /api/files/{name} downloads.
+* FakeCalendar: HTTP server speaking enough of Calendar v3 for the Lambdas:
+  events list/insert/patch/delete and the multipart batch endpoint.
+* FakeS3 / FakeSecretsManager: in-memory boto3 client stand-ins, with ETags,
+  If-Match/If-None-Match, object metadata, version ids (as in a versioned
+  bucket) and paginated list_objects_v2.
+* write_fake_gemini_cli: a `gemini` executable returning a canned schedule.
+
+Every fake counts the calls it serves in `calls` (a Counter), so a benchmark
+can report round trips per stage.
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import datetime
+import threading
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+from botocore.exceptions import ClientError
+
+
+class _Server:
+    """Runs a ThreadingHTTPServer on a free localhost port in a daemon thread."""
+
+    def __init__(self, handler_class):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        handler_class.fake = self
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+    fake = None
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def log_message(self, format, *args):
+        pass
+
+
+# --- WAHA ---
+
+class _WahaHandler(_Handler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[:2] == ["api", "sessions"] and len(parts) == 3:
+            self.fake.count("sessions")
+            self._send(200, {"name": parts[2], "status": self.fake.session_status})
+        elif parts[:2] == ["api", "files"]:
+            self.fake.count("files")
+            data = self.fake.files.get(unquote("/".join(parts[2:])))
+            if data is None:
+                self._send(404)
+            else:
+                self._send(200, data, content_type="image/jpeg")
+        elif len(parts) == 5 and parts[0] == "api" and parts[2] == "chats" and parts[4] == "messages":
+            self.fake.count("messages")
+            self._send(200, self.fake.page(unquote(parts[3]), parse_qs(url.query)))
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        self._body()
+        self.fake.count("start")
+        self.fake.session_status = "WORKING"
+        self._send(201, {})
+
+
+class FakeWaha(_Server):
+    def __init__(self):
+        self.session_status = "WORKING"
+        self.chats = {}  # chat id -> [message]
+        self.files = {}  # file name -> bytes
+        super().__init__(_WahaHandler)
+
+    def add_message(self, chat_id, message, image=None):
+        """Adds a WAHA message; with `image` bytes it gets a downloadable media URL."""
+        if image is not None:
+            name = f"{message['id']}.jpg"
+            self.files[name] = image
+            message["hasMedia"] = True
+            message["media"] = {"url": f"{self.url}/api/files/{name}", "mimetype": "image/jpeg"}
+        self.chats.setdefault(chat_id, []).append(message)
+
+    def page(self, chat_id, query):
+        since = int(query.get("filter.timestamp.gte", ["0"])[0])
+        limit = int(query.get("limit", ["100"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        # WAHA returns the newest messages first
+        messages = sorted(
+            (m for m in self.chats.get(chat_id, []) if m["timestamp"] >= since),
+            key=lambda m: m["timestamp"], reverse=True
+        )
+        return messages[offset:offset + limit]
+
+
+# --- Google Calendar v3 ---
+
+def _event_start(event, tz):
+    value = event["start"]
+    if "dateTime" in value:
+        return datetime.datetime.fromisoformat(value["dateTime"].replace("Z", "+00:00"))
+    return datetime.datetime.combine(datetime.date.fromisoformat(value["date"]), datetime.time.min, tzinfo=tz)
+
+
+def _event_end(event, tz):
+    value = event["end"]
+    if "dateTime" in value:
+        return datetime.datetime.fromisoformat(value["dateTime"].replace("Z", "+00:00"))
+    return datetime.datetime.combine(datetime.date.fromisoformat(value["date"]), datetime.time.min, tzinfo=tz)
+
+
+class _CalendarHandler(_Handler):
+    def do_GET(self):
+        self._dispatch("GET", self.path, self._body())
+
+    def do_POST(self):
+        if urlparse(self.path).path.startswith("/batch/"):
+            self._batch()
+        else:
+            self._dispatch("POST", self.path, self._body())
+
+    def do_PATCH(self):
+        self._dispatch("PATCH", self.path, self._body())
+
+    def do_DELETE(self):
+        self._dispatch("DELETE", self.path, self._body())
+
+    def _dispatch(self, method, path, body):
+        self.fake.count("http")
+        status, payload = self.fake.handle(method, path, body)
+        self._send(status, b"" if payload is None else payload)
+
+    def _batch(self):
+        """multipart/mixed in, multipart/mixed out; one application/http part per call."""
+        self.fake.count("http")
+        self.fake.count("batch")
+        raw = b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + self._body()
+        message = BytesParser(policy=HTTP).parsebytes(raw)
+        boundary = uuid.uuid4().hex
+        out = []
+        for part in message.iter_parts():
+            request = part.get_payload(decode=False)
+            head, _, body = request.replace("\r\n", "\n").partition("\n\n")
+            method, path, _ = head.split("\n", 1)[0].split(" ", 2)
+            status, payload = self.fake.handle(method, path, body.encode("utf-8"))
+            content_id = part["Content-ID"].strip("<>")
+            payload = b"" if payload is None else json.dumps(payload).encode("utf-8")
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode()
+                + payload + b"\r\n"
+            )
+        body = b"".join(out) + f"--{boundary}--\r\n".encode()
+        self._send(200, body, content_type=f"multipart/mixed; boundary={boundary}")
+
+
+class FakeCalendar(_Server):
+    PAGE_SIZE = 250
+
+    def __init__(self, writes_per_second=None, latency=0.0):
+        self.events = {}  # calendar id -> {event id: event}
+        self.latency = latency  # seconds added to every call, like Google's round trip
+        self._ids = 0
+        # Like Google's per-user write limit: over it, writes get 403 rateLimitExceeded
+        self.writes_per_second = writes_per_second
+        self._recent_writes = []
+        super().__init__(_CalendarHandler)
+
+    def add_event(self, calendar_id, event):
+        self._ids += 1
+        event = dict(event, id=f"evt{self._ids}")
+        self.events.setdefault(calendar_id, {})[event["id"]] = event
+        return event
+
+    def handle(self, method, path, body):
+        """Serves one Calendar call; returns (status, json payload or None)."""
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(path)
+        parts = [unquote(p) for p in url.path.strip("/").split("/")]
+        if "calendars" not in parts:
+            return 404, {"error": "unknown path"}
+        parts = parts[parts.index("calendars"):]
+        calendar = self.events.setdefault(parts[1], {})
+        with self._lock:
+            if method != "GET" and self._over_write_limit():
+                self.calls["rate_limited"] += 1
+                return 403, {"error": {"code": 403, "message": "Rate Limit Exceeded",
+                                       "errors": [{"domain": "usageLimits", "reason": "rateLimitExceeded"}]}}
+            if method == "GET" and len(parts) == 3:
+                self.calls["list"] += 1
+                return 200, self._list(calendar, parse_qs(url.query))
+            if method == "POST" and len(parts) == 3:
+                self.calls["insert"] += 1
+                self._ids += 1
+                event = dict(json.loads(body), id=f"evt{self._ids}")
+                calendar[event["id"]] = event
+                return 200, event
+            event_id = parts[3] if len(parts) == 4 else None
+            if event_id not in calendar:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            if method == "PATCH":
+                self.calls["patch"] += 1
+                calendar[event_id].update(json.loads(body))
+                return 200, calendar[event_id]
+            if method == "DELETE":
+                self.calls["delete"] += 1
+                del calendar[event_id]
+                return 204, None
+        return 405, {"error": "unsupported"}
+
+    def _over_write_limit(self):
+        """Counts a write in a sliding one-second window; True if it exceeds writes_per_second."""
+        if not self.writes_per_second:
+            return False
+        now = time.monotonic()
+        self._recent_writes = [t for t in self._recent_writes if now - t < 1.0]
+        if len(self._recent_writes) >= self.writes_per_second:
+            return True
+        self._recent_writes.append(now)
+        return False
+
+    def _list(self, calendar, query):
+        time_min = datetime.datetime.fromisoformat(query["timeMin"][0].replace("Z", "+00:00"))
+        time_max = datetime.datetime.fromisoformat(query["timeMax"][0].replace("Z", "+00:00"))
+        tz = time_min.tzinfo
+        matching = sorted(
+            (e for e in calendar.values() if _event_start(e, tz) < time_max and _event_end(e, tz) > time_min),
+            key=lambda e: _event_start(e, tz)
+        )
+        page_size = min(int(query.get("maxResults", [self.PAGE_SIZE])[0]), self.PAGE_SIZE)
+        offset = int(query.get("pageToken", ["0"])[0])
+        result = {"items": matching[offset:offset + page_size]}
+        if offset + page_size < len(matching):
+            result["nextPageToken"] = str(offset + page_size)
+        return result
+
+    def build_service(self):
+        """A googleapiclient Calendar client pointed at this server (no credentials needed)."""
+        import httplib2
+        from googleapiclient.discovery import build
+        from googleapiclient.http import BatchHttpRequest
+
+        service = build(
+            "calendar", "v3", http=httplib2.Http(), static_discovery=True, cache_discovery=False,
+            client_options={"api_endpoint": f"{self.url}/calendar/v3/"}
+        )
+        # The batch URI comes from the discovery document's rootUrl, not api_endpoint
+        batch_uri = f"{self.url}/batch/calendar/v3"
+        service.new_batch_http_request = lambda callback=None: BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+        return service
+
+
+# --- AWS ---
+
+class _Body(io.BytesIO):
+    """Stands in for botocore's StreamingBody."""
+
+
+def _client_error(code, operation, status=400):
+    return ClientError({"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, operation)
+
+
+class FakeS3:
+    LIST_PAGE_SIZE = 1000
+
+    def __init__(self, latency=0.0):
+        self.objects = {}  # (bucket, key) -> (bytes, etag, metadata)
+        self.modified = {}  # (bucket, key) -> datetime of the last put
+        self.versions = {}  # (bucket, key) -> {version id: (bytes, etag, metadata)}, oldest first
+        self.latency = latency  # seconds added to every object read, like a real round trip
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _version(self, Bucket, Key, VersionId, operation):
+        if VersionId is None:
+            if (Bucket, Key) not in self.objects:
+                raise _client_error("NoSuchKey", operation, 404)
+            return self.objects[(Bucket, Key)], next(reversed(self.versions[(Bucket, Key)]))
+        if VersionId not in self.versions.get((Bucket, Key), {}):
+            raise _client_error("NoSuchVersion", operation, 404)
+        return self.versions[(Bucket, Key)][VersionId], VersionId
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, VersionId=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls["get_object"] += 1
+            (body, etag, metadata), version_id = self._version(Bucket, Key, VersionId, "GetObject")
+        if IfNoneMatch and IfNoneMatch == etag:
+            raise _client_error("304", "GetObject", 304)
+        return {"Body": _Body(body), "ETag": etag, "Metadata": dict(metadata), "ContentLength": len(body),
+                "VersionId": version_id}
+
+    def head_object(self, Bucket, Key, VersionId=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls["head_object"] += 1
+            (body, etag, metadata), version_id = self._version(Bucket, Key, VersionId, "HeadObject")
+        return {"ETag": etag, "Metadata": dict(metadata), "ContentLength": len(body), "VersionId": version_id}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, Metadata=None, **kwargs):
+        body = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        with self._lock:
+            self.calls["put_object"] += 1
+            current = self.objects.get((Bucket, Key))
+            if IfNoneMatch == "*" and current is not None:
+                raise _client_error("PreconditionFailed", "PutObject", 412)
+            if IfMatch and (current is None or current[1] != IfMatch):
+                raise _client_error("PreconditionFailed", "PutObject", 412)
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            version_id = uuid.uuid4().hex
+            self.objects[(Bucket, Key)] = (body, etag, Metadata or {})
+            self.versions.setdefault((Bucket, Key), {})[version_id] = self.objects[(Bucket, Key)]
+            self.modified[(Bucket, Key)] = datetime.datetime.now(datetime.timezone.utc)
+        return {"ETag": etag, "VersionId": version_id}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=None, **kwargs):
+        MaxKeys = MaxKeys or self.LIST_PAGE_SIZE
+        with self._lock:
+            self.calls["list_objects_v2"] += 1
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+            offset = int(ContinuationToken or 0)
+            page = keys[offset:offset + MaxKeys]
+            result = {
+                "KeyCount": len(page),
+                "Contents": [{"Key": key, "Size": len(self.objects[(Bucket, key)][0]),
+                              "ETag": self.objects[(Bucket, key)][1], "LastModified": self.modified[(Bucket, key)]}
+                             for key in page],
+                "IsTruncated": offset + MaxKeys < len(keys),
+            }
+        if result["IsTruncated"]:
+            result["NextContinuationToken"] = str(offset + MaxKeys)
+        if not page:
+            del result["Contents"]
+        return result
+
+    def get_paginator(self, operation):
+        if operation != "list_objects_v2":
+            raise NotImplementedError(operation)
+        return _ListPaginator(self)
+
+
+class _ListPaginator:
+    """What boto3's list_objects_v2 paginator does: follow NextContinuationToken."""
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.s3.list_objects_v2(**kwargs, **({"ContinuationToken": token} if token else {}))
+            yield page
+            token = page.get("NextContinuationToken")
+            if not token:
+                return
+
+
+class FakeSecretsManager:
+    def __init__(self, secrets, latency=0.0):
+        self.secrets = secrets  # name -> SecretString; "*" answers any other name
+        self.latency = latency
+        self.calls = Counter()
+
+    def get_secret_value(self, SecretId, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls["get_secret_value"] += 1
+        value = self.secrets.get(SecretId, self.secrets.get("*"))
+        if value is None:
+            raise _client_error("ResourceNotFoundException", "GetSecretValue")
+        return {"Name": SecretId, "SecretString": value}
+
+
+def boto3_client_factory(s3, secretsmanager):
+    """A replacement for boto3.client / Session.client handing out the fakes."""
+    clients = {"s3": s3, "secretsmanager": secretsmanager}
+
+    def client(*args, **kwargs):
+        name = args[0] if args else kwargs["service_name"]
+        return clients[name]
+    return client
+
+
+# --- Gemini CLI ---
+
+FAKE_GEMINI_CLI = """#!{python}
+# Fake `gemini` CLI for benchmarks: answers every prompt with the schedule in
+# $BENCH_GEMINI_RESPONSE and appends one line per call to $BENCH_GEMINI_CALLS.
+import os, sys, json, time
+time.sleep(float(os.environ.get("BENCH_GEMINI_DELAY", "0")))
+with open(os.environ["BENCH_GEMINI_CALLS"], "a") as f:
+    f.write(str(len(" ".join(sys.argv))) + "\\n")
+with open(os.environ["BENCH_GEMINI_RESPONSE"]) as f:
+    print(json.dumps({{"response": f.read()}}))
+"""
+
+
+def write_fake_gemini_cli(directory):
+    """Writes an executable `gemini` into directory (prepend it to PATH)."""
+    path = os.path.join(directory, "gemini")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(FAKE_GEMINI_CLI.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return path
@@ -0,0 +1,68 @@
+"""Import-time report for the Lambda handlers.
+
+Runs `python -X importtime -c "import lambda_function"` in a fresh interpreter
+for each handler and prints the total plus the heaviest top-level imports, so
+cold-start regressions are visible. Exits non-zero when a handler exceeds
+--max-ms.
+
+    python benchmark/import_time_report.py --max-ms 400
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLERS = {
+    "status-checker": os.path.join(REPO_ROOT, "lambda-status-checker"),
+    "calendar-updater": os.path.join(REPO_ROOT, "lambda-calendar-updater"),
+}
+
+
+def measure(handler_dir, module="lambda_function"):
+    """Returns (total_us, [(cumulative_us, name)]) for the handler and its direct imports."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=handler_dir, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} in {handler_dir} failed:\n{result.stderr}")
+
+    # Children are printed before their parent and indented two spaces per level,
+    # so the handler's direct imports are the depth-1 lines since the last depth-0 one.
+    direct = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, raw_name = line[len("import time:"):].split("|")
+        name = raw_name[1:].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            direct.append((int(cumulative), name.strip()))
+        elif depth == 0:
+            if name == module:
+                return int(cumulative), sorted(direct, reverse=True)
+            direct = []
+    raise RuntimeError(f"No import time reported for {module}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=8, help="heaviest imports to list per handler")
+    parser.add_argument("--max-ms", type=float, help="fail when a handler's import time exceeds this")
+    args = parser.parse_args()
+
+    failed = False
+    for name, handler_dir in HANDLERS.items():
+        total, imports = measure(handler_dir)
+        print(f"{name}: {total / 1000:.1f} ms to import lambda_function")
+        for cumulative, module in imports[:args.top]:
+            print(f"  {cumulative / 1000:8.1f} ms  {module}")
+        if args.max_ms is not None and total / 1000 > args.max_ms:
+            print(f"  !! above the {args.max_ms:.0f} ms budget")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""Corpus check for the bot's local schedule parser.
+
+Runs every message in local_parser_corpus.json through
+utils/local_parser.py and compares the outcome with the expected one: either
+the exact `[date, location]` list the parser must produce on its own, or
+`null` when the message has to be left to Gemini. Prints the mismatches, the
+share of messages parsed locally and the time per message, and exits
+non-zero on any mismatch, so it can gate a CI job.
+
+    python benchmark/local_parser_corpus.py
+    python benchmark/local_parser_corpus.py --min-confidence 0.9 --verbose
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_DIR = os.path.join(REPO_ROOT, "docker-waha-gemini-s3", "automation_bot")
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_parser_corpus.json")
+DEFAULT_SENT = "2025-12-21"  # a Sunday
+
+
+def run(corpus, local_parser, repeat):
+    """Returns [(case, items or None, confidence)] and the mean parse time in microseconds."""
+    results = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        results = []
+        for case in corpus:
+            items, confidence = local_parser.parse(case["text"], date.fromisoformat(case.get("sent", DEFAULT_SENT)))
+            got = [[item["date"], item["location"]] for item in items] if local_parser.is_confident(confidence) else None
+            results.append((case, got, confidence))
+    elapsed = time.perf_counter() - started
+    return results, elapsed / (repeat * len(corpus)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=CORPUS, help="JSON list of {text, expect, sent?, why?}")
+    parser.add_argument("--min-confidence", type=float, help="override LOCAL_PARSER_MIN_CONFIDENCE")
+    parser.add_argument("--repeat", type=int, default=200, help="passes over the corpus for the timing")
+    parser.add_argument("--verbose", action="store_true", help="list every message, not only mismatches")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BOT_DIR)
+    from utils import local_parser
+    local_parser.LOCAL_PARSER = True
+    if args.min_confidence is not None:
+        local_parser.LOCAL_PARSER_MIN_CONFIDENCE = args.min_confidence
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = json.load(f)
+    results, per_message_us = run(corpus, local_parser, args.repeat)
+
+    wrong = fallback_missed = local = 0
+    for case, got, confidence in results:
+        expect = case["expect"]
+        ok = got == expect
+        local += got is not None
+        if not ok:
+            # Parsing a message wrongly is worse than handing a parseable one to Gemini
+            if got is not None:
+                wrong += 1
+            else:
+                fallback_missed += 1
+        if not ok or args.verbose:
+            status = "ok  " if ok else "FAIL"
+            print(f"{status} {confidence:.2f} {case['text']!r}")
+            if not ok:
+                print(f"       expected {expect}, got {got}")
+
+    print(f"{len(results)} messages, {local} parsed locally ({local / len(results):.0%}), "
+          f"{len(results) - local} left for Gemini")
+    print(f"{wrong} parsed wrongly, {fallback_missed} parseable but left for Gemini")
+    print(f"{per_message_us:.1f} us per message (threshold {local_parser.LOCAL_PARSER_MIN_CONFIDENCE})")
+    return 1 if wrong or fallback_missed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""Load test: the status checker as a Lambda vs. as the always-warm service.
+
+Replays the same request mix against both deployments of
+lambda-status-checker, sharing one handler, against local fakes with
+realistic latencies:
+
+* lambda: lambda_handler called in-process, with a cold start (fresh module
+  state: Secrets Manager lookups, decision index download, Calendar client
+  build, plus --lambda-init-ms for the runtime start-up that cannot be
+  reproduced in-process) on the first request and on --cold-ratio of the rest.
+* service: server.py on a local port, warmed up at start, secrets from the
+  environment (SECRETS_SOURCE=env), queried over HTTP with --concurrency
+  clients.
+
+The mix is mostly "where am I now" polls (decision index hits), some other
+days (every fifth is missing from the index and goes to the Calendar) and a
+7-day plan every 25th request. Reports p50/p90/p99/max per mode.
+
+    python benchmark/status_load_test.py
+    python benchmark/status_load_test.py --requests 2000 --cold-ratio 0.02 --concurrency 4
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import fakes
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHECKER_DIR = os.path.join(REPO_ROOT, "lambda-status-checker")
+CALENDAR_ID = "bench@group.calendar.google.com"
+BUCKET = "bench-bucket"
+HEADER_SECRET = "bench-secret"
+GOOGLE_SECRET = json.dumps({"client_email": "bench@example.com", "private_key_id": "bench"})
+
+
+def load_checker(name):
+    """A fresh copy of lambda_function.py: what a new Lambda container starts with."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(CHECKER_DIR, "lambda_function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def use_fake_calendar(module, calendar):
+    """Points the module's Calendar clients at the fake; the credentials lookup and per-thread client build still happen."""
+    module.get_google_creds = lambda secret_name=module.SECRET_NAME: (module.get_secret(secret_name), object())[1]
+    module.build_calendar_client = lambda creds: calendar.build_service()
+
+
+def seed(s3, calendar, today, days):
+    """Decision index for every day but each fifth, and Calendar events for all of them."""
+    dates = {}
+    for i in range(-1, days):
+        day = today + datetime.timedelta(days=i)
+        location = "Afeka" if i % 2 == 0 else "Home"
+        calendar.add_event(CALENDAR_ID, {
+            "summary": f"Study: {location}",
+            "start": {"date": day.isoformat()},
+            "end": {"date": (day + datetime.timedelta(days=1)).isoformat()},
+        })
+        if i % 5 != 4:
+            dates[day.isoformat()] = {"location": location, "trigger": location == "Afeka"}
+    s3.put_object(Bucket=BUCKET, Key="decision-index/daily.json", Body=json.dumps({"version": 1, "dates": dates}))
+
+
+def request_mix(rng, count, today, days):
+    """The query parameters of each of `count` requests."""
+    mix = []
+    for i in range(count):
+        if i % 25 == 24:
+            mix.append({"days": "7"})
+        elif rng.random() < 0.8:
+            mix.append({})
+        else:
+            mix.append({"at": (today + datetime.timedelta(days=rng.randrange(days))).isoformat() + "T08:00"})
+    return mix
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return {"p50": pick(50), "p90": pick(90), "p99": pick(99), "max": ordered[-1],
+            "mean": sum(ordered) / len(ordered)}
+
+
+def run_lambda(args, mix, calendar, rng):
+    """Latencies (ms) of in-process handler calls with cold starts mixed in."""
+    samples, colds = [], 0
+    module = None
+    event_headers = {"x-secret-header": HEADER_SECRET}
+    os.environ["SECRETS_SOURCE"] = "aws"
+    for i, params in enumerate(mix):
+        started = time.perf_counter()
+        if module is None or rng.random() < args.cold_ratio:
+            colds += 1
+            time.sleep(args.lambda_init_ms / 1000)
+            module = load_checker(f"status_checker_cold_{i}")
+            module.logger.setLevel("WARNING")
+            use_fake_calendar(module, calendar)
+        response = module.lambda_handler({"headers": event_headers, "queryStringParameters": params or None}, None)
+        samples.append((time.perf_counter() - started) * 1000)
+        if response["statusCode"] != 200:
+            raise RuntimeError(f"Lambda mode answered {response}")
+    return samples, colds
+
+
+def run_service(args, mix, calendar):
+    """Latencies (ms) of HTTP requests to server.py, after its warm-up."""
+    os.environ.update({"SECRETS_SOURCE": "env", "SECRET_HEADER": HEADER_SECRET, "GOOGLE_CALENDAR_API_KEY": GOOGLE_SECRET,
+                       "STATUS_HOST": "127.0.0.1", "STATUS_PORT": "0"})
+    sys.path.insert(0, CHECKER_DIR)
+    sys.modules.pop("lambda_function", None)
+    import server
+    server.lambda_function.logger.setLevel("WARNING")
+    use_fake_calendar(server.lambda_function, calendar)
+
+    started = time.perf_counter()
+    server.warm()
+    warm_up_ms = (time.perf_counter() - started) * 1000
+    httpd = server.StatusServer((server.STATUS_HOST, 0), server.StatusHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{httpd.server_address[1]}/"
+
+    def call(params):
+        query = "&".join(f"{k}={v}" for k, v in params.items())
+        request = urllib.request.Request(base + (f"?{query}" if query else ""), headers={"x-secret-header": HEADER_SECRET})
+        started = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f"Service answered {response.status}")
+        return (time.perf_counter() - started) * 1000
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            samples = list(pool.map(call, mix))
+    finally:
+        httpd.shutdown()
+    return samples, warm_up_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--days", type=int, default=30, help="days covered by the index and the calendar")
+    parser.add_argument("--cold-ratio", type=float, default=0.05, help="share of Lambda requests hitting a cold start")
+    parser.add_argument("--lambda-init-ms", type=float, default=250,
+                        help="runtime start-up a real cold start adds before the handler module loads")
+    parser.add_argument("--secrets-latency-ms", type=float, default=30, help="Secrets Manager round trip")
+    parser.add_argument("--s3-latency-ms", type=float, default=20, help="S3 round trip (decision index)")
+    parser.add_argument("--calendar-latency-ms", type=float, default=80, help="Google Calendar round trip")
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel clients against the service")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    os.environ.update({"DECISION_INDEX_BUCKET": BUCKET, "CALENDAR_ID": CALENDAR_ID, "METRICS_ENABLED": "false",
+                       "CALENDAR_TIMEZONE": "UTC"})
+    os.environ.pop("TENANTS_CONFIG", None)
+    rng = random.Random(args.seed)
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    s3 = fakes.FakeS3(latency=args.s3_latency_ms / 1000)
+    secrets = fakes.FakeSecretsManager({"SECRET_HEADER": json.dumps({"SECRET_HEADER": HEADER_SECRET}), "*": GOOGLE_SECRET},
+                                       latency=args.secrets_latency_ms / 1000)
+    calendar = fakes.FakeCalendar(latency=args.calendar_latency_ms / 1000)
+    seed(s3, calendar, today, args.days)
+    mix = request_mix(rng, args.requests, today, args.days)
+
+    results = {}
+    with mock.patch("boto3.client", fakes.boto3_client_factory(s3, secrets)), \
+            mock.patch("boto3.session.Session.client",
+                       lambda session, *a, **k: fakes.boto3_client_factory(s3, secrets)(*a, **k)):
+        samples, colds = run_lambda(args, mix, calendar, random.Random(args.seed))
+        results["lambda"] = dict(percentiles(samples), cold_starts=colds)
+        samples, warm_up_ms = run_service(args, mix, calendar)
+        results["service"] = dict(percentiles(samples), warm_up_ms=round(warm_up_ms, 1))
+    calendar.close()
+
+    print(f"{args.requests} requests ({args.cold_ratio:.0%} Lambda cold starts, {args.concurrency} concurrent service clients)")
+    print(f"{'mode':<8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} {'mean':>8}  (ms)")
+    for mode, result in results.items():
+        extra = f"  {result['cold_starts']} cold starts" if mode == "lambda" else f"  warm-up {result['warm_up_ms']} ms at start"
+        print(f"{mode:<8} " + " ".join(f"{result[k]:8.2f}" for k in ("p50", "p90", "p99", "max", "mean")) + extra)
+    print(f"p99: service {results['service']['p99']:.1f} ms vs lambda {results['lambda']['p99']:.1f} ms "
+          f"({results['lambda']['p99'] / results['service']['p99']:.0f}x)")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,18 @@
 from utils import process_messages
-from utils import waha_session_check
-from utils import waha_start_session
-import time
+from utils import waha_readiness
+from utils import webhook_server
+import os
 
-try:
-    time.sleep(15)
-    waha_start_session.waha_start_session()
+# "batch": process once and exit. "webhook": process once to catch up, then
+# stay up and process new messages as WAHA pushes them.
+BOT_MODE = os.getenv("BOT_MODE", "batch")
 
-except Exception as e:
-    print(e)
+readiness = waha_readiness.wait_until_ready()
+print(f"WAHA ready={readiness.ready} status={readiness.status} "
+      f"after {readiness.elapsed:.1f}s and {readiness.attempts} attempts")
 
-for s in range(120):
-    try:
-        session_status = waha_session_check.waha_session_check()
-        if session_status == "WORKING":
-            time.sleep(3)
-            process_messages.process_messages()
-            break
-    except Exception as e:
-        print(f"Error nach: {e}")
+if readiness.ready:
+    process_messages.process_messages()
 
-    time.sleep(2)
+if BOT_MODE == "webhook":
+    webhook_server.serve()
@@ -0,0 +1,203 @@
+import os
+import json
+import base64
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "cli" (default) shells out to the gemini CLI, "http" calls the API in
+# process, "fake" returns canned output for offline runs.
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "cli")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-pro")
+GEMINI_API_URL = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_MAX_WORKERS = int(os.getenv("GEMINI_MAX_WORKERS", "4"))
+GEMINI_TIMEOUT = int(os.getenv("GEMINI_TIMEOUT", "120"))
+
+# Each entry passed to a backend is a dict:
+#   {"msg_id": str, "line": "[time] sender: text", "image_path": str | None, "mime_type": str | None}
+
+
+def run_gemini_cli(prompt):
+    """Executes the gemini CLI command using subprocess."""
+    print("Running Gemini CLI...")
+
+    env = os.environ.copy()
+    if GEMINI_API_KEY:
+        env["GOOGLE_API_KEY"] = GEMINI_API_KEY
+
+    command = [
+        "gemini",
+        "-p", prompt,
+        "-m", "pro",
+        "--output-format", "json"
+    ]
+
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, env=env)
+
+        if result.returncode == 0:
+            try:
+                return json.loads(result.stdout)
+            except json.JSONDecodeError:
+                print(f"JSON Error. Raw Output: {result.stdout}")
+                return None
+        else:
+            print(f"CLI Error: {result.stderr}")
+            return None
+    except FileNotFoundError:
+        print("Error: 'gemini' command not found. Ensure CLI is installed.")
+        return None
+
+
+def extract_schedule_list(text):
+    """Parses a model reply into a list of entries, or None if it holds no list."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[4:].strip()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, list) else None
+
+
+def merge_by_date(results):
+    """Merges per-call schedule lists; later lists win for the same date."""
+    merged = {}
+    for entries in results:
+        for entry in entries:
+            if isinstance(entry, dict) and entry.get("date"):
+                merged[entry["date"]] = entry
+    return [merged[date] for date in sorted(merged)]
+
+
+class CliBackend:
+    """Sends everything in one prompt through the gemini CLI (@path image syntax)."""
+    name = "cli"
+
+    def parse(self, prompt, entries):
+        prompt_parts = [prompt, "\n--- USER INPUT START ---"]
+        for entry in entries:
+            image_tag = f" [Attached Image: @{entry['image_path']}]" if entry.get("image_path") else ""
+            prompt_parts.append(f"{entry['line']}{image_tag}")
+        prompt_parts.append("--- USER INPUT END ---")
+        return run_gemini_cli("\n".join(prompt_parts))
+
+
+class HttpBackend:
+    """Calls the Gemini API in process over a pooled session, one request per image in parallel."""
+    name = "http"
+
+    def __init__(self, session=None, max_workers=GEMINI_MAX_WORKERS):
+        self.session = session or requests.Session()
+        self.max_workers = max_workers
+
+    def generate(self, prompt, lines, image=None):
+        """One generateContent call; returns the reply text."""
+        parts = [{"text": "\n".join([prompt, "\n--- USER INPUT START ---", *lines, "--- USER INPUT END ---"])}]
+        if image:
+            path, mime_type = image
+            with open(path, "rb") as f:
+                data = base64.b64encode(f.read()).decode("ascii")
+            parts.append({"inline_data": {"mime_type": mime_type or "image/jpeg", "data": data}})
+
+        response = self.session.post(
+            f"{GEMINI_API_URL}/models/{GEMINI_MODEL}:generateContent",
+            headers={"x-goog-api-key": GEMINI_API_KEY or ""},
+            json={
+                "contents": [{"role": "user", "parts": parts}],
+                "generationConfig": {"responseMimeType": "application/json"}
+            },
+            timeout=GEMINI_TIMEOUT
+        )
+        response.raise_for_status()
+        candidates = response.json().get("candidates") or [{}]
+        return "".join(p.get("text", "") for p in candidates[0].get("content", {}).get("parts", []))
+
+    def _jobs(self, entries):
+        """Splits entries into independent calls: all text together, then one per image.
+
+        Each job is (position, lines, image, source message id). Jobs are ordered
+        by their last message so later messages win when merged.
+        """
+        text_lines = [(i, e["line"]) for i, e in enumerate(entries) if not e.get("image_path")]
+        jobs = []
+        if text_lines:
+            source = entries[text_lines[0][0]].get("msg_id") if len(text_lines) == 1 else None
+            jobs.append((text_lines[-1][0], [line for _, line in text_lines], None, source))
+        for i, entry in enumerate(entries):
+            if entry.get("image_path"):
+                jobs.append((i, [entry["line"]], (entry["image_path"], entry.get("mime_type")), entry.get("msg_id")))
+        return sorted(jobs, key=lambda job: job[0])
+
+    def parse(self, prompt, entries):
+        jobs = self._jobs(entries)
+        print(f"Calling Gemini API with {len(jobs)} parallel requests...")
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                replies = list(pool.map(lambda job: self.generate(prompt, job[1], job[2]), jobs))
+        except Exception as e:
+            print(f"Gemini API Error: {e}. Falling back to the CLI.")
+            return CliBackend().parse(prompt, entries)
+
+        results = [extract_schedule_list(reply) for reply in replies]
+        # Tag entries with the message they came from when a call covered a single message
+        for job, result in zip(jobs, results):
+            for item in result or []:
+                if isinstance(item, dict) and job[3]:
+                    item.setdefault("source", job[3])
+        if all(r is None for r in results):
+            # Nothing parseable (e.g. the "No info" sentinel): pass the reply through as the CLI would
+            return {"response": replies[0] if replies else ""}
+        merged = merge_by_date(r for r in results if r is not None)
+        return {"response": json.dumps(merged, ensure_ascii=False)}
+
+
+class FakeBackend:
+    """Offline backend for tests and benchmarks.
+
+    `responder(prompt, entries)` returns the model text; by default it returns
+    GEMINI_FAKE_RESPONSE (or an empty list).
+    """
+    name = "fake"
+
+    def __init__(self, responder=None):
+        self.responder = responder or (lambda prompt, entries: os.getenv("GEMINI_FAKE_RESPONSE", "[]"))
+        self.calls = []
+
+    def parse(self, prompt, entries):
+        self.calls.append(entries)
+        return {"response": self.responder(prompt, entries)}
+
+
+BACKENDS = {
+    "cli": CliBackend,
+    "http": HttpBackend,
+    "fake": FakeBackend,
+}
+
+_backend = None
+
+
+def set_backend(backend):
+    """Overrides the active backend instance (used by tests and benchmarks)."""
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    """Returns the backend selected by GEMINI_BACKEND, falling back to the CLI."""
+    global _backend
+    if _backend is None:
+        factory = BACKENDS.get(GEMINI_BACKEND)
+        if factory is None:
+            print(f"Unknown GEMINI_BACKEND '{GEMINI_BACKEND}', using the CLI.")
+            factory = CliBackend
+        _backend = factory()
+    return _backend
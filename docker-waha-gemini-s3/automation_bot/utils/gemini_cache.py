@@ -0,0 +1,128 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Lives inside the bot's mounted volume so results survive container restarts.
+CACHE_DIR = os.getenv("GEMINI_CACHE_DIR", "./gemini_cache")
+CACHE_MAX_BYTES = int(os.getenv("GEMINI_CACHE_MAX_BYTES", str(20 * 1024 * 1024)))
+STATS_FILE = os.path.join(CACHE_DIR, "stats.json")
+# Media and parse workers hit the cache in parallel; they share one stats file
+_stats_lock = threading.Lock()
+
+
+def hash_file(path):
+    """SHA-256 of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(prompt, parts):
+    """Cache key from the prompt version plus the ordered message contents.
+
+    `parts` are strings such as "text:<body>" or "image:<sha256>", so the same
+    schedule forwarded again (new message id, new timestamp) hits the cache.
+    """
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(prompt.encode("utf-8")).digest())
+    for part in parts:
+        digest.update(b"\0")
+        digest.update(part.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def _write_json(path, value):
+    """Writes through a uniquely named temp file and swaps it in, so concurrent
+    writers never share a temp file and readers never see half a document."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _record(field):
+    with _stats_lock:
+        stats = get_stats()
+        stats[field] = stats.get(field, 0) + 1
+        try:
+            _write_json(STATS_FILE, stats)
+        except OSError as e:
+            print(f"Could not update cache stats: {e}")
+
+
+def get_stats():
+    """Cumulative hit/miss counters."""
+    try:
+        with open(STATS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {"hits": 0, "misses": 0}
+
+
+def get(key):
+    """Returns the cached Gemini response for a key, or None."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _entry_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            value = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        _record("misses")
+        return None
+
+    # Bump mtime so eviction treats this entry as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass  # evicted by another worker since we read it
+    _record("hits")
+    return value
+
+
+def put(key, value):
+    """Stores a Gemini response and evicts least recently used entries over the size cap."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    _write_json(_entry_path(key), value)
+    evict()
+
+
+def evict(max_bytes=CACHE_MAX_BYTES):
+    """Deletes the least recently used entries until the cache fits in max_bytes."""
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith(".json") or name == os.path.basename(STATS_FILE):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # removed by a concurrent eviction
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
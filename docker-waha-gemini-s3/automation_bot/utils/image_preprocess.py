@@ -0,0 +1,193 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+from dotenv import load_dotenv
+
+try:
+    from PIL import Image, ImageChops, ImageOps
+except ImportError:  # Pillow is optional: without it images are only sniffed and exact-deduplicated
+    Image = None
+
+load_dotenv()
+
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "true").lower() == "true"
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_MAX_WORKERS = int(os.getenv("IMAGE_MAX_WORKERS", "4"))
+# Max dHash bit difference for two images to count as the same picture. Off by
+# default: two weeks of the same timetable share a layout and hash alike even
+# though their cells differ. Byte-identical copies are always skipped.
+IMAGE_DEDUPE_DISTANCE = int(os.getenv("IMAGE_DEDUPE_DISTANCE", "-1"))
+# How far a pixel may be from the corner colour and still count as margin (0-255)
+MARGIN_TOLERANCE = 12
+MARGIN_PADDING = 8
+
+# (offset, signature, format, mime type)
+SIGNATURES = [
+    (0, b"\xff\xd8\xff", "jpeg", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "png", "image/png"),
+    (0, b"GIF87a", "gif", "image/gif"),
+    (0, b"GIF89a", "gif", "image/gif"),
+    (8, b"WEBP", "webp", "image/webp"),
+    (4, b"ftypheic", "heic", "image/heic"),
+    (4, b"ftypmif1", "heif", "image/heif"),
+]
+EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "gif": ".gif", "webp": ".webp", "heic": ".heic", "heif": ".heif"}
+
+
+@dataclass
+class PreparedImage:
+    path: str
+    mime_type: str
+    sha256: str  # of the downloaded bytes, so forwarded copies hit the Gemini cache
+    bytes_before: int
+    bytes_after: int
+    dhash: Optional[int] = None
+    duplicate_of: Optional[str] = None  # msg id of the newer copy of this image
+
+
+def detect_format(path):
+    """Returns (format, mime type) from the file's magic bytes, or (None, None)."""
+    with open(path, "rb") as f:
+        head = f.read(16)
+    for offset, signature, fmt, mime_type in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if fmt == "webp" and not head.startswith(b"RIFF"):
+                continue
+            return fmt, mime_type
+    return None, None
+
+
+def dhash(image, size=8):
+    """64-bit difference hash: brightness gradients of a 9x8 thumbnail."""
+    small = image.convert("L").resize((size + 1, size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def crop_margins(image):
+    """Crops borders of the corner colour (phone chrome, letterboxing) around the schedule."""
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    diff = ImageChops.difference(image, background).convert("L")
+    bbox = diff.point(lambda v: 255 if v > MARGIN_TOLERANCE else 0).getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    bbox = (
+        max(left - MARGIN_PADDING, 0),
+        max(top - MARGIN_PADDING, 0),
+        min(right + MARGIN_PADDING, image.width),
+        min(bottom + MARGIN_PADDING, image.height),
+    )
+    return image.crop(bbox) if bbox != (0, 0, image.width, image.height) else image
+
+
+def _shrink(path, fmt, mime_type):
+    """Crops, downscales and recompresses; returns (path, mime type, dhash).
+
+    Screenshots (PNG) are also re-encoded as PNG and whichever encoding is
+    smaller wins. A JPEG or PNG original is kept when nothing beats its byte
+    size, even after a crop or downscale.
+    """
+    with Image.open(path) as original:
+        # Let the JPEG decoder skip detail we would throw away (DCT scaling)
+        original.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+        image = ImageOps.exif_transpose(original).convert("RGB")
+    image = crop_margins(image)
+    image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+    image_hash = dhash(image)
+
+    base = os.path.splitext(path)[0]
+    candidates = [(f"{base}.jpg.tmp", "JPEG", "image/jpeg", {"quality": IMAGE_JPEG_QUALITY, "optimize": True})]
+    if fmt == "png":
+        candidates.append((f"{base}.png.tmp", "PNG", "image/png", {"optimize": True}))
+    for tmp_path, encoder, _, options in candidates:
+        image.save(tmp_path, encoder, **options)
+    best = min(candidates, key=lambda c: os.path.getsize(c[0]))
+
+    keep_original = fmt in ("jpeg", "png") and os.path.getsize(best[0]) >= os.path.getsize(path)
+    for tmp_path, *_ in candidates:
+        if keep_original or tmp_path != best[0]:
+            os.remove(tmp_path)
+    if keep_original:
+        return path, mime_type, image_hash
+
+    out_path = best[0][:-len(".tmp")]
+    os.replace(best[0], out_path)
+    if out_path != path:
+        os.remove(path)
+    return out_path, best[2], image_hash
+
+
+def prepare(path):
+    """Sniffs, and with Pillow shrinks, one downloaded image. Returns None for non-images."""
+    fmt, mime_type = detect_format(path)
+    if not fmt:
+        print(f"Not an image (unknown magic bytes), skipping: {path}")
+        return None
+
+    with open(path, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    bytes_before = os.path.getsize(path)
+
+    # Give the file the extension of what it really is (WAHA files are saved as .jpg)
+    real_path = f"{os.path.splitext(path)[0]}{EXTENSIONS[fmt]}"
+    if real_path != path:
+        os.replace(path, real_path)
+        path = real_path
+
+    image_hash = None
+    if IMAGE_PREPROCESS and Image is not None:
+        try:
+            path, mime_type, image_hash = _shrink(path, fmt, mime_type)
+        except Exception as e:  # e.g. HEIC without a decoder plugin: send it unchanged
+            print(f"Could not preprocess {path} ({e}), sending it unchanged.")
+    return PreparedImage(path, mime_type, sha256, bytes_before, os.path.getsize(path), image_hash)
+
+
+def prepare_all(image_paths):
+    """Prepares {msg_id: path} (oldest message first) and marks duplicates.
+
+    Of two identical (or, with IMAGE_DEDUPE_DISTANCE, perceptually close)
+    images the newer one is kept. Returns {msg_id: PreparedImage}.
+    """
+    downloaded = [(msg_id, path) for msg_id, path in image_paths.items() if path]
+    with ThreadPoolExecutor(max_workers=IMAGE_MAX_WORKERS) as pool:
+        results = list(pool.map(lambda item: prepare(item[1]), downloaded))
+    return mark_duplicates({msg_id: image for (msg_id, _), image in zip(downloaded, results) if image})
+
+
+def mark_duplicates(prepared):
+    """Sets duplicate_of on older copies in {msg_id: PreparedImage} (oldest first) and returns it."""
+    kept = []
+    for msg_id in reversed(list(prepared)):
+        image = prepared[msg_id]
+        for kept_id in kept:
+            other = prepared[kept_id]
+            if image.sha256 == other.sha256 or (
+                IMAGE_DEDUPE_DISTANCE >= 0 and image.dhash is not None and other.dhash is not None
+                and hamming(image.dhash, other.dhash) <= IMAGE_DEDUPE_DISTANCE
+            ):
+                image.duplicate_of = kept_id
+                break
+        else:
+            kept.append(msg_id)
+
+    if prepared:
+        before = sum(image.bytes_before for image in prepared.values())
+        after = sum(image.bytes_after for image in prepared.values() if not image.duplicate_of)
+        duplicates = len(prepared) - len(kept)
+        print(f"Images: {before} -> {after} bytes to send ({len(kept)} kept, {duplicates} duplicates skipped).")
+    return prepared
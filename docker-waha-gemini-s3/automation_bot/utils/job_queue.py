@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Lives inside the bot's mounted volume next to the cursors, so queued work
+# survives container restarts.
+QUEUE_DB = os.getenv("BOT_QUEUE_DB", "./state/jobs.db")
+QUEUE_RETENTION_DAYS = float(os.getenv("QUEUE_RETENTION_DAYS", "7"))
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    chat_id TEXT,
+    window_key TEXT,
+    seq REAL NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (stage, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, stage, next_attempt);
+CREATE INDEX IF NOT EXISTS jobs_chat ON jobs (chat_id, status, stage);
+"""
+
+_init_lock = threading.Lock()
+_initialized = set()
+_local = threading.local()
+
+
+@dataclass
+class Job:
+    stage: str
+    key: str  # idempotency key: enqueuing the same (stage, key) twice is a no-op
+    chat_id: Optional[str] = None
+    window_key: Optional[str] = None  # the batch of messages this job belongs to
+    seq: float = 0  # orders windows of one chat (newest message timestamp)
+    payload: dict = field(default_factory=dict)
+    attempts: int = 0
+
+
+def _connect():
+    """This thread's connection; jobs are claimed and finished from several threads at once."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.path == QUEUE_DB:
+        return conn
+    with _init_lock:
+        if QUEUE_DB not in _initialized:
+            os.makedirs(os.path.dirname(QUEUE_DB) or ".", exist_ok=True)
+    conn = sqlite3.connect(QUEUE_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # With WAL this still survives a crashed process; only a power cut can lose the last commits
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with _init_lock:
+        if QUEUE_DB not in _initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            _initialized.add(QUEUE_DB)
+    _local.conn, _local.path = conn, QUEUE_DB
+    return conn
+
+
+def _job(row):
+    return Job(row["stage"], row["key"], row["chat_id"], row["window_key"], row["seq"],
+               json.loads(row["payload"]), row["attempts"])
+
+
+def enqueue(*jobs):
+    """Adds jobs in one transaction, skipping any whose (stage, key) already exists.
+
+    Returns how many were added.
+    """
+    now = time.time()
+    conn = _connect()
+    with conn:
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO jobs (stage, key, chat_id, window_key, seq, payload, next_attempt, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(job.stage, job.key, job.chat_id, job.window_key, job.seq,
+              json.dumps(job.payload, ensure_ascii=False), now, now) for job in jobs],
+        )
+    return cursor.rowcount
+
+
+def due(stage, limit):
+    """Pending jobs of a stage whose backoff has passed, oldest window first."""
+    conn = _connect()
+    rows = conn.execute(
+        "SELECT * FROM jobs WHERE status = ? AND stage = ? AND next_attempt <= ? ORDER BY seq, next_attempt LIMIT ?",
+        (PENDING, stage, time.time(), limit),
+    ).fetchall()
+    return [_job(row) for row in rows]
+
+
+def claim(job):
+    """Marks a pending job as running. False if another worker got it first."""
+    conn = _connect()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ? WHERE stage = ? AND key = ? AND status = ?",
+            (RUNNING, time.time(), job.stage, job.key, PENDING),
+        )
+    if cursor.rowcount:
+        job.attempts += 1
+    return bool(cursor.rowcount)
+
+
+def _finish(job, status, error=None, delay=0, payload=None):
+    now = time.time()
+    conn = _connect()
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, last_error = ?, next_attempt = ?, payload = COALESCE(?, payload), updated = ?"
+            " WHERE stage = ? AND key = ?",
+            (status, error, now + delay, None if payload is None else json.dumps(payload, ensure_ascii=False),
+             now, job.stage, job.key),
+        )
+
+
+def complete(job, payload=None):
+    """Marks a job done, optionally storing its result in the payload."""
+    _finish(job, DONE, payload=payload)
+
+
+def retry(job, error, delay):
+    """Puts a job back to pending, not to be picked up for `delay` seconds."""
+    _finish(job, PENDING, error=error, delay=delay)
+
+
+def fail(job, error):
+    """Gives up on a job; it stays in the table for inspection."""
+    _finish(job, FAILED, error=error)
+
+
+def payloads(stage, keys):
+    """{key: payload} for the given jobs of a stage."""
+    keys = list(keys)
+    if not keys:
+        return {}
+    conn = _connect()
+    rows = conn.execute(
+        f"SELECT key, payload FROM jobs WHERE stage = ? AND key IN ({','.join('?' * len(keys))})",
+        [stage] + keys,
+    ).fetchall()
+    return {row["key"]: json.loads(row["payload"]) for row in rows}
+
+
+def unfinished(chat_id, stages, keys=None, before_seq=None, statuses=(PENDING, RUNNING)):
+    """Counts a chat's jobs in the given stages that are still pending or running.
+
+    Narrowed to the given job keys, or to older windows with before_seq.
+    """
+    query = (f"SELECT COUNT(*) FROM jobs WHERE chat_id = ? AND status IN ({','.join('?' * len(statuses))})"
+             f" AND stage IN ({','.join('?' * len(stages))})")
+    params = [chat_id] + list(statuses) + list(stages)
+    if keys is not None:
+        query += f" AND key IN ({','.join('?' * len(keys))})"
+        params += list(keys)
+    if before_seq is not None:
+        query += " AND seq < ?"
+        params.append(before_seq)
+    conn = _connect()
+    return conn.execute(query, params).fetchone()[0]
+
+
+def next_attempt():
+    """The earliest time a pending job becomes due, or None when nothing is pending."""
+    conn = _connect()
+    return conn.execute("SELECT MIN(next_attempt) FROM jobs WHERE status = ?", (PENDING,)).fetchone()[0]
+
+
+def recover():
+    """Returns jobs left running by a crashed process to pending. Returns how many."""
+    conn = _connect()
+    with conn:
+        return conn.execute(
+            "UPDATE jobs SET status = ?, next_attempt = ?, updated = ? WHERE status = ?",
+            (PENDING, time.time(), time.time(), RUNNING),
+        ).rowcount
+
+
+def prune(max_age_days=QUEUE_RETENTION_DAYS):
+    """Deletes finished jobs older than max_age_days. Returns how many."""
+    conn = _connect()
+    with conn:
+        return conn.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+            (DONE, FAILED, time.time() - max_age_days * 86400),
+        ).rowcount
+
+
+def counts():
+    """{stage: {status: n}} over the whole table."""
+    conn = _connect()
+    rows = conn.execute("SELECT stage, status, COUNT(*) FROM jobs GROUP BY stage, status").fetchall()
+    result = {}
+    for stage, status, n in rows:
+        result.setdefault(stage, {})[status] = n
+    return result
@@ -0,0 +1,222 @@
+import os
+import re
+import json
+from datetime import date, timedelta
+from dotenv import load_dotenv
+from utils import schedule_model
+
+load_dotenv()
+
+# Plain-text schedules ("25.12.25 Zoom") are parsed here instead of by Gemini.
+# Anything scoring below LOCAL_PARSER_MIN_CONFIDENCE still goes to the model.
+LOCAL_PARSER = os.getenv("LOCAL_PARSER", "true").lower() == "true"
+LOCAL_PARSER_MIN_CONFIDENCE = float(os.getenv("LOCAL_PARSER_MIN_CONFIDENCE", "0.8"))
+
+# The text fallback rules of GEMINI_PROMPT. Home words are whole words, with
+# Hebrew prefixes allowed (מהבית, בזום); Afeka words are matched inside longer
+# words. Compounds that only contain a Home word (school, homework, hospital)
+# are removed before matching.
+HOME_PATTERN = re.compile(
+    r"\b(?:home|zoom|online|remote)\b|(?<!\w)[ושמבלהכ]{0,3}(?:בית|מקוון|זום|מרחוק)(?!\w)", re.IGNORECASE
+)
+NOT_HOME_PATTERN = re.compile(
+    r"\bhome\s*work\w*|(?<!\w)[ושמבלהכ]{0,3}בית\s+[ה]?(?:ספר|חולים)(?!\w)|(?<!\w)[ו]?שיעורי\s+[ה]?בית(?!\w)",
+    re.IGNORECASE,
+)
+AFEKA_WORDS = ("אפקה", "קמפוס", "כיתה", "מעבדה", "תרגול")
+AFEKA_PATTERN = re.compile(r"\b(?:afeka|campus|college|lab|labs|class|classes|classroom|exercise|room)\b", re.IGNORECASE)
+# Words that turn a plain statement into something the rules cannot read
+# ("not on Zoom", "cancelled", "instead of"), and questions
+DOUBT_PATTERN = re.compile(
+    r"\b(?:not|no|cancel\w*|instead|except|maybe|unless|postponed)\b|\?"
+    r"|(?<!\w)[ו]?(?:לא|אין|בוטל\w*|במקום|חוץ|אולי|נדחה)(?!\w)"
+    # Deadlines and assignments: a date there is a due date, not where class is
+    r"|\b(?:due|submit\w*|submission\w*|assignment\w*|homework\w*)\b"
+    r"|(?<!\w)[ו]?(?:[לה]?הגש\w*|עד)(?!\w)",
+    re.IGNORECASE,
+)
+
+DATE_PATTERN = re.compile(
+    r"(?<![\d./])(?<!\d-)(?:(\d{4})-(\d{2})-(\d{2})|(\d{1,2})[./](\d{1,2})(?:[./](\d{4}|\d{2}))?)(?![\d./-]*\d)"
+)
+DATE_RANGE_PATTERN = re.compile(r"\d{1,2}[./]\d{1,2}(?:[./]\d{2,4})?\s*[-–]\s*\d{1,2}[./]\d{1,2}")
+# Sunday-Thursday; Hebrew names need "יום" ("שני" alone also means "second")
+HEBREW_DAYS = {"ראשון": 6, "שני": 0, "שלישי": 1, "רביעי": 2, "חמישי": 3, "שישי": 4, "שבת": 5}
+HEBREW_DAY_LETTERS = {"א": 6, "ב": 0, "ג": 1, "ד": 2, "ה": 3, "ו": 4}
+WEEKDAY_PATTERN = re.compile(
+    r"(?<!\w)[ו]?[בל]?יום\s+(ראשון|שני|שלישי|רביעי|חמישי|שישי)(?!\w)"
+    r"|(?<!\w)[ו]?[בל]?יום\s+([אבגדהו])['׳](?!\w)"
+    r"|\b(sunday|monday|tuesday|wednesday|thursday|friday|saturday)\b"
+    r"|(?<!\w)(?:ו)?(?:ב)?(שבת)(?!\w)",
+    re.IGNORECASE,
+)
+ENGLISH_DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+RELATIVE_PATTERN = re.compile(r"\b(today|tomorrow)\b|(?<!\w)[ו]?(היום|מחר)(?!\w)", re.IGNORECASE)
+CLAUSE_SPLIT = re.compile(r"[\n;,|]+|\s+(?:and|&)\s+|\s+ו(?=(?:ב|ל)?(?:יום|\d))")
+# Numbers right after these name a room or a class ("room 5.3", "class 3.2"), not a date
+NUMBER_LABEL_PATTERN = re.compile(
+    r"(?:\b(?:room|class|classroom)|(?<!\w)[ו]?[בל]?(?:חדר|כיתה))\s*(?:no\.?|#)?\s*$", re.IGNORECASE
+)
+# Dates without a year must fall this close to the message to be trusted
+MAX_DAYS_AHEAD = 120
+MAX_DAYS_BEHIND = 14
+# "24.12" reads as a date; "3.2" or "1.1" only counts when a weekday name next
+# to it agrees, otherwise the factor keeps it under the threshold
+SHORT_DATE_FACTOR = 0.5
+
+
+def find_locations(text):
+    """Returns the set of Location values named in text."""
+    lowered = text.lower()
+    found = set()
+    if HOME_PATTERN.search(NOT_HOME_PATTERN.sub(" ", text)):
+        found.add(schedule_model.Location.HOME)
+    if AFEKA_PATTERN.search(text) or any(word in lowered for word in AFEKA_WORDS):
+        found.add(schedule_model.Location.AFEKA)
+    return found
+
+
+def _pick_location(locations):
+    """(location, confidence factor); explicit Home overrides, as in the prompt."""
+    if not locations:
+        return None, 0.0
+    if schedule_model.Location.HOME in locations:
+        return schedule_model.Location.HOME, 1.0 if len(locations) == 1 else 0.9
+    return schedule_model.Location.AFEKA, 1.0
+
+
+def _explicit_dates(clause, reference):
+    """Yields (date, confidence factor) for DD.MM[.YY] and YYYY-MM-DD dates in clause."""
+    for match in DATE_PATTERN.finditer(clause):
+        if NUMBER_LABEL_PATTERN.search(clause, 0, match.start()):
+            yield None, 0.0  # "room 5.3" is not a date, and the rest may not be either
+            continue
+        iso_year, iso_month, iso_day, day, month, year = match.groups()
+        try:
+            if iso_year:
+                yield date(int(iso_year), int(iso_month), int(iso_day)), 1.0
+            elif year:
+                yield date(int(year) + (2000 if len(year) == 2 else 0), int(month), int(day)), 1.0
+            else:
+                # No year: the candidate nearest to the message, if it is plausibly close
+                candidates = []
+                for y in (reference.year - 1, reference.year, reference.year + 1):
+                    try:
+                        candidates.append(date(y, int(month), int(day)))
+                    except ValueError:
+                        pass
+                if not candidates:
+                    raise ValueError(match.group(0))
+                nearest = min(candidates, key=lambda d: abs((d - reference).days))
+                offset = (nearest - reference).days
+                if not -MAX_DAYS_BEHIND <= offset <= MAX_DAYS_AHEAD:
+                    yield nearest, 0.0
+                else:
+                    yield nearest, 0.95 if len(day) == 2 and len(month) == 2 else SHORT_DATE_FACTOR
+        except ValueError:
+            yield None, 0.0  # "10.30" is a time, "31.02" is a typo: let the model look
+
+
+def _named_dates(clause, reference):
+    """Yields (date, confidence factor) for weekday names and today/tomorrow."""
+    for match in WEEKDAY_PATTERN.finditer(clause):
+        hebrew_name, hebrew_letter, english_name, shabbat = match.groups()
+        if hebrew_name:
+            weekday = HEBREW_DAYS[hebrew_name]
+        elif hebrew_letter:
+            weekday = HEBREW_DAY_LETTERS[hebrew_letter]
+        elif english_name:
+            weekday = ENGLISH_DAYS.index(english_name.lower())
+        else:
+            weekday = HEBREW_DAYS[shabbat]
+        # The coming occurrence; naming the current weekday could mean today or next week
+        offset = (weekday - reference.weekday()) % 7
+        yield reference + timedelta(days=offset), 0.9 if offset else 0.0
+    for match in RELATIVE_PATTERN.finditer(clause):
+        word = (match.group(1) or match.group(2)).lower()
+        yield reference + timedelta(days=1 if word in ("tomorrow", "מחר") else 0), 0.9
+
+
+def parse(text, reference):
+    """Rule-based parse of one text message sent on the `reference` date.
+
+    Returns (items, confidence): items in the `[{"date", "location"}]` schema
+    of GEMINI_PROMPT and a confidence from 0 to 1. Each clause (line, or part
+    of a line split at "," / ";" / "and") contributes its dates with the
+    location named in the same clause, else the one location named on the
+    line or in the whole message. The confidence is the weakest entry's:
+    lowered for dates without a year (below the threshold for one-digit ones
+    like "3.2" unless a weekday name on the line agrees), weekday names,
+    inherited locations and Home-over-Afeka conflicts, and zero for anything
+    the rules cannot read (no date, no location, room or class numbers, date
+    ranges, negations, questions, Friday or Saturday dates, weekday names
+    that contradict the date next to them).
+    """
+    text = (text or "").strip()
+    if not text:
+        return [], 0.0
+    if DATE_RANGE_PATTERN.search(text) or DOUBT_PATTERN.search(text):
+        return [], 0.0
+
+    message_locations = find_locations(text)
+    message_location, _ = _pick_location(message_locations)
+    items = []
+    confidence = 1.0
+    for line in text.splitlines():
+        line_locations = find_locations(line)
+        line_location, _ = _pick_location(line_locations)
+        explicit_on_line = [d for d, _ in _explicit_dates(line, reference) if d]
+        named_weekdays = {d.weekday() for d, _ in _named_dates(line, reference)}
+        for clause in CLAUSE_SPLIT.split(line):
+            dates = list(_explicit_dates(clause, reference))
+            named = list(_named_dates(clause, reference))
+            if explicit_on_line:
+                # "Sunday 28.12": the name only confirms the date, unless they disagree
+                weekdays = {d.weekday() for d in explicit_on_line}
+                if any(d not in explicit_on_line and d.weekday() not in weekdays for d, _ in named):
+                    return [], 0.0
+                dates = [(d, 0.95 if f == SHORT_DATE_FACTOR and d.weekday() in named_weekdays else f)
+                         for d, f in dates]
+            else:
+                dates += named
+            if not dates:
+                continue
+
+            location, factor = _pick_location(find_locations(clause))
+            if location is None and len(line_locations) == 1:
+                location, factor = line_location, 0.9
+            elif location is None and len(message_locations) == 1:
+                location, factor = message_location, 0.85
+            if location is None:
+                return [], 0.0
+
+            for day, date_factor in dates:
+                if day is None or date_factor == 0.0 or day.weekday() in (4, 5):
+                    return [], 0.0
+                items.append({"date": day.isoformat(), "location": location.value})
+                confidence = min(confidence, factor * date_factor)
+
+    if not items:
+        return [], 0.0
+    return items, round(confidence, 3)
+
+
+def is_confident(confidence):
+    return LOCAL_PARSER and confidence >= LOCAL_PARSER_MIN_CONFIDENCE
+
+
+def merge(model_schedule, local_results, model_upto):
+    """Combines Gemini's schedule with locally parsed messages.
+
+    local_results holds (message position, items) in message order and
+    model_upto is the position of the last message sent to Gemini. For a date
+    given by both, the later message wins: local messages older than
+    everything Gemini saw are overridden by it, newer ones override it.
+    """
+    older = [item for position, items in local_results if position < model_upto for item in items]
+    newer = [item for position, items in local_results if position > model_upto for item in items]
+    return schedule_model.dedupe(
+        schedule_model.parse_schedule(json.dumps(older))
+        + list(model_schedule)
+        + schedule_model.parse_schedule(json.dumps(newer))
+    )
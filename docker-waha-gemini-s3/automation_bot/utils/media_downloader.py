@@ -0,0 +1,99 @@
+import os
+import glob
+import shutil
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from utils import waha_client
+from utils.metrics import metrics
+
+load_dotenv()
+
+# Local Temp Directory
+TEMP_DIR = "./waha_images"
+# WAHA's ./media volume mounted read-only into the bot; files found there are
+# copied instead of downloaded again.
+WAHA_MEDIA_DIR = os.getenv("WAHA_MEDIA_DIR")
+MEDIA_MAX_WORKERS = int(os.getenv("MEDIA_MAX_WORKERS", "4"))
+CHUNK_SIZE = 64 * 1024
+
+
+def _local_filename(msg_id):
+    # Create a safe filename
+    safe_id = "".join([c for c in msg_id if c.isalnum() or c in ('-', '_')])
+    return f"{TEMP_DIR}/{safe_id}.jpg"
+
+
+def _media_volume_path(url):
+    """Maps a WAHA file URL (.../api/files/<path>) to the mounted media volume."""
+    if not WAHA_MEDIA_DIR:
+        return None
+    path = urlparse(url).path
+    marker = "/api/files/"
+    if marker not in path:
+        return None
+    candidate = os.path.normpath(os.path.join(WAHA_MEDIA_DIR, path.split(marker, 1)[1]))
+    # Never follow a crafted URL outside the media volume
+    if not candidate.startswith(os.path.normpath(WAHA_MEDIA_DIR) + os.sep):
+        return None
+    return candidate if os.path.isfile(candidate) else None
+
+
+def download_image(url, msg_id):
+    """Downloads image to a temp file, reusing copies already on disk."""
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    filename = _local_filename(msg_id)
+
+    if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+        return filename
+
+    # A partial file is never reused: copies and downloads land here first
+    tmp_path = f"{filename}.part"
+    volume_path = _media_volume_path(url)
+    if volume_path:
+        try:
+            metrics.count("media_copy")
+            shutil.copyfile(volume_path, tmp_path)
+            os.replace(tmp_path, filename)
+            return filename
+        except OSError as e:
+            # e.g. WAHA pruned the file or the volume is not mounted: download it instead
+            print(f"Could not copy {volume_path} ({e}), downloading it.")
+
+    try:
+        if "localhost" in url:
+            url = url.replace("localhost", "waha")
+            print(f"🔗 Docker Network Fix: Rewrote URL to {url}")
+        metrics.count("media_download")
+        with waha_client.get_session().get(url, stream=True, timeout=60) as response:
+            if response.status_code != 200:
+                print(f"Failed to download image ({response.status_code}): {url}")
+                return None
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(tmp_path, filename)
+        return filename
+    except Exception as e:
+        print(f"Failed to download image: {e}")
+    return None
+
+
+def download_all(items, max_workers=MEDIA_MAX_WORKERS):
+    """Downloads (url, msg_id) pairs concurrently; returns {msg_id: local path or None}."""
+    if not items:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        paths = list(pool.map(lambda item: download_image(*item), items))
+    print(f"Downloaded {sum(1 for p in paths if p)}/{len(items)} images.")
+    return {msg_id: path for (_, msg_id), path in zip(items, paths)}
+
+
+def cleanup_temp_files(paths=None):
+    """Removes the given downloaded files, or everything in TEMP_DIR when paths is None."""
+    files = glob.glob(f"{TEMP_DIR}/*") if paths is None else paths
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError:
+            pass
@@ -0,0 +1,93 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# One JSON line per run on stdout, e.g.
+#   {"metric": "bot_run", "duration_ms": 812.4, "stages_ms": {"waha_fetch": 41.2, ...}, "calls": {"waha_page": 2, ...}}
+# Set BOT_METRICS=false to turn it off.
+METRICS_ENABLED = os.getenv("BOT_METRICS", "true").lower() == "true"
+# Values that must never reach the logs, whatever prints them
+SECRET_ENV_VARS = ("WAHA_API_KEY", "AWS_SECRET_ACCESS_KEY", "AWS_ACCESS_KEY_ID", "GEMINI_API_KEY")
+_SECRET_PATTERN = re.compile(r'("?(?:private_key|api[_-]?key|secret|token|password)"?\s*[:=]\s*)("[^"]*"|\S+)', re.IGNORECASE)
+
+
+def redact(text):
+    """Masks configured secret values and key=value / "key": "value" secrets in a string."""
+    text = str(text)
+    for name in SECRET_ENV_VARS:
+        value = os.getenv(name)
+        if value and len(value) >= 4:
+            text = text.replace(value, "***")
+    return _SECRET_PATTERN.sub(r'\1"***"', text)
+
+
+class Metrics:
+    """Stage timings and external call counts for one bot run.
+
+    Runs can overlap (a webhook burst while another chat is processed); their
+    numbers are then merged and reported once the last of them ends.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._reset()
+
+    def _reset(self):
+        self.stages = Counter()
+        self.calls = Counter()
+        self.properties = {}
+        self.started = time.monotonic()
+
+    def begin(self):
+        with self._lock:
+            if self._active == 0:
+                self._reset()
+            self._active += 1
+
+    def end(self, **properties):
+        """Closes a run; emits the metrics line when no other run is in flight."""
+        with self._lock:
+            self.properties.update(properties)
+            self._active = max(self._active - 1, 0)
+            if self._active:
+                return
+            line = {
+                "metric": "bot_run",
+                "duration_ms": round((time.monotonic() - self.started) * 1000, 1),
+                "stages_ms": {name: round(ms, 1) for name, ms in sorted(self.stages.items())},
+                "calls": dict(sorted(self.calls.items())),
+                **self.properties,
+            }
+        if METRICS_ENABLED:
+            print(redact(json.dumps(line, ensure_ascii=False)), flush=True)
+        return line
+
+    @contextmanager
+    def stage(self, name):
+        """Times a block; stages entered several times (or in parallel) add up."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = (time.monotonic() - started) * 1000
+            with self._lock:
+                self.stages[name] += elapsed
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.calls[name] += n
+
+    def set(self, **properties):
+        with self._lock:
+            self.properties.update(properties)
+
+
+metrics = Metrics()
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from dotenv import load_dotenv
+from utils import job_queue
+from utils import media_downloader
+from utils import image_preprocess
+from utils import process_messages
+from utils import schedule_model
+from utils import state_store
+from utils.job_queue import Job
+from utils.metrics import metrics, redact
+
+load_dotenv()
+
+# The bot's work as stages of the job queue (utils/job_queue.py):
+#   ingest  (one per chat and run)  new WAHA messages -> one media job per message + one parse job
+#   media   (key: WAHA message id)  download and preprocess the message's image
+#   parse   (key: newest message id of the window)  local parser / Gemini -> schedule
+#   publish (same key as its parse job)  merge the schedule into S3
+# Every stage has its own workers and retry policy, so one chat's Gemini call
+# overlaps another's downloads, and a failure only repeats the failed step.
+
+
+@dataclass
+class StagePolicy:
+    workers: int
+    max_attempts: int
+    backoff: float  # seconds before the first retry, doubled for each further one
+
+
+def _policy(stage, workers, max_attempts, backoff):
+    prefix = f"QUEUE_{stage.upper()}_"
+    return StagePolicy(
+        int(os.getenv(f"{prefix}WORKERS", str(workers))),
+        int(os.getenv(f"{prefix}ATTEMPTS", str(max_attempts))),
+        float(os.getenv(f"{prefix}BACKOFF", str(backoff))),
+    )
+
+
+STAGES = {
+    "ingest": _policy("ingest", 2, 5, 5),
+    "media": _policy("media", media_downloader.MEDIA_MAX_WORKERS, 5, 2),
+    "parse": _policy("parse", 2, 4, 30),
+    "publish": _policy("publish", 2, 8, 5),
+}
+QUEUE_MAX_BACKOFF = float(os.getenv("QUEUE_MAX_BACKOFF", "600"))
+# How long a run waits for retries that are not due yet; later ones are
+# picked up by the next run (or the next webhook).
+QUEUE_MAX_WAIT = float(os.getenv("QUEUE_MAX_WAIT_SECONDS", "60"))
+POLL_SECONDS = 0.2
+# Only what the later stages read is stored, not WAHA's raw message
+MESSAGE_FIELDS = ("id", "timestamp", "from", "body", "hasMedia", "media")
+
+_recovered = False
+_recover_lock = threading.Lock()
+
+
+def ingest(job):
+    """Fetches the chat's new messages and queues them as one window."""
+    chat_id = job.chat_id
+    cursor = state_store.load_cursor(chat_id)
+    # A WAHA outage must fail the job (and be retried), not read as "no new messages"
+    messages = process_messages.get_new_messages(cursor, chat_id, raise_errors=True)
+    metrics.count("messages", len(messages))
+    if not messages:
+        print(f"No new messages for {job.payload.get('name', chat_id)}.")
+        return None
+
+    window = messages[-1].get("id")
+    seq = max(msg.get("timestamp") or 0 for msg in messages)
+    ids = [msg.get("id") for msg in messages]
+    job_queue.enqueue(
+        *[Job("media", msg.get("id"), chat_id, window, seq, {"message": {k: msg[k] for k in MESSAGE_FIELDS if k in msg}})
+          for msg in messages],
+        Job("parse", window, chat_id, window, seq, {"s3_prefix": job.payload["s3_prefix"], "message_ids": ids}),
+    )
+    print(f"Queued {len(messages)} messages of {job.payload.get('name', chat_id)} as window {window}.")
+    # The messages are safe in the queue now; a crash from here on resumes from there
+    state_store.advance_cursor(chat_id, messages, cursor)
+    return None
+
+
+def fetch_media(job):
+    """Downloads and preprocesses the message's image, if it has one."""
+    msg = job.payload["message"]
+    if not (msg.get("hasMedia") and process_messages.is_image(msg.get("media"))):
+        return None
+    with metrics.stage("media_download"):
+        path = media_downloader.download_image(msg["media"]["url"], job.key)
+    if not path:
+        raise RuntimeError(f"Could not download the image of {job.key}")
+    with metrics.stage("image_preprocess"):
+        image = image_preprocess.prepare(path)
+    if not image:
+        media_downloader.cleanup_temp_files([path])
+        return None
+    metrics.count("image_bytes_before", image.bytes_before)
+    metrics.count("image_bytes_after", image.bytes_after)
+    return dict(job.payload, image=asdict(image))
+
+
+def _window(job):
+    """The parse job's messages (oldest first) and {msg_id: PreparedImage}."""
+    media = job_queue.payloads("media", job.payload["message_ids"])
+    ids = [msg_id for msg_id in job.payload["message_ids"] if msg_id in media]
+    messages = [media[msg_id]["message"] for msg_id in ids]
+    images = {
+        msg_id: image_preprocess.PreparedImage(**media[msg_id]["image"])
+        for msg_id in ids if media[msg_id].get("image")
+    }
+    return messages, images
+
+
+def parse(job):
+    """Turns the window into a schedule and queues its publish job."""
+    messages, images = _window(job)
+    # Resent copies are only known once the whole window is downloaded
+    images = image_preprocess.mark_duplicates(images)
+    schedule = process_messages.parse_window(messages, images)
+    if schedule is None:
+        raise RuntimeError("Gemini gave no usable schedule")
+
+    files = [image.path for image in images.values()]
+    if not schedule:
+        print("No schedule info in these messages, nothing to upload.")
+        media_downloader.cleanup_temp_files(files)
+        return dict(job.payload, schedule=[])
+
+    items = [entry.to_dict() for entry in schedule]
+    job_queue.enqueue(Job("publish", job.key, job.chat_id, job.window_key, job.seq,
+                          {"s3_prefix": job.payload["s3_prefix"], "schedule": items, "files": files}))
+    return dict(job.payload, schedule=items)
+
+
+def publish(job):
+    """Merges the window's schedule into S3 and removes its images."""
+    schedule = schedule_model.parse_schedule(json.dumps(job.payload["schedule"]))
+    process_messages.publish_schedule(schedule, job.payload["s3_prefix"])
+    media_downloader.cleanup_temp_files(job.payload["files"])
+    return None
+
+
+HANDLERS = {"ingest": ingest, "media": fetch_media, "parse": parse, "publish": publish}
+
+
+def ready(job):
+    """False while a job still waits for others of its chat."""
+    if job.stage == "ingest":
+        # One fetch per chat at a time, so both never read the same cursor
+        return not job_queue.unfinished(job.chat_id, ["ingest"], statuses=[job_queue.RUNNING])
+    if job.stage == "parse":
+        return not job_queue.unfinished(job.chat_id, ["media"], keys=job.payload["message_ids"])
+    if job.stage == "publish":
+        # Windows of a chat reach S3 in order, so the newer message wins a date
+        return not job_queue.unfinished(job.chat_id, ["parse", "publish"], before_seq=job.seq)
+    return True
+
+
+def discard(job):
+    """Removes the images of a window that was given up on."""
+    if job.stage == "parse":
+        _, images = _window(job)
+        media_downloader.cleanup_temp_files([image.path for image in images.values()])
+    elif job.stage == "publish":
+        media_downloader.cleanup_temp_files(job.payload["files"])
+
+
+def settle(job, future):
+    """Records a finished job: done, back to pending with backoff, or failed."""
+    try:
+        payload = future.result()
+    except Exception as e:
+        error = redact(f"{type(e).__name__}: {e}")
+        policy = STAGES[job.stage]
+        if job.attempts >= policy.max_attempts:
+            print(f"Giving up on {job.stage} job {job.key} after {job.attempts} attempts: {error}")
+            metrics.count("queue_failed")
+            job_queue.fail(job, error)
+            discard(job)
+        else:
+            delay = min(policy.backoff * 2 ** (job.attempts - 1), QUEUE_MAX_BACKOFF)
+            print(f"{job.stage} job {job.key} failed (attempt {job.attempts}/{policy.max_attempts}), "
+                  f"retrying in {delay:g}s: {error}")
+            metrics.count("queue_retry")
+            job_queue.retry(job, error, delay)
+        return
+    job_queue.complete(job, payload)
+
+
+def dispatch(pools, in_flight):
+    """Claims the due, ready jobs each stage has free workers for."""
+    for stage, policy in STAGES.items():
+        free = policy.workers - sum(1 for job in in_flight.values() if job.stage == stage)
+        if free <= 0:
+            continue
+        # Look past a few blocked jobs (e.g. a window still downloading)
+        for job in job_queue.due(stage, free + 20):
+            if free == 0:
+                break
+            if ready(job) and job_queue.claim(job):
+                in_flight[pools[stage].submit(HANDLERS[stage], job)] = job
+                metrics.count(f"queue_{stage}")
+                free -= 1
+
+
+def run(chats):
+    """Queues an ingest job per chat and works the queue until it is drained.
+
+    Jobs left over by an earlier (crashed or interrupted) run are resumed.
+    Retries due later than QUEUE_MAX_WAIT seconds are left for the next run.
+    """
+    global _recovered
+    with _recover_lock:
+        if not _recovered:
+            resumed = job_queue.recover()
+            if resumed:
+                print(f"Resuming {resumed} jobs interrupted by the last run.")
+            job_queue.prune()
+            _recovered = True
+
+    started = int(time.time() * 1000)
+    for tenant in chats:
+        # A pending ingest of this chat will fetch everything new anyway
+        if not job_queue.unfinished(tenant["chat_id"], ["ingest"], statuses=[job_queue.PENDING]):
+            job_queue.enqueue(Job("ingest", f"{tenant['chat_id']}@{started}", tenant["chat_id"],
+                                  payload={"name": tenant["name"], "s3_prefix": tenant["s3_prefix"]}))
+
+    pools = {stage: ThreadPoolExecutor(max_workers=policy.workers) for stage, policy in STAGES.items()}
+    in_flight = {}
+    idle_since = None
+    try:
+        while True:
+            dispatch(pools, in_flight)
+            if in_flight:
+                idle_since = None
+                finished, _ = wait(list(in_flight), timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    settle(in_flight.pop(future), future)
+                continue
+
+            upcoming = job_queue.next_attempt()
+            if upcoming is None:
+                break
+            idle_since = idle_since or time.monotonic()
+            delay = max(upcoming - time.time(), POLL_SECONDS)
+            if time.monotonic() - idle_since + delay > QUEUE_MAX_WAIT:
+                print(f"Leaving queued jobs for the next run: {job_queue.counts()}")
+                break
+            time.sleep(delay)
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True)
@@ -1,21 +1,30 @@
 
 import os
-import requests
 import boto3
-import subprocess
-import json
-import glob
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from utils import state_store
+from utils import gemini_cache
+from utils import gemini_backends
+from utils import waha_client
+from utils import media_downloader
+from utils import image_preprocess
+from utils import prompt_builder
+from utils import local_parser
+from utils import schedule_model
+from utils import s3_schedule_store
+from utils import tenants
+from utils.metrics import metrics
 
 # --- LOAD SECRETS ---
 load_dotenv()
 
 # WAHA Config
-WAHA_BASE_URL = os.getenv("WAHA_BASE_URL", "http://waha:3000")
+WAHA_BASE_URL = waha_client.WAHA_BASE_URL
 SESSION_NAME = os.getenv("WAHA_SESSION", "default")
 CHAT_ID = os.getenv("WAHA_CHAT_ID")
-WAHA_API_KEY = os.getenv("WAHA_API_KEY")
+WAHA_API_KEY = waha_client.WAHA_API_KEY
 
 # AWS Config
 AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
@@ -23,14 +32,12 @@ AWS_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
 
-# Gemini Config
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+PAGE_SIZE = 100
+LOOKBACK_HOURS = 24  # How far back the first run (no cursor yet) looks
+# Run fetch -> media -> parse -> publish as stages of the durable job queue
+# (utils/pipeline.py) instead of in one pass per chat
+BOT_QUEUE = os.getenv("BOT_QUEUE", "false").lower() == "true"
 
-# Local Temp Directory
-TEMP_DIR = "./waha_images"
-S3_FILE_NAME = f"whatsapp_summary_{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.json"
-
-headers = ""
 # --- PROMPT INSTRUCTION ---
 GEMINI_PROMPT = """
 ### PERSONA
@@ -78,181 +85,276 @@ Return ONLY a raw, parseable JSON list. No markdown, no conversation.
 """ 
 # --- HELPER FUNCTIONS ---
 
-def run_gemini_cli(prompt):
-    """Executes the gemini CLI command using subprocess."""
-    print("Running Gemini CLI...")
-    
-    env = os.environ.copy()
-    if GEMINI_API_KEY:
-        env["GOOGLE_API_KEY"] = GEMINI_API_KEY
-
-    command = [
-        "gemini", 
-        "-p", prompt, 
-        "-m", "pro", 
-        "--output-format", "json"
-    ]
-    
-    try:
-        result = subprocess.run(command, capture_output=True, text=True, env=env)
-        
-        if result.returncode == 0:
-            try:
-                return json.loads(result.stdout)
-            except json.JSONDecodeError:
-                print(f"JSON Error. Raw Output: {result.stdout}")
-                return None
-        else:
-            print(f"CLI Error: {result.stderr}")
-            return None
-    except FileNotFoundError:
-        print("Error: 'gemini' command not found. Ensure CLI is installed.")
-        return None
+def get_messages(since_timestamp, chat_id=None, raise_errors=False):
+    """Fetch messages from WAHA newer than (or at) since_timestamp, paging through all of them.
 
-def get_messages():
-    """Fetch messages from WAHA."""
-    if not WAHA_API_KEY or not CHAT_ID:
+    Errors are printed and read as "no messages", unless raise_errors is set
+    (the job queue's ingest stage, which retries the fetch instead).
+    """
+    chat_id = chat_id or CHAT_ID
+    if not WAHA_API_KEY or not chat_id:
+        if raise_errors:
+            raise RuntimeError("Missing WAHA_API_KEY or CHAT_ID in .env file.")
         print("Error: Missing WAHA_API_KEY or CHAT_ID in .env file.")
         return []
 
-    url = f"{WAHA_BASE_URL}/api/{SESSION_NAME}/chats/{CHAT_ID}/messages"
-    params = {"limit": 100} 
-    global headers
-    headers = {"X-Api-Key": WAHA_API_KEY, "accept": "application/json"}
-    
-    
+    url = f"{WAHA_BASE_URL}/api/{SESSION_NAME}/chats/{chat_id}/messages"
+    session = waha_client.get_session()
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        return response.json()
+        with metrics.stage("waha_fetch"):
+            return _get_pages(session, url, since_timestamp)
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error fetching WAHA messages: {e}")
         return []
 
-def download_image(url, msg_id):
-    """Downloads image to a temp file."""
-    if not os.path.exists(TEMP_DIR):
-        os.makedirs(TEMP_DIR)
-        
+def _get_pages(session, url, since_timestamp):
+    """Pages through the chat until WAHA returns a short page."""
+    messages = []
+    offset = 0
+    while True:
+        params = {
+            "limit": PAGE_SIZE,
+            "offset": offset,
+            "filter.timestamp.gte": since_timestamp
+        }
+        metrics.count("waha_page")
+        response = session.get(url, params=params, timeout=30)
+        response.raise_for_status()
+        page = response.json()
+        messages.extend(page)
+        if len(page) < PAGE_SIZE:
+            return messages
+        offset += PAGE_SIZE
+
+def get_new_messages(cursor, chat_id=None, raise_errors=False):
+    """Returns messages not yet processed, oldest first."""
+    if cursor:
+        since = cursor["last_timestamp"]
+    else:
+        since = int((datetime.now() - timedelta(hours=LOOKBACK_HOURS)).timestamp())
+    print(f"Fetching messages for {chat_id or CHAT_ID} newer than: {datetime.fromtimestamp(since)}")
+
+    # WAHA's filter is inclusive; drop what the cursor says we've already handled
+    messages = [m for m in get_messages(since, chat_id, raise_errors) if (m.get('timestamp') or 0) >= since and state_store.is_new(m, cursor)]
+    return sorted(messages, key=lambda m: m.get('timestamp') or 0)
+
+def is_image(media_info):
+    """True for WAHA media entries that are downloadable images."""
+    if not media_info:
+        return False
+    mime_type = media_info.get('mimetype')
+    return bool(media_info.get('url') and mime_type and mime_type.startswith('image'))
+
+# --- MAIN LOGIC ---
+
+def process_messages(chats=None):
+    """Processes the given tenants (default: every configured chat), a few at a time.
+
+    Emits one metrics line for the run.
+    """
+    chats = chats or tenants.load_tenants()
+    metrics.begin()
     try:
-        if "localhost" in url:
-            url = url.replace("localhost", "waha")
-            print(f"🔗 Docker Network Fix: Rewrote URL to {url}")
-        response = requests.get(url, headers=headers)
-        print(response.status_code)
-        if response.status_code == 200:
-            # Create a safe filename 
-            print("Creating a image")
-            safe_id = "".join([c for c in msg_id if c.isalnum() or c in ('-','_')])
-            filename = f"{TEMP_DIR}/{safe_id}.jpg"
-            with open(filename, 'wb') as f:
-                f.write(response.content)
-                print("Downloaded the image")
-            return filename
+        if BOT_QUEUE:
+            from utils import pipeline  # imports this module, so not at the top
+            pipeline.run(chats)
+        elif len(chats) == 1:
+            process_tenant(chats[0])
+        else:
+            with ThreadPoolExecutor(max_workers=tenants.TENANTS_MAX_WORKERS) as pool:
+                list(pool.map(process_tenant, chats))
+    finally:
+        metrics.end(chats=len(chats))
+
+def process_tenant(tenant):
+    try:
+        process_chat(tenant["chat_id"], tenant["s3_prefix"])
     except Exception as e:
-        print(f"Failed to download image: {e}")
-    return None
+        # One broken chat must not stop the others
+        print(f"Processing {tenant['name']} failed: {e}")
+
+def parse_with_gemini(entries, cache_parts):
+    """Sends entries to Gemini (or answers from the cache) and validates the reply.
+
+    Returns the schedule entries, or None when the call failed or the output
+    was rejected; the messages are then retried on the next run.
+    """
+    # --- GEMINI (skipped when this exact content was already parsed) ---
+    cache_key = gemini_cache.make_key(GEMINI_PROMPT, cache_parts)
+    cli_response = gemini_cache.get(cache_key)
+    from_cache = bool(cli_response)
+    if from_cache:
+        metrics.count("gemini_cache_hit")
+        print(f"Gemini cache hit for {len(entries)} messages ({gemini_cache.get_stats()}).")
+    else:
+        backend = gemini_backends.get_backend()
+        print(f"Sending {len(entries)} messages to Gemini ({backend.name} backend)...")
+        metrics.count("gemini_call")
+        with metrics.stage("gemini"):
+            cli_response = prompt_builder.parse_in_chunks(backend, GEMINI_PROMPT, entries)
+
+    if not cli_response:
+        print("Failed to get valid response from Gemini.")
+        return None
 
-def cleanup_temp_files():
-    files = glob.glob(f"{TEMP_DIR}/*")
-    for f in files:
-        try:
-            os.remove(f)
-        except OSError:
-            pass
+    # Check for 'response' or 'text'
+    summary_text = cli_response.get("response") or cli_response.get("text")
+    if not summary_text:
+        print("Gemini response did not contain 'text' or 'response'.")
+        print("Full Response Keys:", list(cli_response.keys()))
+        return None
 
-# --- MAIN LOGIC ---
+    print("-" * 20)
+    print("Gemini Output:", summary_text)
+    print("-" * 20)
+
+    # --- VALIDATION (garbage never reaches S3 or the Lambda) ---
+    try:
+        schedule = schedule_model.parse_schedule(
+            summary_text, entries[0]["msg_id"] if len(entries) == 1 else None
+        )
+    except schedule_model.ScheduleValidationError as e:
+        print(f"Rejected Gemini output: {e}")
+        return None
+
+    if not from_cache:
+        gemini_cache.put(cache_key, cli_response)
+    return schedule
 
-def process_messages():
-    messages = get_messages()
-    if not messages:
-        print("No messages found or API failed.")
-        return
 
-    cutoff_time = datetime.now() - timedelta(hours=24)
-    print(f"Filtering messages newer than: {cutoff_time}")
+def parse_window(messages, images):
+    """Turns a window of messages (oldest first) into schedule entries.
 
-    # Initialize prompt with the strict instruction set
-    prompt_parts = [GEMINI_PROMPT, "\n--- USER INPUT START ---"]
-    message_count = 0
+    `images` maps message ids to their PreparedImage. Plain-text schedules are
+    parsed locally, the rest goes to Gemini. Returns the entries (empty when
+    there is nothing to upload), or None when Gemini failed and the window
+    has to be retried.
+    """
+    entries = []
+    cache_parts = []
+    skipped = 0
+    local_results = []  # (message position, items) parsed without Gemini
+    model_upto = -1  # position of the last message sent to Gemini
 
-    for msg in messages:
+    for position, msg in enumerate(messages):
         ts = msg.get('timestamp')
         msg_time = datetime.fromtimestamp(ts)
 
-        if msg_time < cutoff_time:
-            continue 
-
-        message_count += 1
         sender = msg.get('from')
         # Correctly get ID as string
         msg_id = msg.get('id', 'unknown')
         text_body = msg.get('body', '')
         
         # Handle Images
-        image_tag = ""
-        if msg.get('hasMedia'):
-            media_info = msg.get('media')
-            media_url = media_info.get('url')
-            mime_type = media_info.get('mimetype')
-
-            if media_url and mime_type and mime_type.startswith('image'):
-                local_path = download_image(media_url, msg_id)
-                if local_path:
-                    # CLI syntax for local file inclusion
-                    image_tag = f" [Attached Image: @{local_path}]"
-
-        if text_body or image_tag:
-            line = f"[{msg_time.strftime('%Y-%m-%d %H:%M')}] {sender}: {text_body}{image_tag}"
-            prompt_parts.append(line)
-
-    if message_count == 0:
+        local_path = None
+        mime_type = None
+        image = images.get(msg_id)
+        if image and not image.duplicate_of:
+            mime_type = image.mime_type
+            local_path = image.path
+
+        if not prompt_builder.is_relevant(text_body, bool(local_path)):
+            skipped += 1
+            continue
+        if text_body and not local_path:
+            items, confidence = local_parser.parse(text_body, msg_time.date())
+            if local_parser.is_confident(confidence):
+                local_results.append((position, [dict(item, source=msg_id) for item in items]))
+                continue
+        if local_path:
+            cache_parts.append(f"image:{image.sha256}")
+
+        if text_body or local_path:
+            if text_body:
+                cache_parts.append(f"text:{text_body}")
+            entries.append({
+                "msg_id": msg_id,
+                "line": f"[{msg_time.strftime('%Y-%m-%d %H:%M')}] {sender}: {text_body}",
+                "image_path": local_path,
+                "mime_type": mime_type
+            })
+            model_upto = position
+
+    if skipped:
+        print(f"Left out {skipped} messages without dates, images or schedule keywords.")
+        metrics.count("messages_filtered", skipped)
+    if local_results:
+        print(f"Parsed {len(local_results)} text messages locally, {len(entries)} left for Gemini.")
+        metrics.count("local_parse", len(local_results))
+
+    if not entries and not local_results:
+        print("No new messages with schedule content, skipping Gemini.")
+        return []
+
+    schedule = []
+    if entries:
+        schedule = parse_with_gemini(entries, cache_parts)
+        if schedule is None:
+            return None
+    if local_results:
+        schedule = local_parser.merge(schedule, local_results, model_upto)
+    return schedule
+
+
+def publish_schedule(schedule, s3_prefix=""):
+    """Merges schedule entries into the canonical S3 schedule; raises on S3 errors."""
+    print(f"Merging {len(schedule)} dates into S3 Bucket: {AWS_BUCKET_NAME}/{s3_prefix}...")
+    s3_client = boto3.client(
+        's3', 
+        region_name=AWS_REGION,
+        aws_access_key_id=AWS_ACCESS_KEY,
+        aws_secret_access_key=AWS_SECRET_KEY
+    )
+
+    with metrics.stage("s3_publish"):
+        s3_schedule_store.publish(s3_client, AWS_BUCKET_NAME, schedule, s3_prefix)
+    print("Upload Successful.")
+
+
+def process_chat(chat_id, s3_prefix=""):
+    cursor = state_store.load_cursor(chat_id)
+    messages = get_new_messages(cursor, chat_id)
+    metrics.count("messages", len(messages))
+    if not messages:
         print("No new messages to process.")
-        cleanup_temp_files()
         return
 
-    prompt_parts.append("--- USER INPUT END ---")
-    full_prompt = "\n".join(prompt_parts)
+    # Fetch every image in the window concurrently before building the prompt
+    with metrics.stage("media_download"):
+        image_paths = media_downloader.download_all([
+            (msg['media']['url'], msg.get('id', 'unknown'))
+            for msg in messages
+            if msg.get('hasMedia') and is_image(msg.get('media'))
+        ])
+    # Shrink what Gemini has to read and drop resent copies of the same image
+    with metrics.stage("image_preprocess"):
+        images = image_preprocess.prepare_all(image_paths)
+    metrics.count("image_bytes_before", sum(i.bytes_before for i in images.values()))
+    metrics.count("image_bytes_after", sum(i.bytes_after for i in images.values() if not i.duplicate_of))
+    temp_files = [p for p in image_paths.values() if p] + [i.path for i in images.values()]
+
+    schedule = parse_window(messages, images)
+    if schedule is None:
+        media_downloader.cleanup_temp_files(temp_files)
+        return
 
-    # --- GEMINI CLI ---
-    print(f"Sending {message_count} messages to Gemini...")
-    cli_response = run_gemini_cli(full_prompt)
+    if not schedule:
+        print("No schedule info in these messages, nothing to upload.")
+        state_store.advance_cursor(chat_id, messages, cursor)
+        media_downloader.cleanup_temp_files(temp_files)
+        return
 
-    if cli_response:
-        # Check for 'response' or 'text'
-        summary_text = cli_response.get("response") or cli_response.get("text")
-        
-        if summary_text:
-            print("-" * 20)
-            print("Gemini Output:", summary_text)
-            print("-" * 20)
-
-            # --- AWS S3 UPLOAD ---
-            print(f"Uploading to S3 Bucket: {AWS_BUCKET_NAME}...")
-            try:
-                s3_client = boto3.client(
-                    's3', 
-                    region_name=AWS_REGION,
-                    aws_access_key_id=AWS_ACCESS_KEY,
-                    aws_secret_access_key=AWS_SECRET_KEY
-                )
-                
-                s3_client.put_object(
-                    Bucket=AWS_BUCKET_NAME, 
-                    Key=S3_FILE_NAME, 
-                    Body=summary_text,
-                    ContentType='application/json' # Since output is JSON
-                )
-                print("Upload Successful.")
-            except Exception as e:
-                print(f"S3 Error: {e}")
-        else:
-            print("Gemini response did not contain 'text' or 'response'.")
-            print("Full Response Keys:", list(cli_response.keys()))
-    else:
-        print("Failed to get valid response from Gemini.")
+    # --- AWS S3 UPLOAD (merged into the canonical schedule) ---
+    try:
+        publish_schedule(schedule, s3_prefix)
+        # Only move the cursor once the result is safely stored
+        state_store.advance_cursor(chat_id, messages, cursor)
+    except Exception as e:
+        print(f"S3 Error: {e}")
 
-    cleanup_temp_files()
+    media_downloader.cleanup_temp_files(temp_files)
 
 if __name__ == "__main__":
     process_messages()
@@ -0,0 +1,102 @@
+import os
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from utils import gemini_backends
+from utils import schedule_model
+
+load_dotenv()
+
+# Bounds for one Gemini call. The CLI receives the whole prompt as a single
+# argv element, so text is capped well below the OS argument limit.
+PROMPT_MAX_CHARS = int(os.getenv("PROMPT_MAX_CHARS", "12000"))
+PROMPT_MAX_IMAGES = int(os.getenv("PROMPT_MAX_IMAGES", "4"))
+PROMPT_MAX_WORKERS = int(os.getenv("PROMPT_MAX_WORKERS", "3"))
+# Drop text-only messages that carry no date and no schedule keyword
+PROMPT_PREFILTER = os.getenv("PROMPT_PREFILTER", "true").lower() == "true"
+IMAGE_TOKENS = 258  # what Gemini bills for a (tiled) image, for the size estimate
+
+KEYWORDS = {
+    "home", "afeka", "college", "campus", "zoom", "online", "lab", "class", "room", "schedule",
+    "lecture", "tomorrow", "today", "sunday", "monday", "tuesday", "wednesday", "thursday",
+    "בית",  # bayit (home)
+    "אפקה",  # Afeka
+    "מקוון",  # online
+    "זום",  # Zoom
+    "מערכת",  # timetable
+    "לוח",  # schedule board
+    "מחר",  # tomorrow
+    "היום",  # today
+    "ראשון", "שני", "שלישי", "רביעי", "חמישי",  # Sunday-Thursday
+}
+KEYWORDS.update(k.strip().lower() for k in os.getenv("PROMPT_KEYWORDS", "").split(",") if k.strip())
+DATE_PATTERN = re.compile(r"\d{1,2}[./-]\d{1,2}(?:[./-]\d{2,4})?|\d{4}-\d{2}-\d{2}")
+
+
+def is_relevant(text, has_image):
+    """True for messages that may carry schedule info: images, dates or schedule keywords."""
+    if has_image or not PROMPT_PREFILTER:
+        return True
+    text = (text or "").lower()
+    return bool(DATE_PATTERN.search(text)) or any(keyword in text for keyword in KEYWORDS)
+
+
+def estimate_tokens(prompt, entries):
+    """Rough size of a call: ~4 characters per text token plus a flat cost per image."""
+    chars = len(prompt) + sum(len(entry["line"]) + 1 for entry in entries)
+    return chars // 4 + IMAGE_TOKENS * sum(1 for entry in entries if entry.get("image_path"))
+
+
+def chunk(entries, max_chars=PROMPT_MAX_CHARS, max_images=PROMPT_MAX_IMAGES):
+    """Splits entries, in order, into chunks of at most max_chars of text and max_images images."""
+    chunks = []
+    current, chars, images = [], 0, 0
+    for entry in entries:
+        size = len(entry["line"]) + 1
+        has_image = bool(entry.get("image_path"))
+        if current and (chars + size > max_chars or images + has_image > max_images):
+            chunks.append(current)
+            current, chars, images = [], 0, 0
+        current.append(entry)
+        chars += size
+        images += has_image
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def parse_in_chunks(backend, prompt, entries):
+    """Runs backend.parse per chunk in parallel and merges the date lists.
+
+    Chunks are merged in message order, so for a date given in several chunks
+    the latest message wins, as it would in a single call. Returns the
+    backend-style response, or None if any chunk failed (the whole window is
+    then retried on the next run).
+    """
+    chunks = chunk(entries)
+    if len(chunks) == 1:
+        return backend.parse(prompt, entries)
+
+    print(f"Splitting {len(entries)} messages (~{estimate_tokens(prompt, entries)} tokens) into {len(chunks)} Gemini calls.")
+    with ThreadPoolExecutor(max_workers=PROMPT_MAX_WORKERS) as pool:
+        responses = list(pool.map(lambda part: backend.parse(prompt, part), chunks))
+    if any(not response for response in responses):
+        return None
+
+    replies = [response.get("response") or response.get("text") or "" for response in responses]
+    results = [gemini_backends.extract_schedule_list(reply) for reply in replies]
+    for reply, result in zip(replies, results):
+        if result is None and schedule_model.NO_INFO_SENTINEL.lower() not in reply.lower():
+            # Garbage from one chunk: hand it on so validation rejects the whole window
+            return {"response": reply}
+    # Keep the source tag of chunks holding a single message
+    for part, result in zip(chunks, results):
+        for item in result or []:
+            if isinstance(item, dict) and len(part) == 1:
+                item.setdefault("source", part[0].get("msg_id"))
+    if all(result is None for result in results):
+        # Nothing parseable anywhere (e.g. the "No info" sentinel): pass the first reply through
+        return {"response": replies[0]}
+    merged = gemini_backends.merge_by_date(result for result in results if result is not None)
+    return {"response": json.dumps(merged, ensure_ascii=False)}
@@ -0,0 +1,103 @@
+import os
+import json
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+from utils import schedule_model
+from utils.metrics import metrics
+
+load_dotenv()
+
+# One canonical document holds the whole schedule; the updater Lambda is
+# triggered by writes to it. Optional per-month shards are small read copies.
+S3_SCHEDULE_KEY = os.getenv("S3_SCHEDULE_KEY", "schedule/schedule.json")
+S3_SHARD_PREFIX = os.getenv("S3_SHARD_PREFIX", "schedule/months/")
+S3_WRITE_SHARDS = os.getenv("S3_WRITE_SHARDS", "false").lower() == "true"
+MAX_ATTEMPTS = 5
+CONFLICT_CODES = {"PreconditionFailed", "ConditionalRequestConflict"}
+
+
+def load(s3_client, bucket, key):
+    """Returns ({date: entry dict}, etag); etag is None when the object does not exist."""
+    metrics.count("s3_get")
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return {}, None
+        raise
+    entries = json.loads(response["Body"].read() or b"[]")
+    return {entry["date"]: entry for entry in entries}, response["ETag"]
+
+
+def merge(existing, schedule):
+    """Merges new entries into {date: entry}; returns (merged, changed dates).
+
+    An entry that only differs in its source message id is not a change.
+    """
+    merged = dict(existing)
+    changed = []
+    for entry in schedule:
+        data = entry.to_dict()
+        current = merged.get(data["date"])
+        if current and current.get("location") == data["location"]:
+            continue
+        merged[data["date"]] = data
+        changed.append(data["date"])
+    return merged, changed
+
+
+def _write_merged(s3_client, bucket, key, schedule):
+    """Read-merge-write with If-Match, retried on concurrent updates. Returns changed dates."""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        existing, etag = load(s3_client, bucket, key)
+        merged, changed = merge(existing, schedule)
+        if not changed:
+            return []
+
+        body = schedule_model.to_canonical_json(
+            [schedule_model.ScheduleEntry.from_dict(entry) for entry in merged.values()]
+        )
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        metrics.count("s3_put")
+        try:
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=body.encode("utf-8"),
+                ContentType="application/json",
+                # Lets the updater reconcile only the dates this write touched
+                Metadata={
+                    "schema": schedule_model.SCHEMA_VERSION,
+                    "changed-from": min(changed),
+                    "changed-to": max(changed),
+                },
+                **condition
+            )
+            return changed
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in CONFLICT_CODES:
+                raise
+            print(f"{key} changed while merging (attempt {attempt}), retrying...")
+    raise RuntimeError(f"Gave up merging into {key} after {MAX_ATTEMPTS} conflicting writes.")
+
+
+def publish(s3_client, bucket, schedule, prefix=""):
+    """Merges the schedule into the canonical document (and shards) under a tenant prefix.
+
+    Returns the changed dates.
+    """
+    key = f"{prefix}{S3_SCHEDULE_KEY}"
+    changed = _write_merged(s3_client, bucket, key, schedule)
+    if not changed:
+        print("Schedule unchanged, skipping S3 write.")
+        return []
+    print(f"Updated {key}: {len(changed)} dates changed.")
+
+    if S3_WRITE_SHARDS:
+        months = {}
+        for entry in schedule:
+            if entry.date.isoformat() in changed:
+                months.setdefault(entry.date.strftime("%Y-%m"), []).append(entry)
+        for month, entries in sorted(months.items()):
+            _write_merged(s3_client, bucket, f"{prefix}{S3_SHARD_PREFIX}{month}.json", entries)
+    return changed
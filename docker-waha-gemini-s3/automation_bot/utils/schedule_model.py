@@ -0,0 +1,103 @@
+import json
+from dataclasses import dataclass
+from datetime import date, datetime
+from enum import Enum
+from typing import List, Optional
+
+# Tag stored as S3 object metadata so the updater can take its fast parse path
+SCHEMA_VERSION = "schedule-v1"
+NO_INFO_SENTINEL = "No info for setting"
+
+
+class Location(str, Enum):
+    HOME = "Home"
+    AFEKA = "Afeka"
+
+
+class ScheduleValidationError(ValueError):
+    """Gemini output that is neither a schedule nor the "no info" sentinel."""
+
+
+@dataclass(frozen=True)
+class ScheduleEntry:
+    date: date
+    location: Location
+    source_message_id: Optional[str] = None
+
+    def to_dict(self):
+        data = {"date": self.date.isoformat(), "location": self.location.value}
+        if self.source_message_id:
+            data["source"] = self.source_message_id
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """The inverse of to_dict, for entries read back from the stored document."""
+        return cls(date.fromisoformat(data["date"]), Location(data["location"]), data.get("source"))
+
+
+def _strip_fences(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`").strip()
+        if text.startswith("json"):
+            text = text[4:].strip()
+    return text
+
+
+def _parse_location(value):
+    for location in Location:
+        if isinstance(value, str) and value.strip().lower() == location.value.lower():
+            return location
+    return None
+
+
+def parse_schedule(text, source_message_id=None) -> List[ScheduleEntry]:
+    """Validates raw Gemini output into deduplicated entries, sorted by date.
+
+    Returns an empty list for the "no info" sentinel and raises
+    ScheduleValidationError for anything else that is not a schedule.
+    """
+    text = _strip_fences(text or "")
+    if NO_INFO_SENTINEL.lower() in text.lower():
+        return []
+
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ScheduleValidationError(f"Output is not JSON: {e}")
+    if not isinstance(data, list):
+        raise ScheduleValidationError(f"Expected a JSON list, got {type(data).__name__}.")
+
+    entries = []
+    for item in data:
+        if not isinstance(item, dict):
+            print(f"Skipping non-object schedule item: {item!r}")
+            continue
+        try:
+            entry_date = datetime.strptime(str(item.get("date")), "%Y-%m-%d").date()
+        except ValueError:
+            print(f"Skipping item with invalid date: {item!r}")
+            continue
+        location = _parse_location(item.get("location"))
+        if location is None:
+            print(f"Skipping item with unknown location: {item!r}")
+            continue
+        entries.append(ScheduleEntry(entry_date, location, item.get("source") or source_message_id))
+
+    if data and not entries:
+        raise ScheduleValidationError("No valid schedule entries in output.")
+    return dedupe(entries)
+
+
+def dedupe(entries: List[ScheduleEntry]) -> List[ScheduleEntry]:
+    """One entry per date (the last one wins), sorted by date."""
+    by_date = {}
+    for entry in entries:
+        by_date[entry.date] = entry
+    return [by_date[d] for d in sorted(by_date)]
+
+
+def to_canonical_json(entries: List[ScheduleEntry]) -> str:
+    """Minified, date-sorted JSON list; identical schedules serialize identically."""
+    return json.dumps([e.to_dict() for e in dedupe(entries)], ensure_ascii=False, separators=(",", ":"))
@@ -0,0 +1,62 @@
+import os
+import json
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Lives inside the bot's mounted volume so it survives container restarts.
+STATE_FILE = os.getenv("BOT_STATE_FILE", "./state/cursors.json")
+# Chats are processed in parallel; they share one state file
+_lock = threading.Lock()
+
+
+def _load_state():
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        print(f"State file {STATE_FILE} is corrupt, starting from scratch.")
+        return {}
+
+
+def load_cursor(chat_id):
+    """Returns the last processed message cursor for a chat, or None."""
+    return _load_state().get(chat_id)
+
+
+def save_cursor(chat_id, last_timestamp, last_ids):
+    """Records the newest processed timestamp and the message ids seen at it."""
+    with _lock:
+        state = _load_state()
+        state[chat_id] = {"last_timestamp": last_timestamp, "last_ids": sorted(last_ids)}
+
+        os.makedirs(os.path.dirname(STATE_FILE) or ".", exist_ok=True)
+        tmp_path = f"{STATE_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        # Atomic swap so a crash mid-write never leaves a half-written cursor
+        os.replace(tmp_path, STATE_FILE)
+
+
+def is_new(msg, cursor):
+    """True if the message is newer than the cursor."""
+    if not cursor:
+        return True
+    ts = msg.get("timestamp") or 0
+    if ts != cursor["last_timestamp"]:
+        return ts > cursor["last_timestamp"]
+    return msg.get("id") not in cursor["last_ids"]
+
+
+def advance_cursor(chat_id, messages, cursor=None):
+    """Moves the cursor past the given (already processed) messages."""
+    if not messages:
+        return
+    newest = max(msg.get("timestamp") or 0 for msg in messages)
+    ids = {msg.get("id") for msg in messages if (msg.get("timestamp") or 0) == newest}
+    if cursor and cursor["last_timestamp"] == newest:
+        ids.update(cursor["last_ids"])
+    save_cursor(chat_id, newest, ids)
@@ -0,0 +1,47 @@
+import os
+import json
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Inline JSON or a path to a JSON file, listing one entry per WhatsApp chat:
+#   [{"name": "alice", "chat_id": "123@g.us", "s3_prefix": "tenants/alice/"}, ...]
+# Without it the bot serves the single WAHA_CHAT_ID at the bucket root.
+TENANTS_CONFIG = os.getenv("TENANTS_CONFIG")
+TENANTS_MAX_WORKERS = int(os.getenv("TENANTS_MAX_WORKERS", "4"))
+
+
+def _default_tenant():
+    return {"name": "default", "chat_id": os.getenv("WAHA_CHAT_ID"), "s3_prefix": ""}
+
+
+def load_tenants():
+    """Returns the configured tenants, each a dict with name, chat_id and s3_prefix."""
+    if not TENANTS_CONFIG:
+        return [_default_tenant()]
+    try:
+        if TENANTS_CONFIG.lstrip().startswith("["):
+            entries = json.loads(TENANTS_CONFIG)
+        else:
+            with open(TENANTS_CONFIG, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Could not read TENANTS_CONFIG ({e}), using WAHA_CHAT_ID only.")
+        return [_default_tenant()]
+
+    tenants = []
+    for entry in entries:
+        if not entry.get("chat_id"):
+            print(f"Skipping tenant without a chat_id: {entry}")
+            continue
+        tenants.append({
+            "name": entry.get("name") or entry["chat_id"],
+            "chat_id": entry["chat_id"],
+            "s3_prefix": entry.get("s3_prefix", ""),
+        })
+    return tenants or [_default_tenant()]
+
+
+def by_chat_id(tenants):
+    """Indexes tenants by their WhatsApp chat id."""
+    return {tenant["chat_id"]: tenant for tenant in tenants}
@@ -0,0 +1,25 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WAHA_BASE_URL = os.getenv("WAHA_BASE_URL", "http://waha:3000")
+WAHA_API_KEY = os.getenv("WAHA_API_KEY")
+POOL_SIZE = int(os.getenv("WAHA_POOL_SIZE", "8"))
+
+_session = None
+
+
+def get_session():
+    """Returns the shared, connection-pooled session used for every WAHA call."""
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"X-Api-Key": WAHA_API_KEY or "", "accept": "application/json"})
+        _session = session
+    return _session
@@ -0,0 +1,96 @@
+import os
+import time
+import random
+from dataclasses import dataclass
+from typing import Optional
+import requests
+from dotenv import load_dotenv
+from utils import waha_client
+
+load_dotenv()
+
+SESSION_NAME = os.getenv("WAHA_SESSION", "default")
+READY_TIMEOUT = float(os.getenv("WAHA_READY_TIMEOUT", "300"))
+BASE_DELAY = 0.5
+MAX_DELAY = 10.0
+# Statuses that will not become WORKING without a start request
+STARTABLE_STATUSES = {None, "STOPPED", "FAILED"}
+
+
+@dataclass
+class ReadinessResult:
+    ready: bool
+    status: Optional[str]
+    attempts: int
+    elapsed: float  # Seconds until WORKING (or until giving up)
+
+
+def get_session_status(session_name=SESSION_NAME):
+    """Returns the named session's status, or None if WAHA does not know it."""
+    response = waha_client.get_session().get(
+        f"{waha_client.WAHA_BASE_URL}/api/sessions/{session_name}", timeout=5
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json().get("status")
+
+
+def start_session(session_name=SESSION_NAME):
+    """Asks WAHA to start the named session."""
+    response = waha_client.get_session().post(
+        f"{waha_client.WAHA_BASE_URL}/api/sessions/{session_name}/start", timeout=10
+    )
+    print(f"Start session '{session_name}': {response.status_code}")
+    return response
+
+
+def backoff_delay(attempt, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    """Exponential backoff with jitter: a random delay in [cap/2, cap]."""
+    cap = min(max_delay, base_delay * (2 ** attempt))
+    return random.uniform(cap / 2, cap)
+
+
+def wait_until_ready(session_name=SESSION_NAME, timeout=READY_TIMEOUT, start_if_stopped=True):
+    """Polls WAHA until the session is WORKING or the deadline passes.
+
+    Connection errors (WAHA still booting) count as attempts. A stopped or
+    unknown session is started once.
+    """
+    started_at = time.monotonic()
+    deadline = started_at + timeout
+    attempts = 0
+    status = None
+    start_requested = False
+    last_logged = object()
+
+    while True:
+        attempts += 1
+        try:
+            status = get_session_status(session_name)
+        except (requests.RequestException, ValueError) as e:
+            status = None
+            if last_logged != "error":
+                print(f"WAHA not reachable yet: {e}")
+                last_logged = "error"
+        else:
+            if status != last_logged:
+                print(f"Session '{session_name}' status: {status}")
+                last_logged = status
+            if status == "WORKING":
+                return ReadinessResult(True, status, attempts, time.monotonic() - started_at)
+            if start_if_stopped and not start_requested and status in STARTABLE_STATUSES:
+                try:
+                    start_session(session_name)
+                    start_requested = True
+                except requests.RequestException as e:
+                    print(f"Could not start session: {e}")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return ReadinessResult(False, status, attempts, time.monotonic() - started_at)
+        time.sleep(min(backoff_delay(attempts - 1), remaining))
+
+
+if __name__ == "__main__":
+    print(wait_until_ready())
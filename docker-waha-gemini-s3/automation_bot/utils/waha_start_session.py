@@ -1,17 +1,7 @@
-import os
-from dotenv import load_dotenv
-import requests
-def waha_start_session():
-    load_dotenv()
-
-    WAHA_API_KEY = os.getenv("WAHA_API_KEY")
-    WAHA_BASE_URL = os.getenv("WAHA_BASE_URL")
-
-    headers = {"X-API-KEY": WAHA_API_KEY, "accept": "application/json"}
+from utils import waha_readiness
 
-    response = requests.post(f"{WAHA_BASE_URL}/api/sessions/default/start", headers=headers)
-
-    print(response)
+def waha_start_session():
+    waha_readiness.start_session()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+from utils import process_messages
+from utils import tenants
+
+load_dotenv()
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8000"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# A schedule is often several messages (image + follow-up text) sent in a
+# burst; wait for the chat to go quiet before running one Gemini job.
+DEBOUNCE_SECONDS = float(os.getenv("WEBHOOK_DEBOUNCE_SECONDS", "10"))
+MESSAGE_EVENTS = {"message", "message.any"}
+
+
+class Debouncer:
+    """Runs `job` once, `delay` seconds after the last trigger. Runs never overlap."""
+
+    def __init__(self, job, delay):
+        self.job = job
+        self.delay = delay
+        self._timer = None
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+
+    def trigger(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run(self):
+        # A burst arriving mid-run waits here and then runs once more; the
+        # WAHA cursor makes that follow-up run pick up only the new messages.
+        with self._run_lock:
+            try:
+                self.job()
+            except Exception as e:
+                print(f"Webhook job failed: {e}")
+
+
+def chat_of(payload):
+    """The chat a WAHA message belongs to (for our own messages, the recipient)."""
+    if payload.get("fromMe"):
+        return payload.get("to")
+    return payload.get("from")
+
+
+def make_handler(debouncers):
+    """`debouncers` maps each watched chat id to the Debouncer that processes it."""
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self._reply(200 if self.path == "/health" else 404)
+
+        def do_POST(self):
+            if self.path != WEBHOOK_PATH:
+                self._reply(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except (ValueError, json.JSONDecodeError):
+                self._reply(400)
+                return
+
+            # Acknowledge right away; the work happens after the debounce window
+            self._reply(200)
+            if body.get("event") in MESSAGE_EVENTS:
+                debouncer = debouncers.get(chat_of(body.get("payload", {})))
+                if debouncer:
+                    debouncer.trigger()
+
+        def _reply(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            # Keep container logs quiet; one line per webhook is noise
+            pass
+
+    return WebhookHandler
+
+
+def serve():
+    """Listens for WAHA webhooks forever and processes new schedule messages as they arrive."""
+    # Each chat debounces on its own, so a busy group never delays another tenant
+    debouncers = {
+        chat_id: Debouncer(lambda tenant=tenant: process_messages.process_messages([tenant]), DEBOUNCE_SECONDS)
+        for chat_id, tenant in tenants.by_chat_id(tenants.load_tenants()).items()
+    }
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), make_handler(debouncers))
+    print(f"Listening for WAHA webhooks on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,189 @@
+"""Backfill: rebuild a calendar from the schedules already in S3, in one pass.
+
+Lists every object under the given prefixes (by default the bot's old
+`whatsapp_summary_<timestamp>.json` uploads), fetches them concurrently,
+collapses them into one date -> location state where the newest object wins
+a date, and reconciles the calendar with it once, through the same code the
+Lambda uses (rate limiting, retries and batching included). Use it to rebuild
+a calendar after a bug or to onboard a new one, instead of re-triggering the
+Lambda once per object.
+
+    python backfill.py --dry-run
+    python backfill.py --since 2025-01-01 --workers 32
+    python backfill.py --tenant alice --calendar-id new@group.calendar.google.com
+    python backfill.py --prefix whatsapp_summary_ --prefix schedule/schedule.json
+
+Takes the same environment as the Lambda (BUCKET_NAME, CALENDAR_ID,
+SECRET_NAME, TENANTS_CONFIG, CALENDAR_WRITES_PER_SECOND, ...) and the usual
+AWS credentials. With --since/--until, auto-added events in that range that
+no object schedules are deleted; without them the range is the first to the
+last scheduled date.
+"""
+import argparse
+import logging
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+from lambda_function import (
+    BUCKET_NAME, DECISION_INDEX_KEY, failed_ops, get_data_from_s3, get_s3_client, get_secrets,
+    load_tenants, logger, metrics, update_decision_index, update_google_calendar,
+)
+
+SUMMARY_PREFIX = "whatsapp_summary_"
+# The upload time is in the name; LastModified is reset when objects are copied
+SUMMARY_TIMESTAMP = re.compile(r"whatsapp_summary_(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})\.json$")
+PROGRESS_EVERY = 0.1  # print progress after every tenth of the objects
+
+
+def list_objects(bucket: str, prefix: str) -> List[Dict]:
+    """Every .json object under prefix, following list_objects_v2 pagination."""
+    objects = []
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(obj for obj in page.get('Contents', []) if obj['Key'].endswith('.json'))
+    return objects
+
+
+def object_order(obj: Dict) -> Tuple[str, str]:
+    """Sort key putting older schedules first."""
+    match = SUMMARY_TIMESTAMP.search(obj['Key'])
+    written = match.group(1) if match else obj['LastModified'].strftime("%Y-%m-%d-%H-%M-%S")
+    return written, obj['Key']
+
+
+def fetch_all(bucket: str, objects: List[Dict], workers: int) -> Tuple[Dict[str, List[Dict]], List[str]]:
+    """Reads the objects concurrently; returns ({key: schedule}, keys that failed)."""
+    schedules, failed = {}, []
+    sizes = {obj['Key']: obj.get('Size', 0) for obj in objects}
+    read_bytes = 0
+    step = max(1, int(len(objects) * PROGRESS_EVERY))
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(get_data_from_s3, bucket, obj['Key']): obj['Key'] for obj in objects}
+        for done, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            read_bytes += sizes[key]
+            try:
+                data = future.result()
+                schedules[key] = data if isinstance(data, list) else []
+            except Exception as e:
+                logger.warning(f"Skipping {key}: {e}")
+                failed.append(key)
+            if done % step == 0 or done == len(objects):
+                elapsed = time.perf_counter() - started
+                print(f"  fetched {done}/{len(objects)} objects ({read_bytes / 1024:.0f} KiB) "
+                      f"in {elapsed:.1f}s, {done / elapsed if elapsed else 0:.0f} objects/s", flush=True)
+    return schedules, failed
+
+
+def collapse(schedules: Dict[str, List[Dict]], order: List[str], since: str = None, until: str = None) -> List[Dict]:
+    """Latest-wins date -> location state over the schedules, oldest key first."""
+    desired = {}
+    for key in order:
+        for entry in schedules.get(key, []):
+            if not isinstance(entry, dict):
+                continue
+            date_str, location = entry.get('date'), entry.get('location')
+            if not date_str or not location:
+                continue
+            if (since and date_str < since) or (until and date_str > until):
+                continue
+            desired[date_str] = location
+    return [{"date": date_str, "location": desired[date_str]} for date_str in sorted(desired)]
+
+
+def pick_tenant(name: str = None) -> Dict:
+    tenants = load_tenants()
+    if name:
+        for tenant in tenants:
+            if tenant['name'] == name:
+                return tenant
+        raise SystemExit(f"No tenant named {name!r} in TENANTS_CONFIG.")
+    if len(tenants) > 1:
+        raise SystemExit(f"Several tenants configured, pick one with --tenant: {[t['name'] for t in tenants]}")
+    return tenants[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", default=BUCKET_NAME)
+    parser.add_argument("--prefix", action="append",
+                        help=f"key prefix below the tenant's, repeatable (default {SUMMARY_PREFIX})")
+    parser.add_argument("--tenant", help="tenant name from TENANTS_CONFIG (needed when there are several)")
+    parser.add_argument("--calendar-id", help="write to this calendar instead of the tenant's")
+    parser.add_argument("--since", help="first date to reconcile (YYYY-MM-DD)")
+    parser.add_argument("--until", help="last date to reconcile (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent S3 reads")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan without writing")
+    parser.add_argument("--no-index", action="store_true", help="leave the decision index alone")
+    parser.add_argument("--verbose", action="store_true", help="log every S3 read and Calendar operation")
+    args = parser.parse_args()
+    if bool(args.since) != bool(args.until):
+        parser.error("--since and --until go together")
+    date_range = (args.since, args.until) if args.since else None
+
+    logging.basicConfig(format="%(levelname)s %(message)s")
+    logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    metrics.reset()
+
+    tenant = pick_tenant(args.tenant)
+    calendar_id = args.calendar_id or tenant['calendar_id']
+    prefixes = [f"{tenant['s3_prefix']}{prefix}" for prefix in (args.prefix or [SUMMARY_PREFIX])]
+    timings = {}
+
+    started = time.perf_counter()
+    objects = [obj for prefix in prefixes for obj in list_objects(args.bucket, prefix)]
+    objects.sort(key=object_order)
+    timings['list'] = time.perf_counter() - started
+    print(f"Listed {len(objects)} objects under s3://{args.bucket}/{{{','.join(prefixes)}}} in {timings['list']:.1f}s")
+    if not objects:
+        return 0
+
+    started = time.perf_counter()
+    schedules, failed_keys = fetch_all(args.bucket, objects, args.workers)
+    timings['fetch'] = time.perf_counter() - started
+
+    schedule = collapse(schedules, [obj['Key'] for obj in objects], args.since, args.until)
+    entries = sum(len(data) for data in schedules.values())
+    print(f"Collapsed {entries} entries into {len(schedule)} dates"
+          + (f" ({schedule[0]['date']}..{schedule[-1]['date']})" if schedule else ""))
+
+    started = time.perf_counter()
+    google_creds = get_secrets(tenant['google_secret_name']).get('google_service_account_json')
+    if not google_creds:
+        raise SystemExit("google_service_account_json not found in secrets.")
+    plan = update_google_calendar(google_creds, calendar_id, schedule, args.dry_run, date_range)
+    timings['reconcile'] = time.perf_counter() - started
+
+    ops = {}
+    for op in plan:
+        ops[op['op']] = ops.get(op['op'], 0) + 1
+    failed = failed_ops(plan)
+    if args.dry_run:
+        for op in plan:
+            print(f"  [dry-run] {op['op']} {op['date']}: {op['location']}")
+    elif not args.no_index and args.calendar_id is None:
+        scheduled = {entry['date'] for entry in schedule}
+        removed = {op['date'] for op in plan if op['op'] == 'delete'} - scheduled
+        update_decision_index(args.bucket, schedule, removed, f"{tenant['s3_prefix']}{DECISION_INDEX_KEY}")
+
+    total = sum(timings.values())
+    written = len(plan) - len(failed) if not args.dry_run else 0
+    print(f"\n{'Dry run' if args.dry_run else 'Backfill'} of {calendar_id}: {len(plan)} operations {ops}, "
+          f"{len(failed)} failed or deferred")
+    print(f"  list       {timings['list']:7.2f}s")
+    print(f"  fetch      {timings['fetch']:7.2f}s  {len(objects) / timings['fetch'] if timings['fetch'] else 0:7.0f} objects/s"
+          f"  ({len(failed_keys)} unreadable)")
+    print(f"  reconcile  {timings['reconcile']:7.2f}s  {written / timings['reconcile'] if timings['reconcile'] else 0:7.1f} writes/s"
+          f"  (waiting on the rate limiter {metrics.stages.get('CalendarThrottle', 0) / 1000:.2f}s)")
+    print(f"  total      {total:7.2f}s for {len(objects)} objects and {len(schedule)} dates")
+    for op in failed:
+        print(f"  {op['status']}: {op['op']} {op['date']} ({op.get('error')})")
+    return 1 if failed or failed_keys else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
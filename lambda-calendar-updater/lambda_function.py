@@ -1,14 +1,17 @@
 import json
 import logging
 import os
+import random
+import re
+import threading
+import time
 import boto3
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
-
-# Google Auth for Calendar
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from typing import List, Dict, Any, Set, Tuple
 from botocore.exceptions import ClientError
+# Google Auth for Calendar is imported lazily in get_calendar_service: the
+# client libraries dominate cold-start import time.
 
 # --- Configuration ---
 logger = logging.getLogger()
@@ -16,18 +19,299 @@ logger.setLevel(logging.INFO)
 
 SECRET_NAME = os.environ.get("SECRET_NAME", "Secret-for-Set-home-or-afeka-With-Whatsapp-Gemini-Calendar")
 REGION_NAME = os.environ.get("AWS_REGION", "us-east-1")
-CALENDAR_ID = "c8cd5d56e9bb6d244670b112aa68015b79321b3f5725bf8385fce6c4292deaca@group.calendar.google.com" 
-BUCKET_NAME = "docker-volume-nachman"
+CALENDAR_ID = os.environ.get("CALENDAR_ID", "c8cd5d56e9bb6d244670b112aa68015b79321b3f5725bf8385fce6c4292deaca@group.calendar.google.com")
+BUCKET_NAME = os.environ.get("BUCKET_NAME", "docker-volume-nachman")
+# Compact date -> decision map read by the status checker. Kept under its own
+# prefix so writing it does not re-trigger this function.
+DECISION_INDEX_KEY = os.environ.get("DECISION_INDEX_KEY", "decision-index/daily.json")
+TRIGGER_LOCATIONS = {"Afeka"}
+STUDY_PREFIX = "Study: "
+AUTO_DESCRIPTION = 'Auto-added from WhatsApp Schedule Analysis'
+# Private extended property marking events this function owns
+AUTO_TAG_KEY = "autoAdded"
+AUTO_TAG_VALUE = "whatsapp-schedule"
+DRY_RUN = os.environ.get("DRY_RUN", "false").lower() == "true"
+SCHEDULE_SCHEMA = "schedule-v1"  # S3 metadata tag set by the bot on validated uploads
+# Per-month read copies of the canonical schedule; never processed here
+SCHEDULE_SHARD_PREFIX = os.environ.get("SCHEDULE_SHARD_PREFIX", "schedule/months/")
+BATCH_LIMIT = 50  # Calendar API accepts at most 50 calls per batch request
+SECRETS_CACHE_TTL = int(os.environ.get("SECRETS_CACHE_TTL", "900"))
+
+# Calendar quota: every call inside a batch counts against the per-user limit.
+# Writes are paced by a token bucket, rate-limit and transient errors are
+# retried with backoff, and entries that still fail are kept in a retry list
+# (an S3 object per tenant) and replayed on the next invocation.
+CALENDAR_WRITES_PER_SECOND = float(os.environ.get("CALENDAR_WRITES_PER_SECOND", "8"))
+CALENDAR_WRITE_BURST = int(os.environ.get("CALENDAR_WRITE_BURST", "50"))
+CALENDAR_MAX_ATTEMPTS = int(os.environ.get("CALENDAR_MAX_ATTEMPTS", "5"))
+CALENDAR_BACKOFF_BASE = float(os.environ.get("CALENDAR_BACKOFF_BASE", "1"))
+# Total time one invocation may spend backing off before deferring to the retry list
+CALENDAR_RETRY_BUDGET = float(os.environ.get("CALENDAR_RETRY_BUDGET_SECONDS", "60"))
+# Time kept back before the Lambda timeout to record deferred writes and the decision index
+CALENDAR_TIMEOUT_MARGIN = float(os.environ.get("CALENDAR_TIMEOUT_MARGIN_SECONDS", "10"))
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+QUOTA_REASONS = {"quotaExceeded", "dailyLimitExceeded"}  # gone for the day: defer, don't hammer
+RETRY_LIST_KEY = os.environ.get("CALENDAR_RETRY_KEY", "calendar-retry/pending.json")
+# Local directory standing in for the S3 retry list (local runs and benchmarks)
+RETRY_LIST_DIR = os.environ.get("CALENDAR_RETRY_DIR")
+RETRY_MAX_REPLAYS = int(os.environ.get("CALENDAR_RETRY_MAX_REPLAYS", "10"))
+# Re-reads allowed when another invocation wins a conditional write (index, retry list)
+CONDITIONAL_WRITE_ATTEMPTS = 8
+
+# Tenant registry: a JSON list (inline or a path to a bundled file) of
+# {"name", "s3_prefix", "calendar_id", "google_secret_name"}. S3 keys are routed
+# to the tenant with the longest matching prefix. Without a registry there is
+# one tenant covering the whole bucket.
+TENANTS_CONFIG = os.environ.get("TENANTS_CONFIG")
+DEFAULT_TENANT = {
+    "name": "default",
+    "s3_prefix": "",
+    "calendar_id": CALENDAR_ID,
+    "google_secret_name": SECRET_NAME,
+}
+
+# --- Instrumentation ---
+# Each invocation ends with one CloudWatch Embedded Metric Format line holding
+# per-stage milliseconds and external call counts (no PutMetricData calls).
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "WhatsappScheduler")
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+class InvocationMetrics:
+    """Stage timings (ms) and external call counts for the current invocation.
+
+    The backfill's fetch workers record into it in parallel, so updates hold a lock.
+    """
+
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.properties: Dict[str, Any] = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times one external call (or step); repeated stages add up."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+                self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + n
+
+    def emit(self, **properties):
+        if not METRICS_ENABLED:
+            return
+        values = {"DurationMs": round((time.perf_counter() - self.started) * 1000, 1)}
+        with self._lock:
+            values.update({f"{name}Ms": round(ms, 1) for name, ms in self.stages.items()})
+            values.update({f"{name}Calls": count for name, count in self.calls.items()})
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Function"]],
+                    "Metrics": [
+                        {"Name": name, "Unit": "Milliseconds" if name.endswith("Ms") else "Count"}
+                        for name in values
+                    ],
+                }],
+            },
+            "Function": self.function_name,
+            **values,
+            **self.properties,
+            **properties,
+        }
+        # Printed, not logged: EMF lines must reach stdout without the log prefix
+        print(json.dumps(document))
+
+class RedactSecrets(logging.Filter):
+    """Masks private keys and other credential-looking key/value pairs in log records."""
+    PATTERN = re.compile(
+        r"""(["']?(?:private_key(?:_id)?|client_secret|google_service_account_json|api[_-]?key|password)["']?\s*[:=]\s*)"""
+        r"""("[^"]*"|'[^']*'|[^\s,}]+)""",
+        re.IGNORECASE
+    )
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = self.PATTERN.sub(r'\1"***"', record.getMessage())
+        record.args = None
+        return True
+
+metrics = InvocationMetrics("calendar-updater")
+logger.addFilter(RedactSecrets())
+
+_s3_client = None
+_calendar_services = {}  # service account identity -> Calendar client, reused while warm
+_secrets_cache = {}  # secret name -> (value, fetched_at)
+_rate_limiters = {}  # service account -> TokenBucket, so warm invocations share the pace
+_tenants = None
+_invocation_deadline = None  # time.monotonic() by which writes must stop; None outside Lambda
+
+class TokenBucket:
+    """Client-side rate limiter: `rate` calls per second with up to `burst` saved up.
+
+    The rate is halved on rate-limit errors (down to an eighth) and recovers
+    gradually after clean batches, so writes settle at the quota ceiling.
+    While slowed down the burst shrinks to one second's worth of calls, since
+    a saved-up burst is exactly what the server just refused.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.base_rate = self.rate = rate
+        self.base_burst = self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n: int = 1) -> float:
+        """Blocks until n calls may go out; returns the seconds waited. n may exceed the burst."""
+        self._refill()
+        waited = 0.0
+        if self.tokens < n:
+            waited = (n - self.tokens) / self.rate
+            time.sleep(waited)
+            self._refill()
+        self.tokens -= n
+        return waited
+
+    def wait_time(self, n: int = 1) -> float:
+        """Seconds acquire(n) would block right now."""
+        self._refill()
+        return max(0.0, (n - self.tokens) / self.rate)
+
+    def slow_down(self):
+        self.rate = max(self.base_rate / 8, self.rate / 2)
+        self.burst = max(1, min(self.burst, int(self.rate)))
+        self.tokens = min(self.tokens, self.burst)
+
+    def speed_up(self):
+        self.rate = min(self.base_rate, self.rate * 1.25)
+        self.burst = self.base_burst if self.rate == self.base_rate else max(self.burst, int(self.rate))
+
+def get_rate_limiter(identity: str) -> TokenBucket:
+    if identity not in _rate_limiters:
+        _rate_limiters[identity] = TokenBucket(CALENDAR_WRITES_PER_SECOND, CALENDAR_WRITE_BURST)
+    return _rate_limiters[identity]
+
+def calendar_error(exception: Exception) -> Tuple[int, str]:
+    """(HTTP status, Google error reason) of a Calendar API exception; status 0 if there was no response."""
+    status = getattr(getattr(exception, 'resp', None), 'status', 0) or 0
+    reason = ''
+    content = getattr(exception, 'content', None)
+    if content:
+        try:
+            error = json.loads(content.decode('utf-8') if isinstance(content, bytes) else content).get('error', {})
+            reason = (error.get('errors') or [{}])[0].get('reason') or error.get('status') or ''
+        except (ValueError, AttributeError):
+            pass
+    return int(status), reason
+
+def classify_error(exception: Exception, op: Dict = None) -> str:
+    """'retry' (rate limit, 5xx, network), 'defer' (daily quota used up), 'done' (already deleted) or 'fail'."""
+    status, reason = calendar_error(exception)
+    if reason in QUOTA_REASONS:
+        return 'defer'
+    if status == 0 or status == 429 or status >= 500 or reason in RATE_LIMIT_REASONS:
+        return 'retry'
+    if op and op['op'] == 'delete' and status in (404, 410):
+        return 'done'
+    return 'fail'
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter for the given (1-based) attempt."""
+    return random.uniform(0.5, 1.0) * CALENDAR_BACKOFF_BASE * 2 ** (attempt - 1)
+
+def with_backoff(call):
+    """Runs call(), retrying rate-limit and transient Calendar errors with exponential backoff."""
+    for attempt in range(1, CALENDAR_MAX_ATTEMPTS + 1):
+        try:
+            return call()
+        except Exception as e:
+            if attempt == CALENDAR_MAX_ATTEMPTS or classify_error(e) != 'retry':
+                raise
+            delay = backoff_delay(attempt)
+            if _invocation_deadline is not None and time.monotonic() + delay > _invocation_deadline:
+                raise
+            logger.warning(f"Calendar call failed ({calendar_error(e)}), retrying in {delay:.1f}s")
+            metrics.count("CalendarRetry")
+            time.sleep(delay)
+
+def load_tenants() -> List[Dict]:
+    """Returns the tenant registry, loaded once per container."""
+    global _tenants
+    if _tenants is None:
+        if not TENANTS_CONFIG:
+            _tenants = [DEFAULT_TENANT]
+        else:
+            raw = TENANTS_CONFIG
+            if not raw.lstrip().startswith('['):
+                with open(raw, 'r', encoding='utf-8') as f:
+                    raw = f.read()
+            _tenants = [{**DEFAULT_TENANT, **tenant} for tenant in json.loads(raw)]
+    return _tenants
 
-s3_client = boto3.client('s3')
+def route_tenant(key: str) -> Dict:
+    """Returns the tenant owning an S3 key (longest prefix wins), or None."""
+    matches = [t for t in load_tenants() if key.startswith(t['s3_prefix'])]
+    return max(matches, key=lambda t: len(t['s3_prefix'])) if matches else None
 
-def get_secrets() -> Dict[str, Any]:
-    """Retrieves Google Credentials from AWS Secrets Manager."""
+def get_s3_client():
+    """Creates the S3 client on first use and reuses it across warm invocations."""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+def get_calendar_service(service_account_info: Dict):
+    """Builds (once per warm container) a Calendar client for the service account."""
+    cache_key = (service_account_info.get('client_email'), service_account_info.get('private_key_id'))
+    if cache_key not in _calendar_services:
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+
+        creds = service_account.Credentials.from_service_account_info(
+            service_account_info, scopes=['https://www.googleapis.com/auth/calendar']
+        )
+        # static_discovery reads the Calendar v3 document bundled with the client
+        # library in the layer instead of fetching it over the network.
+        with metrics.stage("CalendarBuild"):
+            _calendar_services[cache_key] = build(
+                'calendar', 'v3', credentials=creds, static_discovery=True, cache_discovery=False
+            )
+    return _calendar_services[cache_key]
+
+def get_secrets(secret_name: str = SECRET_NAME) -> Dict[str, Any]:
+    """Retrieves Google Credentials from AWS Secrets Manager, cached per secret while warm."""
+    cached = _secrets_cache.get(secret_name)
+    if cached and time.monotonic() - cached[1] < SECRETS_CACHE_TTL:
+        return cached[0]
+    secrets = _fetch_secrets(secret_name)
+    _secrets_cache[secret_name] = (secrets, time.monotonic())
+    return secrets
+
+def _fetch_secrets(secret_name: str) -> Dict[str, Any]:
     session = boto3.session.Session()
     client = session.client(service_name='secretsmanager', region_name=REGION_NAME)
 
     try:
-        response = client.get_secret_value(SecretId=SECRET_NAME)
+        with metrics.stage("SecretsFetch"):
+            response = client.get_secret_value(SecretId=secret_name)
         # Parse the inner JSON string if your secret is nested
         secret_string = response['SecretString']
         try:
@@ -35,6 +319,8 @@ def get_secrets() -> Dict[str, Any]:
             # If your secret is double-nested (common in AWS console), unwrap it
             if 'Secret-for-Set-home-or-afeka-With-Whatsapp-Gemini-Calendar' in data:
                  return json.loads(data['Secret-for-Set-home-or-afeka-With-Whatsapp-Gemini-Calendar'])
+            if isinstance(data.get(secret_name), str):
+                 return json.loads(data[secret_name])
             return data
         except json.JSONDecodeError:
             return secret_string # Fallback if it's just a raw string
@@ -43,26 +329,260 @@ def get_secrets() -> Dict[str, Any]:
         logger.error(f"Failed to retrieve secrets: {e}")
         raise e
 
-def get_data_from_s3(bucket: str, key: str) -> List[Dict]:
-    """Reads the JSON schedule file directly from S3."""
+def read_schedule_object(bucket: str, key: str) -> Tuple[List[Dict], Dict[str, str]]:
+    """Reads a JSON schedule file from S3 together with its object metadata."""
     try:
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8').strip()
-        logger.info(f"Read content from S3: {content}")
+        with metrics.stage("S3Read"):
+            response = get_s3_client().get_object(Bucket=bucket, Key=key)
+            content = response['Body'].read().decode('utf-8').strip()
+        metadata = response.get('Metadata', {})
+        logger.info(f"Read {len(content)} characters from s3://{bucket}/{key} (metadata: {metadata})")
+        # Validated, canonical upload from the bot: no cleanup needed
+        if metadata.get('schema') == SCHEDULE_SCHEMA:
+            return json.loads(content), metadata
+        # Legacy raw Gemini output
         if content.startswith("```"):
             content = content.strip("`")
             if content.startswith("json"):
                 content = content[4:].strip()
-        return json.loads(content)
+        return json.loads(content), metadata
     except Exception as e:
         logger.error(f"Failed to read S3 object {key} from {bucket}: {e}")
         raise e
 
-def update_google_calendar(service_account_info: Dict, calendar_id: str, schedule_data: List[Dict]):
-    """Updates Google Calendar with All-Day events, checking for duplicates."""
-    if not schedule_data:
+def get_data_from_s3(bucket: str, key: str) -> List[Dict]:
+    """Reads the JSON schedule file directly from S3."""
+    return read_schedule_object(bucket, key)[0]
+
+def read_version_metadata(bucket: str, key: str, version_id: str, current: Dict[str, str]) -> Dict[str, str]:
+    """Metadata of the object version an S3 event names, i.e. the range that write changed.
+
+    When the bot writes twice before the first event is handled, the current
+    metadata only holds the second write's range. Needs bucket versioning;
+    falls back to the whole document when the version cannot be read.
+    """
+    try:
+        with metrics.stage("S3Head"):
+            return get_s3_client().head_object(Bucket=bucket, Key=key, VersionId=version_id).get('Metadata', {})
+    except ClientError as e:
+        logger.warning(f"Could not read version {version_id} of {key} ({e}), reconciling the whole document.")
+        return {k: v for k, v in current.items() if k not in ('changed-from', 'changed-to')}
+
+def restrict_to_changed_range(schedule_data: List[Dict], metadata: Dict[str, str]) -> List[Dict]:
+    """Keeps only the dates the bot's merge actually changed (canonical schedule document)."""
+    first, last = metadata.get('changed-from'), metadata.get('changed-to')
+    if not first or not last:
+        return schedule_data
+    return [entry for entry in schedule_data if first <= entry.get('date', '') <= last]
+
+def list_events_in_range(service, calendar_id: str, first_date: str, last_date: str) -> List[Dict]:
+    """Lists every event between two dates (inclusive) with a single ranged query."""
+    time_max = datetime.strptime(last_date, "%Y-%m-%d") + timedelta(days=1)
+    events = []
+    page_token = None
+    while True:
+        request = service.events().list(
+            calendarId=calendar_id,
+            timeMin=f"{first_date}T00:00:00Z",
+            timeMax=f"{time_max.strftime('%Y-%m-%d')}T00:00:00Z",
+            singleEvents=True,
+            maxResults=2500,
+            pageToken=page_token
+        )
+        with metrics.stage("CalendarList"):
+            events_result = with_backoff(request.execute)
+        events.extend(events_result.get('items', []))
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            return events
+
+def is_auto_added(event: Dict) -> bool:
+    """True for events this function created (tagged, or legacy untagged by description)."""
+    private = event.get('extendedProperties', {}).get('private', {})
+    if private.get(AUTO_TAG_KEY) == AUTO_TAG_VALUE:
+        return True
+    return event.get('description') == AUTO_DESCRIPTION and event.get('summary', '').startswith(STUDY_PREFIX)
+
+def event_body(date_str: str, location: str) -> Dict:
+    """All-Day event for one schedule entry."""
+    # Google Calendar All-Day events require start date YYYY-MM-DD and end date (start + 1 day)
+    end_date = datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=1)
+    return {
+        'summary': f"{STUDY_PREFIX}{location}", # Added prefix for clarity
+        'start': {'date': date_str},
+        'end': {'date': end_date.strftime("%Y-%m-%d")},
+        'description': AUTO_DESCRIPTION,
+        'transparency': 'transparent', # Show as "Free" so it doesn't block meetings, or remove for "Busy"
+        'extendedProperties': {'private': {AUTO_TAG_KEY: AUTO_TAG_VALUE, 'location': location}}
+    }
+
+def plan_reconciliation(desired: Dict[str, str], events: List[Dict],
+                        date_range: Tuple[str, str] = None) -> List[Dict]:
+    """Minimal insert/patch/delete operations turning the auto-added events into `desired`.
+
+    `desired` maps every date in the affected range (by default its first to
+    last date) that should have an event to its location; auto-added events
+    on other dates in the range are deleted. Events not created by this
+    function are never touched.
+    """
+    first, last = date_range or (min(desired), max(desired))
+    existing = {}
+    for event in events:
+        date_str = event.get('start', {}).get('date')
+        # The ranged list can return neighbouring days (timezone overlap); stay inside the range
+        if date_str and first <= date_str <= last and is_auto_added(event):
+            existing.setdefault(date_str, []).append(event)
+
+    plan = []
+    for date_str in sorted(set(desired) | set(existing)):
+        location = desired.get(date_str)
+        have = existing.get(date_str, [])
+        wanted_summary = f"{STUDY_PREFIX}{location}"
+
+        keep = next((e for e in have if e.get('summary') == wanted_summary), None) if location else None
+        if location and keep is None:
+            if have:
+                # The day flipped location: move the existing event instead of adding a second one
+                keep = have[0]
+                plan.append({'op': 'patch', 'date': date_str, 'location': location, 'event_id': keep['id'],
+                             'from': keep.get('summary', '')[len(STUDY_PREFIX):]})
+            else:
+                plan.append({'op': 'insert', 'date': date_str, 'location': location})
+
+        for event in have:
+            if event is not keep:
+                plan.append({'op': 'delete', 'date': date_str, 'event_id': event['id'],
+                             'location': event.get('summary', '')[len(STUDY_PREFIX):]})
+    return plan
+
+def apply_plan(service, calendar_id: str, plan: List[Dict], limiter: TokenBucket = None):
+    """Sends the planned operations through the batch endpoint, recording each one's 'status'."""
+    requests = []
+    for op in plan:
+        request_id = f"{op['op']}-{op['date']}-{len(requests)}"
+        if op['op'] == 'insert':
+            request = service.events().insert(calendarId=calendar_id, body=event_body(op['date'], op['location']))
+        elif op['op'] == 'patch':
+            body = event_body(op['date'], op['location'])
+            request = service.events().patch(
+                calendarId=calendar_id, eventId=op['event_id'],
+                body={k: body[k] for k in ('summary', 'description', 'extendedProperties')}
+            )
+        else:
+            request = service.events().delete(calendarId=calendar_id, eventId=op['event_id'])
+        requests.append((request_id, request, op))
+
+    if requests:
+        execute_batched(service, requests, limiter or TokenBucket(CALENDAR_WRITES_PER_SECOND, CALENDAR_WRITE_BURST))
+
+def execute_batched(service, requests: List[Tuple[str, Any, Dict]], limiter: TokenBucket):
+    """Sends (request_id, request, op) through the batch endpoint, BATCH_LIMIT calls per HTTP round trip.
+
+    Calls are paced by `limiter`. Rate-limited and transient failures are
+    re-sent with exponential backoff while CALENDAR_RETRY_BUDGET lasts. No
+    chunk is sent, nor waited for, past the invocation's deadline (the Lambda
+    timeout less CALENDAR_TIMEOUT_MARGIN), so a slowed-down limiter cannot
+    outlast the invocation before the retry list is written. Each op
+    ends with a 'status' of ok, failed or deferred (not attempted or still
+    failing: left for the retry list), an 'attempts' count and the last 'error'.
+    A single failed write never aborts the others.
+    """
+    deadline = time.monotonic() + CALENDAR_RETRY_BUDGET
+    if _invocation_deadline is not None:
+        deadline = min(deadline, _invocation_deadline)
+    metrics.count("CalendarWrite", len(requests))
+    pending = list(requests)
+    quota_exhausted = out_of_time = False
+    attempt = 0
+    while pending:
+        attempt += 1
+        retry = []
+        while pending:
+            # No bigger than the limiter's burst: a batch's calls reach the API all at once
+            chunk, pending = pending[:min(BATCH_LIMIT, limiter.burst)], pending[min(BATCH_LIMIT, limiter.burst):]
+            if not (quota_exhausted or out_of_time) and _invocation_deadline is not None:
+                out_of_time = time.monotonic() + limiter.wait_time(len(chunk)) > _invocation_deadline
+                if out_of_time:
+                    logger.warning(f"Invocation about to time out, deferring {len(chunk) + len(pending)} calendar writes")
+                    metrics.count("CalendarOutOfTime")
+            if quota_exhausted or out_of_time:
+                for _, _, op in chunk:
+                    op['status'] = 'deferred'
+                continue
+
+            results = {}
+            def callback(request_id, response, exception):
+                results[request_id] = exception
+
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id, request, _ in chunk:
+                batch.add(request, request_id=request_id)
+            with metrics.stage("CalendarThrottle"):
+                limiter.acquire(len(chunk))
+            try:
+                with metrics.stage("CalendarBatch"):
+                    batch.execute()
+            except Exception as e:
+                # The round trip itself failed (network, 429/5xx on the batch endpoint)
+                results = {request_id: e for request_id, _, _ in chunk}
+
+            rate_limited = False
+            for item in chunk:
+                request_id, _, op = item
+                op['attempts'] = attempt
+                exception = results.get(request_id)
+                if exception is None:
+                    op['status'] = 'ok'
+                    continue
+                status, reason = calendar_error(exception)
+                op['error'] = f"{status} {reason}".strip() if status else str(exception)
+                verdict = classify_error(exception, op)
+                if verdict == 'done':
+                    op['status'] = 'ok'
+                elif verdict == 'retry':
+                    retry.append(item)
+                    rate_limited = rate_limited or status == 429 or reason in RATE_LIMIT_REASONS
+                elif verdict == 'defer':
+                    op['status'] = 'deferred'
+                    quota_exhausted = True
+                else:
+                    op['status'] = 'failed'
+                    logger.error(f"Calendar {op['op']} for {op['date']} failed: {exception}")
+            if rate_limited:
+                limiter.slow_down()
+                metrics.count("CalendarRateLimited")
+            else:
+                limiter.speed_up()
+
+        if not retry:
+            break
+        delay = backoff_delay(attempt)
+        if quota_exhausted or out_of_time or attempt >= CALENDAR_MAX_ATTEMPTS or time.monotonic() + delay > deadline:
+            for _, _, op in retry:
+                op['status'] = 'deferred'
+            break
+        logger.warning(f"{len(retry)} calendar writes hit limits or transient errors, "
+                       f"retrying in {delay:.1f}s at {limiter.rate:.1f} calls/s (attempt {attempt + 1})")
+        metrics.count("CalendarRetry", len(retry))
+        time.sleep(delay)
+        pending = retry
+
+    counts = {}
+    for _, _, op in requests:
+        counts[op.get('status')] = counts.get(op.get('status'), 0) + 1
+    logger.info(f"Calendar writes: {counts}")
+
+def update_google_calendar(service_account_info: Dict, calendar_id: str, schedule_data: List[Dict],
+                           dry_run: bool = False, date_range: Tuple[str, str] = None) -> List[Dict]:
+    """Reconciles the calendar with the schedule: one ranged list, then one batch of writes.
+
+    Returns the plan, each op with its write 'status' (see execute_batched);
+    with dry_run the plan is only logged, not applied. date_range widens the
+    reconciled range beyond the schedule's first and last date (replays).
+    """
+    if not schedule_data and not date_range:
         logger.info("No schedule data found in file.")
-        return
+        return []
 
     try:
         # Check if the service account info is a string (JSON) or dict
@@ -75,83 +595,315 @@ def update_google_calendar(service_account_info: Dict, calendar_id: str, schedul
         logger.info(f"🤖 BOT LOGGING IN AS: {bot_email}")
         logger.info(f"📅 TRYING TO UPDATE CALENDAR ID: {calendar_id}")
 
-        creds = service_account.Credentials.from_service_account_info(
-            service_account_info, scopes=['https://www.googleapis.com/auth/calendar']
-        )
-        service = build('calendar', 'v3', credentials=creds)
+        service = get_calendar_service(service_account_info)
 
+        # Later entries for the same date win
+        desired = {}
         for entry in schedule_data:
             date_str = entry.get('date')
             location = entry.get('location')
-            
-            if not date_str or not location:
-                continue
+            if date_str and location:
+                desired[date_str] = location
 
-            # 1. Check for duplicates to prevent spamming calendar
-            time_min = f"{date_str}T00:00:00Z"
-            time_max = f"{date_str}T23:59:59Z"
-            
-            events_result = service.events().list(
-                calendarId=calendar_id, 
-                timeMin=time_min, 
-                timeMax=time_max,
-                singleEvents=True, 
-                q=location 
-            ).execute()
-            
-            existing_events = events_result.get('items', [])
-            
-            if existing_events:
-                logger.info(f"Event '{location}' already exists for {date_str}. Skipping.")
-                continue
+        if not desired and not date_range:
+            logger.info("No valid schedule entries found in file.")
+            return []
+        first, last = date_range or (min(desired), max(desired))
 
-            # 2. Create Event
-            # Google Calendar All-Day events require start date YYYY-MM-DD and end date (start + 1 day)
-            start_date = datetime.strptime(date_str, "%Y-%m-%d")
-            end_date = start_date + timedelta(days=1)
-            
-            event_body = {
-                'summary': f"Study: {location}", # Added prefix for clarity
-                'start': {'date': date_str},
-                'end': {'date': end_date.strftime("%Y-%m-%d")},
-                'description': 'Auto-added from WhatsApp Schedule Analysis',
-                'transparency': 'transparent' # Show as "Free" so it doesn't block meetings, or remove for "Busy"
-            }
-            
-            service.events().insert(calendarId=calendar_id, body=event_body).execute()
-            logger.info(f"✅ Added {location} on {date_str}")
+        # 1. One ranged query over the affected dates instead of one per day
+        events = list_events_in_range(service, calendar_id, first, last)
+
+        # 2. Diff the desired state against the events we created
+        plan = plan_reconciliation(desired, events, (first, last))
+        for op in plan:
+            change = f"{op['from']} -> {op['location']}" if op['op'] == 'patch' else op['location']
+            logger.info(f"{'[dry-run] ' if dry_run else ''}{op['op']} {op['date']}: {change}")
+
+        # 3. Send all writes through the batch endpoint
+        if plan and not dry_run:
+            apply_plan(service, calendar_id, plan, get_rate_limiter(bot_email))
+        logger.info(f"Reconciled {len(desired)} dates with {len(plan)} operations.")
+        return plan
 
     except Exception as e:
         logger.error(f"Google Calendar API Error: {e}")
         raise e
 
+def update_decision_index(bucket: str, schedule_data: List[Dict], removed_dates: Set[str] = frozenset(),
+                          index_key: str = DECISION_INDEX_KEY):
+    """Merges the schedule into the per-date decision index used by the status checker."""
+    decisions = {}
+    for entry in schedule_data:
+        date_str = entry.get('date')
+        location = entry.get('location')
+        if date_str and location:
+            decisions[date_str] = {"location": location, "trigger": location in TRIGGER_LOCATIONS}
+
+    if not decisions and not removed_dates:
+        return
+
+    # Conditional on the ETag read, like the retry list: concurrent invocations
+    # for the same tenant re-read and merge instead of overwriting each other
+    for attempt in range(CONDITIONAL_WRITE_ATTEMPTS):
+        try:
+            with metrics.stage("IndexRead"):
+                response = get_s3_client().get_object(Bucket=bucket, Key=index_key)
+                index, etag = json.loads(response['Body'].read()), response.get('ETag', '')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            index, etag = {"version": 1, "dates": {}}, ''
+
+        for date_str in removed_dates:
+            index["dates"].pop(date_str, None)
+        index["dates"].update(decisions)
+        index["updated_at"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        body = json.dumps(index, separators=(',', ':'), sort_keys=True)
+        if put_if_unchanged(bucket, index_key, body, etag, "IndexWrite"):
+            logger.info(f"Decision index updated with {len(decisions)} dates.")
+            return
+        metrics.count("IndexWriteConflict")
+        conflict_pause(attempt)
+    raise RuntimeError(f"Decision index {index_key} kept changing while being updated.")
+
+def conflict_pause(attempt: int):
+    """Jittered pause before re-reading after a lost conditional write, so racing writers spread out."""
+    time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+def put_if_unchanged(bucket: str, key: str, body: str, etag: str, stage: str) -> bool:
+    """Writes body only if the object still has `etag` ('' = does not exist yet); False on a conflict."""
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        with metrics.stage(stage):
+            get_s3_client().put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/json', **condition)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+        return False
+
+def retry_list_key(tenant: Dict) -> str:
+    return f"{tenant['s3_prefix']}{RETRY_LIST_KEY}"
+
+def read_retry_list(bucket: str, key: str) -> Tuple[Dict, str]:
+    """Returns the retry list and its ETag ('' when there is none yet)."""
+    empty = {"version": 1, "entries": {}}
+    if RETRY_LIST_DIR:
+        try:
+            with open(os.path.join(RETRY_LIST_DIR, bucket, key), 'r', encoding='utf-8') as f:
+                return json.load(f), 'local'
+        except FileNotFoundError:
+            return empty, ''
+    try:
+        with metrics.stage("RetryListRead"):
+            response = get_s3_client().get_object(Bucket=bucket, Key=key)
+            return json.loads(response['Body'].read()), response.get('ETag', '')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return empty, ''
+
+def update_retry_list(bucket: str, key: str, change):
+    """Applies change(retry_list) and writes it back only if it differs.
+
+    The S3 write is conditional on the ETag that was read, so two concurrent
+    invocations never drop each other's entries; on a conflict it re-reads.
+    """
+    for attempt in range(CONDITIONAL_WRITE_ATTEMPTS):
+        retry_list, etag = read_retry_list(bucket, key)
+        before = json.dumps(retry_list, sort_keys=True)
+        change(retry_list)
+        body = json.dumps(retry_list, separators=(',', ':'), sort_keys=True)
+        if json.dumps(retry_list, sort_keys=True) == before:
+            return
+        if RETRY_LIST_DIR:
+            path = os.path.join(RETRY_LIST_DIR, bucket, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                f.write(body)
+            os.replace(f"{path}.tmp", path)
+            return
+        if put_if_unchanged(bucket, key, body, etag, "RetryListWrite"):
+            return
+        conflict_pause(attempt)
+    raise RuntimeError(f"Retry list {key} kept changing while being updated.")
+
+def record_failed_writes(bucket: str, tenant: Dict, file_key: str, failed_dates: List[str], error: str):
+    """Adds the failed dates of a schedule object to the tenant's retry list."""
+    if not failed_dates:
+        return
+    first, last = min(failed_dates), max(failed_dates)
+
+    def change(retry_list):
+        entry = retry_list['entries'].setdefault(file_key, {"bucket": bucket, "first": first, "last": last, "replays": 0})
+        entry['first'], entry['last'] = min(entry['first'], first), max(entry['last'], last)
+        entry['error'] = error
+        entry['updated_at'] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    update_retry_list(bucket, retry_list_key(tenant), change)
+    metrics.count("RetryListed", len(failed_dates))
+    logger.warning(f"Kept {len(failed_dates)} failed calendar writes of {file_key} ({first}..{last}) for the next invocation.")
+
+def failed_ops(plan: List[Dict]) -> List[Dict]:
+    return [op for op in plan if op.get('status') in ('failed', 'deferred')]
+
+def replay_failed_writes(bucket: str, tenant: Dict, google_creds, dry_run: bool = False) -> int:
+    """Reconciles the date ranges in the tenant's retry list against the current schedule.
+
+    Replays re-plan from the latest schedule object and calendar state, so a
+    date changed since the failure is written with its new value. Entries are
+    cleared once they go through and dropped after RETRY_MAX_REPLAYS tries.
+    Returns how many writes are still failing.
+    """
+    retry_list, _ = read_retry_list(bucket, retry_list_key(tenant))
+    outcomes = {}
+    for file_key, entry in retry_list['entries'].items():
+        logger.info(f"Replaying calendar writes of {file_key} for {entry['first']}..{entry['last']} "
+                    f"(replay {entry['replays'] + 1})")
+        try:
+            schedule_data, _ = read_schedule_object(entry['bucket'], file_key)
+            in_range = [e for e in schedule_data if entry['first'] <= e.get('date', '') <= entry['last']]
+            plan = update_google_calendar(google_creds, tenant['calendar_id'], in_range, dry_run,
+                                          (entry['first'], entry['last']))
+            outcomes[file_key] = (entry.get('updated_at'), failed_ops(plan), None)
+        except Exception as e:
+            outcomes[file_key] = (entry.get('updated_at'), None, str(e))
+    if dry_run or not outcomes:
+        return 0
+
+    def change(retry_list):
+        for file_key, (updated_at, failed, error) in outcomes.items():
+            entry = retry_list['entries'].get(file_key)
+            # Failures recorded after this replay started still need their own replay
+            if entry is None or entry.get('updated_at') != updated_at:
+                continue
+            if failed == []:
+                del retry_list['entries'][file_key]
+            elif entry['replays'] + 1 >= RETRY_MAX_REPLAYS:
+                logger.error(f"Giving up on calendar writes of {file_key} ({entry['first']}..{entry['last']}) "
+                             f"after {RETRY_MAX_REPLAYS} replays: {error or entry.get('error')}")
+                del retry_list['entries'][file_key]
+            else:
+                entry['replays'] += 1
+                entry['error'] = error or failed[-1].get('error')
+
+    update_retry_list(bucket, retry_list_key(tenant), change)
+    still_failing = sum(len(failed) if failed is not None else 1 for _, failed, _ in outcomes.values())
+    metrics.count("RetryReplayed", len(outcomes))
+    return still_failing
+
 # --- Main Handler ---
 def lambda_handler(event, context):
+    global _invocation_deadline
+    metrics.reset()
+    if context is not None:
+        _invocation_deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - CALENDAR_TIMEOUT_MARGIN
+    response = {"statusCode": 500}
+    try:
+        response = handle_event(event)
+        return response
+    finally:
+        _invocation_deadline = None
+        metrics.emit(StatusCode=response.get("statusCode"), DryRun=DRY_RUN or bool(event.get('dryRun')))
+
+def handle_event(event: Dict) -> Dict:
     logger.info("Starting S3 Event Handler")
-    logger.info(f"Received Event: {json.dumps(event)}")
+    # Only the object keys: the full event is large and of no use in the logs
+    keys = [record.get('s3', {}).get('object', {}).get('key') for record in event.get('Records', [])]
+    logger.info(f"Received {len(keys)} S3 records: {keys}")
+
+    # Report the plan without writing anything (env DRY_RUN or {"dryRun": true} in a test event)
+    dry_run = DRY_RUN or bool(event.get('dryRun'))
+    plans = {}
+    # Writes left on the tenants' retry lists for a later invocation
+    queued = 0
+    replayed = set()
+
+    def replay(bucket_name, tenant, google_creds):
+        # Once per tenant and invocation, before its new writes use up the rate
+        nonlocal queued
+        if tenant['name'] in replayed:
+            return
+        replayed.add(tenant['name'])
+        try:
+            queued += replay_failed_writes(bucket_name, tenant, google_creds, dry_run)
+        except Exception as e:
+            # The new writes below must not wait on an unreadable retry list
+            logger.error(f"Replaying the retry list of {tenant['name']} failed: {e}")
 
     try:
-        # 1. Get Secrets (Only need Google Creds now)
-        secrets = get_secrets()
-        google_creds = secrets.get('google_service_account_json')
-        
-        if not google_creds:
-            raise ValueError("google_service_account_json not found in secrets.")
+        # {"replayRetries": true} (e.g. from a schedule rule) only works off the retry lists
+        if event.get('replayRetries'):
+            for tenant in load_tenants():
+                google_creds = get_secrets(tenant['google_secret_name']).get('google_service_account_json')
+                replay(BUCKET_NAME, tenant, google_creds)
 
-        # 2. Parse S3 Event
+        # 1. Parse S3 Event
         # S3 trigger events are list of records
         for record in event.get('Records', []):
-            bucket_name = BUCKET_NAME
+            bucket_name = record['s3'].get('bucket', {}).get('name', BUCKET_NAME)
             file_key = record['s3']['object']['key']
+
+            # 2. Route to the tenant owning this key
+            tenant = route_tenant(file_key)
+            if tenant is None:
+                logger.warning(f"No tenant for {file_key}, skipping.")
+                continue
+            relative_key = file_key[len(tenant['s3_prefix']):]
+
+            if relative_key in (DECISION_INDEX_KEY, RETRY_LIST_KEY) or relative_key.startswith(SCHEDULE_SHARD_PREFIX):
+                logger.info(f"Skipping derived object: {file_key}")
+                continue
             
-            logger.info(f"Processing file: {file_key} from bucket: {bucket_name}")
+            logger.info(f"Processing file: {file_key} from bucket: {bucket_name} for tenant: {tenant['name']}")
+
+            # Get Secrets (Only need Google Creds now), cached per tenant secret
+            google_creds = get_secrets(tenant['google_secret_name']).get('google_service_account_json')
+            if not google_creds:
+                raise ValueError("google_service_account_json not found in secrets.")
+            replay(bucket_name, tenant, google_creds)
+
+            # 3. Read JSON from S3 (only the dates the merge behind this event changed)
+            schedule_data, metadata = read_schedule_object(bucket_name, file_key)
+            version_id = record['s3']['object'].get('versionId')
+            if version_id:
+                # The range from that version; the values from the current one, in case a later write replaced it
+                metadata = read_version_metadata(bucket_name, file_key, version_id, metadata)
+            schedule_data = restrict_to_changed_range(schedule_data, metadata)
+
+            # 4. Reconcile Calendar
+            try:
+                plan = update_google_calendar(google_creds, tenant['calendar_id'], schedule_data, dry_run=dry_run)
+            except Exception as e:
+                # Even the list failed: keep the whole range for the next invocation
+                if dry_run:
+                    raise
+                dates = [entry['date'] for entry in schedule_data if entry.get('date')]
+                record_failed_writes(bucket_name, tenant, file_key, dates, str(e))
+                queued += len(dates)
+                continue
+            plans[file_key] = plan
+            metrics.count("PlannedOp", len(plan))
+            if dry_run:
+                continue
 
-            # 3. Read JSON from S3
-            schedule_data = get_data_from_s3(bucket_name, file_key)
+            failed = failed_ops(plan)
+            if failed:
+                record_failed_writes(bucket_name, tenant, file_key, [op['date'] for op in failed], failed[-1].get('error'))
+                queued += len(failed)
 
-            # 4. Update Calendar
-            update_google_calendar(google_creds, CALENDAR_ID, schedule_data)
+            # 5. Publish the decisions for the status checker's read path
+            scheduled = {entry.get('date') for entry in schedule_data}
+            removed = {op['date'] for op in plan if op['op'] == 'delete'} - scheduled
+            update_decision_index(bucket_name, schedule_data, removed, f"{tenant['s3_prefix']}{DECISION_INDEX_KEY}")
 
+        if dry_run:
+            return {"statusCode": 200, "body": json.dumps({"dryRun": True, "plans": plans})}
+        if queued:
+            # Partial success: the failed dates are on the retry list, not lost
+            metrics.count("CalendarWritesQueued", queued)
+            return {"statusCode": 200, "body": f"Calendar updated, {queued} writes queued for retry"}
         return {"statusCode": 200, "body": "Calendar updated successfully"}
 
     except Exception as e:
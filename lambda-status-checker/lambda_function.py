@@ -1,11 +1,19 @@
+import base64
+import hashlib
 import json
 import os
+import re
 import logging
 import datetime
+import threading
+import time
+from contextlib import contextmanager
+from zoneinfo import ZoneInfo
 import boto3
-from botocore.exceptions import ClientError
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from botocore.exceptions import BotoCoreError, ClientError
+# The Google client libraries are imported lazily (see build_calendar_client):
+# they are only needed when the decision index misses, and they dominate the
+# import time of a cold start.
 
 # Configure Logging
 logger = logging.getLogger()
@@ -16,13 +24,266 @@ SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 SECRET_NAME = os.environ.get('SECRET_NAME', 'Google-Calendar-API-Key')
 SECRET_HEADER = 'SECRET_HEADER'
 REGION_NAME = "us-east-1" # Ensure this matches your AWS Region
+# Where secrets are read from (see SECRET_SOURCES): 'aws' for Secrets Manager,
+# or for the self-hosted service (server.py) 'env' (an environment variable
+# named after the secret) or 'file' (a file named after it in SECRETS_DIR,
+# which is where Docker secrets are mounted).
+SECRETS_SOURCE = os.environ.get('SECRETS_SOURCE', 'aws').lower()
+SECRETS_DIR = os.environ.get('SECRETS_DIR', '/run/secrets')
+CALENDAR_TIMEZONE = os.environ.get('CALENDAR_TIMEZONE', 'Asia/Jerusalem')
+
+# Per-date decision index written by the calendar updater. When the bucket is
+# not configured the checker always asks Google Calendar.
+DECISION_INDEX_BUCKET = os.environ.get('DECISION_INDEX_BUCKET')
+DECISION_INDEX_KEY = os.environ.get('DECISION_INDEX_KEY', 'decision-index/daily.json')
+# How often a warm container revalidates its copy of the index (conditional GET).
+INDEX_REVALIDATE_SECONDS = int(os.environ.get('INDEX_REVALIDATE_SECONDS', '60'))
+# How long a fetched day of events answers "current"/"next" from memory.
+EVENTS_CACHE_SECONDS = int(os.environ.get('EVENTS_CACHE_SECONDS', '300'))
+# Range mode (?days=N): how far ahead a plan may reach and how long the phone
+# may reuse it before revalidating with If-None-Match.
+PLAN_MAX_DAYS = int(os.environ.get('PLAN_MAX_DAYS', '31'))
+PLAN_MAX_AGE_SECONDS = int(os.environ.get('PLAN_MAX_AGE_SECONDS', '3600'))
+
+# Tenant registry: a JSON list (inline or a path to a bundled file) of
+# {"name", "calendar_id", "header_secret_name", "google_secret_name", "s3_prefix"}.
+# Requests pick their tenant with the x-tenant header; without a registry the
+# single tenant below is built from the environment.
+TENANTS_CONFIG = os.environ.get('TENANTS_CONFIG')
+DEFAULT_TENANT = {
+    'name': 'default',
+    'calendar_id': os.environ.get('CALENDAR_ID', 'primary'),
+    'header_secret_name': SECRET_HEADER,
+    'google_secret_name': SECRET_NAME,
+    's3_prefix': '',
+}
+
+# --- Instrumentation ---
+# One CloudWatch Embedded Metric Format line per invocation: time per stage and
+# number of external calls, turned into metrics by CloudWatch Logs for free.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'WhatsappScheduler')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+class InvocationMetrics(threading.local):
+    """Stage timings (ms) and external call counts for the current invocation.
+
+    Thread-local, so concurrent requests in server.py keep their own.
+    """
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.calls = {}
+        self.properties = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Times one external call (or step); repeated stages add up."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - started) * 1000
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def emit(self, **properties):
+        if not METRICS_ENABLED:
+            return
+        values = {'DurationMs': round((time.perf_counter() - self.started) * 1000, 1)}
+        values.update({f'{name}Ms': round(ms, 1) for name, ms in self.stages.items()})
+        values.update({f'{name}Calls': count for name, count in self.calls.items()})
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [
+                        {'Name': name, 'Unit': 'Milliseconds' if name.endswith('Ms') else 'Count'}
+                        for name in values
+                    ],
+                }],
+            },
+            'Function': self.function_name,
+            **values,
+            **self.properties,
+            **properties,
+        }
+        # EMF has to be a bare JSON line on stdout; the Lambda log handler would prefix it
+        print(json.dumps(document))
+
+class RedactSecrets(logging.Filter):
+    """Masks secrets in log records: values registered in `known` plus key/value pairs that look like one."""
+    PATTERN = re.compile(
+        r"""(["']?(?:private_key(?:_id)?|x-secret-header|SECRET_HEADER|client_secret|api[_-]?key|password)["']?\s*[:=]\s*)"""
+        r"""("[^"]*"|'[^']*'|[^\s,}]+)""",
+        re.IGNORECASE
+    )
+
+    def __init__(self):
+        super().__init__()
+        self.known = set()
+
+    def filter(self, record):
+        message = record.getMessage()
+        for value in tuple(self.known):  # another request may be adding one
+            message = message.replace(value, '***')
+        record.msg = self.PATTERN.sub(r'\1"***"', message)
+        record.args = None
+        return True
+
+metrics = InvocationMetrics('status-checker')
+redactor = RedactSecrets()
+logger.addFilter(redactor)
+
+# --- Warm-container cache ---
+# Lambda keeps module state between invocations of a warm container, so the
+# secrets, credentials and Calendar client are fetched once and reused until
+# they expire (or Google rejects them, see check_calendar_status). server.py
+# answers requests concurrently: each entry is fetched under its own lock, so
+# a slow fetch only holds up the requests that need that entry.
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', '900'))
+# Minimum age before a header mismatch may force a Secrets Manager refresh,
+# so bad requests cannot be used to hammer Secrets Manager.
+HEADER_REFRESH_MIN_AGE = int(os.environ.get('HEADER_REFRESH_MIN_AGE', '60'))
+# 403 reasons that mean the credentials were refused; a 403 rate limit is not one
+AUTH_ERROR_REASONS = {'forbidden', 'insufficientPermissions'}
+
+_secrets_client = None
+_s3_client = None
+_cache = {}  # key -> (value, fetched_at)
+_decision_indexes = {}  # index key -> {'etag', 'dates', 'checked_at'}
+_tenants = None
+_locks = {}  # cache key -> Lock
+_locks_guard = threading.Lock()
+_clients = threading.local()  # per thread: secret name -> (credentials, Calendar client)
+
+def _key_lock(key):
+    """The lock serializing the fetches of one cache entry."""
+    with _locks_guard:
+        return _locks.setdefault(key, threading.Lock())
+
+def _cache_get(key, max_age=CACHE_TTL_SECONDS):
+    entry = _cache.get(key)
+    if entry and time.monotonic() - entry[1] < max_age:
+        return entry[0]
+    return None
+
+def _cache_put(key, value):
+    _cache[key] = (value, time.monotonic())
+    return value
+
+def _cache_fetch(key, fetch, max_age=CACHE_TTL_SECONDS, force_refresh=False):
+    """The cached value of key, else fetch()'s, fetched once when concurrent requests miss together."""
+    if not force_refresh:
+        cached = _cache_get(key, max_age)
+        if cached is not None:
+            return cached
+    with _key_lock(key):
+        if not force_refresh:
+            # Fetched by another request while this one waited
+            cached = _cache_get(key, max_age)
+            if cached is not None:
+                return cached
+        return _cache_put(key, fetch())
+
+def _cache_age(key):
+    entry = _cache.get(key)
+    return time.monotonic() - entry[1] if entry else None
+
+def invalidate_cache(key=None):
+    """Drops one cached entry, or every cached secret, credential and client."""
+    if key is None:
+        _cache.clear()
+    else:
+        _cache.pop(key, None)
+
+def prune_cache():
+    """Drops expired entries; a long-running service would otherwise keep every day's events."""
+    max_age = max(CACHE_TTL_SECONDS, EVENTS_CACHE_SECONDS)
+    for key in [key for key, (_, fetched_at) in list(_cache.items()) if time.monotonic() - fetched_at >= max_age]:
+        _cache.pop(key, None)
+    with _locks_guard:
+        for key in [key for key, lock in _locks.items()
+                    if key.startswith('events:') and key not in _cache and not lock.locked()]:
+            del _locks[key]
+
+def load_tenants():
+    """Returns {name: tenant} from TENANTS_CONFIG, loaded once per container."""
+    global _tenants
+    if _tenants is None:
+        if not TENANTS_CONFIG:
+            _tenants = {'default': DEFAULT_TENANT}
+        else:
+            raw = TENANTS_CONFIG
+            if not raw.lstrip().startswith('['):
+                with open(raw, 'r', encoding='utf-8') as f:
+                    raw = f.read()
+            _tenants = {t['name']: {**DEFAULT_TENANT, **t} for t in json.loads(raw)}
+    return _tenants
+
+def get_tenant(name):
+    """Resolves the request's tenant; the first registered tenant is the default."""
+    tenants = load_tenants()
+    if not name:
+        return next(iter(tenants.values()))
+    return tenants.get(name)
+
+def get_secrets_client():
+    """Returns a Secrets Manager client reused across warm invocations."""
+    global _secrets_client
+    if _secrets_client is None:
+        with _key_lock('secrets_client'):
+            if _secrets_client is None:
+                session = boto3.session.Session()
+                _secrets_client = session.client(service_name='secretsmanager', region_name=REGION_NAME)
+    return _secrets_client
+
+def get_s3_client():
+    """Returns an S3 client reused across warm invocations."""
+    global _s3_client
+    if _s3_client is None:
+        # Creating clients from boto3's default session is not thread-safe
+        with _key_lock('s3_client'):
+            if _s3_client is None:
+                _s3_client = boto3.client('s3', region_name=REGION_NAME)
+    return _s3_client
 
 def get_secret(secret_name):
+    """Retrieves the secret from the configured SECRETS_SOURCE."""
+    source = SECRET_SOURCES.get(SECRETS_SOURCE)
+    if source is None:
+        raise ValueError(f"Unknown SECRETS_SOURCE {SECRETS_SOURCE!r}, expected one of {sorted(SECRET_SOURCES)}")
+    return source(secret_name)
+
+def secret_env_name(secret_name):
+    """'Google-Calendar-API-Key' -> 'GOOGLE_CALENDAR_API_KEY'."""
+    return re.sub(r'[^0-9A-Za-z]+', '_', secret_name).strip('_').upper()
+
+def get_env_secret(secret_name):
+    """Reads the secret from the environment variable named after it."""
+    value = os.environ.get(secret_env_name(secret_name))
+    if value is None:
+        raise ValueError(f"Secret {secret_name} not set: export {secret_env_name(secret_name)}")
+    return value
+
+def get_file_secret(secret_name):
+    """Reads the secret from the file named after it in SECRETS_DIR."""
+    path = os.path.join(SECRETS_DIR, secret_name)
+    with metrics.stage('SecretsFetch'):
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+
+def get_aws_secret(secret_name):
     """Retrieves the secret from AWS Secrets Manager."""
-    session = boto3.session.Session()
-    client = session.client(service_name='secretsmanager', region_name=REGION_NAME)
+    client = get_secrets_client()
     try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
+        with metrics.stage('SecretsFetch'):
+            get_secret_value_response = client.get_secret_value(SecretId=secret_name)
     except ClientError as e:
         logger.error(f"Unable to retrieve secret: {e}")
         raise e
@@ -31,10 +292,12 @@ def get_secret(secret_name):
         return get_secret_value_response['SecretString']
     return base64.b64decode(get_secret_value_response['SecretBinary'])
 
-def get_google_creds():
+SECRET_SOURCES = {'aws': get_aws_secret, 'env': get_env_secret, 'file': get_file_secret}
+
+def get_google_creds(secret_name=SECRET_NAME):
     """Robust credential retrieval (handles wrapped/unwrapped secrets)."""
     try:
-        secret_content = get_secret(SECRET_NAME)
+        secret_content = get_secret(secret_name)
         try:
             data = json.loads(secret_content)
         except json.JSONDecodeError:
@@ -66,6 +329,7 @@ def get_google_creds():
         if not final_creds:
             raise ValueError("Could not find valid Google Credentials in Secret.")
 
+        from google.oauth2 import service_account
         return service_account.Credentials.from_service_account_info(
             final_creds, scopes=SCOPES
         )
@@ -74,74 +338,396 @@ def get_google_creds():
         logger.error(f"Credential Error: {e}")
         raise
 
-def check_calendar_status():
-    """Checks the current event on the calendar."""
-    creds = get_google_creds()
-    service = build('calendar', 'v3', credentials=creds)
-    calendar_id = os.environ.get('CALENDAR_ID', 'primary')
-
-    # Get current time in UTC
-    now = datetime.datetime.utcnow().isoformat() + 'Z'
-    
-    events_result = service.events().list(
-        calendarId=calendar_id,
-        timeMin=now,
-        maxResults=1,
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-    
-    events = events_result.get('items', [])
-
-    if not events:
-        return "NO_EVENT"
-
-    # Strict check: Is 'now' actually inside the event duration?
-    # (Optional: You can remove this if you just want the 'next' event)
-    event = events[0]
-    # start = event['start'].get('dateTime', event['start'].get('date'))
-    # end = event['end'].get('dateTime', event['end'].get('date'))
-    # logic to compare timestamps could go here if needed.
-    return event.get('summary', '')
+def get_expected_header_secret(secret_name=SECRET_HEADER, force_refresh=False):
+    """Returns the expected x-secret-header value, cached with a TTL."""
+    def fetch():
+        raw = get_secret(secret_name)
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError:
+            data = None
+        if isinstance(data, dict):
+            expected = data.get(secret_name, data.get(SECRET_HEADER))
+        else:
+            # env and file sources may hold the bare value
+            expected = raw.strip()
+        if expected:
+            redactor.known.add(expected)
+        return expected
+    return _cache_fetch(f'header_secret:{secret_name}', fetch, force_refresh=force_refresh)
+
+def is_authorized(actual_secret, secret_name=SECRET_HEADER):
+    """Validates the request header, re-reading the secret once if it may have rotated."""
+    if actual_secret is None:
+        return False
+    if actual_secret == get_expected_header_secret(secret_name):
+        return True
+    age = _cache_age(f'header_secret:{secret_name}')
+    if age is not None and age >= HEADER_REFRESH_MIN_AGE:
+        logger.info("Header mismatch, refreshing header secret in case it was rotated.")
+        return actual_secret == get_expected_header_secret(secret_name, force_refresh=True)
+    return False
+
+def get_calendar_credentials(secret_name=SECRET_NAME, force_refresh=False):
+    """Returns the service account credentials, cached with a TTL and shared by every thread."""
+    return _cache_fetch(f'google_creds:{secret_name}', lambda: get_google_creds(secret_name), force_refresh=force_refresh)
+
+def build_calendar_client(creds):
+    from googleapiclient.discovery import build
+    # static_discovery reads the Calendar v3 document bundled with the client
+    # library in the layer instead of fetching it over the network.
+    return build('calendar', 'v3', credentials=creds, static_discovery=True, cache_discovery=False)
+
+def get_calendar_service(secret_name=SECRET_NAME, force_refresh=False):
+    """Returns this thread's Calendar client for a service account secret.
+
+    httplib2 connections must not be shared between threads, so each thread
+    builds its own client on the shared credentials and keeps it until they
+    are refreshed.
+    """
+    creds = get_calendar_credentials(secret_name, force_refresh=force_refresh)
+    by_secret = getattr(_clients, 'by_secret', None)
+    if by_secret is None:
+        by_secret = _clients.by_secret = {}
+    entry = by_secret.get(secret_name)
+    if entry is None or entry[0] is not creds:
+        with metrics.stage('CalendarBuild'):
+            entry = by_secret[secret_name] = (creds, build_calendar_client(creds))
+    return entry[1]
+
+def get_decision_index(key=DECISION_INDEX_KEY):
+    """Returns the date -> decision map, revalidated against S3 by ETag.
+
+    While one request revalidates, concurrent ones answer from the copy
+    already loaded instead of waiting on S3.
+    """
+    state = _decision_indexes.setdefault(key, {'etag': None, 'dates': {}, 'checked_at': None})
+    checked_at = state['checked_at']
+    if checked_at is not None and time.monotonic() - checked_at < INDEX_REVALIDATE_SECONDS:
+        return state['dates']
+
+    lock = _key_lock(f'index:{key}')
+    if not lock.acquire(blocking=checked_at is None):
+        return state['dates']
+    try:
+        if state['checked_at'] != checked_at:
+            return state['dates']  # revalidated while this request waited for the first load
+        return _revalidate_decision_index(key, state)
+    finally:
+        lock.release()
+
+def _revalidate_decision_index(key, state):
+    kwargs = {'Bucket': DECISION_INDEX_BUCKET, 'Key': key}
+    if state['etag']:
+        kwargs['IfNoneMatch'] = state['etag']
+
+    try:
+        with metrics.stage('IndexFetch'):
+            response = get_s3_client().get_object(**kwargs)
+            index = json.loads(response['Body'].read())
+        if not isinstance(index, dict) or not isinstance(index.get('dates', {}), dict):
+            raise ValueError("not a decision index document")
+        state['dates'] = index.get('dates', {})
+        state['etag'] = response['ETag']
+        logger.info(f"Loaded decision index ({len(state['dates'])} dates).")
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code == 'NoSuchKey':
+            state.update(etag=None, dates={})
+        elif code not in ('304', 'NotModified'):
+            # Keep serving the last good copy; the live Calendar path still works.
+            logger.warning(f"Could not read decision index: {e}")
+    except (BotoCoreError, ValueError) as e:
+        # Network errors, timeouts, a corrupt body: same as above, days missing
+        # from the last good copy (all of them, if there is none) go to the Calendar
+        logger.warning(f"Could not read decision index: {e}")
+    state['checked_at'] = time.monotonic()
+    return state['dates']
+
+def lookup_decision(date_str, tenant=DEFAULT_TENANT):
+    """Returns the precomputed decision for a date, or None when it must be checked live."""
+    if not DECISION_INDEX_BUCKET:
+        return None
+    return get_decision_index(f"{tenant['s3_prefix']}{DECISION_INDEX_KEY}").get(date_str)
+
+def decide(title):
+    """Maps a calendar event title to the trigger decision."""
+    title_lower = title.lower()
+    should_share = False
+
+    if "afeka" in title_lower or "college" in title_lower:
+        should_share = True
+
+    if "home" in title_lower:
+        should_share = False
+
+    return should_share
+
+def parse_at(value):
+    """Parses the optional ?at= parameter (ISO date or datetime) into an aware datetime."""
+    tz = ZoneInfo(CALENDAR_TIMEZONE)
+    if not value:
+        return datetime.datetime.now(tz)
+    # fromisoformat only accepts a trailing 'Z' from Python 3.11 on
+    parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=tz)
+    return parsed.astimezone(tz)
+
+def event_bounds(event, tz):
+    """Returns the (start, end) of an all-day or timed event as aware datetimes."""
+    bounds = []
+    for edge in ('start', 'end'):
+        value = event.get(edge, {})
+        if 'dateTime' in value:
+            bounds.append(datetime.datetime.fromisoformat(value['dateTime'].replace('Z', '+00:00')))
+        else:
+            # All-day events run from local midnight to local midnight of the (exclusive) end date
+            day = datetime.date.fromisoformat(value['date'])
+            bounds.append(datetime.datetime.combine(day, datetime.time.min, tzinfo=tz))
+    return bounds[0], bounds[1]
+
+def get_events_for_day(service, calendar_id, day, days=2):
+    """Events from the start of `day` until the end of `days` local days, cached per window."""
+    tz = ZoneInfo(CALENDAR_TIMEZONE)
+    window_start = datetime.datetime.combine(day, datetime.time.min, tzinfo=tz)
+    window_end = window_start + datetime.timedelta(days=days)
+
+    def fetch():
+        events = []
+        page_token = None
+        while True:
+            with metrics.stage('CalendarList'):
+                events_result = service.events().list(
+                    calendarId=calendar_id,
+                    timeMin=window_start.isoformat(),
+                    timeMax=window_end.isoformat(),
+                    singleEvents=True,
+                    orderBy='startTime',
+                    timeZone=CALENDAR_TIMEZONE,
+                    maxResults=250,
+                    pageToken=page_token
+                ).execute()
+            events.extend(events_result.get('items', []))
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                return events
+    return _cache_fetch(f'events:{calendar_id}:{day.isoformat()}:{days}', fetch, max_age=EVENTS_CACHE_SECONDS)
+
+def find_current_and_next(events, at):
+    """Splits events into those containing `at` and the first one starting after it."""
+    tz = at.tzinfo
+    current = []
+    upcoming = None
+    for event in events:
+        start, end = event_bounds(event, tz)
+        if start <= at < end:
+            current.append(event)
+        elif start > at and (upcoming is None or start < event_bounds(upcoming, tz)[0]):
+            upcoming = event
+    return current, upcoming
+
+def pick_relevant(events):
+    """Prefers an event whose title carries a location keyword (e.g. the all-day Study event)."""
+    for event in events:
+        title = event.get('summary', '').lower()
+        if any(keyword in title for keyword in ('afeka', 'college', 'home')):
+            return event
+    return events[0] if events else None
+
+def calendar_error_reason(exception):
+    """The Google error reason (e.g. 'rateLimitExceeded') of a Calendar HttpError, or ''."""
+    try:
+        content = exception.content
+        error = json.loads(content.decode('utf-8') if isinstance(content, bytes) else content).get('error', {})
+        return (error.get('errors') or [{}])[0].get('reason') or ''
+    except (AttributeError, ValueError):
+        return ''
+
+def with_calendar(tenant, fn):
+    """Calls fn(service, calendar_id), rebuilding the client once if Google rejects its credentials."""
+    from googleapiclient.errors import HttpError
+    secret_name = tenant['google_secret_name']
+    try:
+        return fn(get_calendar_service(secret_name), tenant['calendar_id'])
+    except HttpError as e:
+        if e.resp.status != 401 and not (e.resp.status == 403 and calendar_error_reason(e) in AUTH_ERROR_REASONS):
+            # Rate limits and other errors: fresh credentials would not help
+            raise
+        # Credentials were revoked or rotated: rebuild from a fresh secret once.
+        logger.warning(f"Calendar rejected cached credentials ({e.resp.status}), refreshing.")
+        service = get_calendar_service(secret_name, force_refresh=True)
+        return fn(service, tenant['calendar_id'])
+
+def check_calendar_status(at, tenant=DEFAULT_TENANT):
+    """Returns the titles of the event happening at `at` and of the next one."""
+    return with_calendar(tenant, lambda service, calendar_id: _check_calendar_status(service, calendar_id, at))
+
+def _check_calendar_status(service, calendar_id, at):
+    events = get_events_for_day(service, calendar_id, at.date())
+    current, upcoming = find_current_and_next(events, at)
+
+    current_event = pick_relevant(current)
+    current_title = current_event.get('summary', '') if current_event else "NO_EVENT"
+    next_title = upcoming.get('summary', '') if upcoming else None
+    return current_title, next_title
+
+def plan_day(day, events, tz, windows=False):
+    """The trigger decision for one local day, from the events overlapping it."""
+    day_start = datetime.datetime.combine(day, datetime.time.min, tzinfo=tz)
+    day_end = day_start + datetime.timedelta(days=1)
+    overlapping = []
+    for event in events:
+        start, end = event_bounds(event, tz)
+        if start < day_end and end > day_start:
+            overlapping.append((event, start, end))
+
+    relevant = pick_relevant([event for event, _, _ in overlapping])
+    title = relevant.get('summary', '') if relevant else "NO_EVENT"
+    entry = {'trigger': decide(title), 'reason': title}
+    if windows:
+        entry['windows'] = [
+            {
+                'from': start.isoformat(),
+                'to': end.isoformat(),
+                'trigger': decide(event.get('summary', '')),
+                'reason': event.get('summary', '')
+            }
+            for event, start, end in overlapping
+            if 'dateTime' in event.get('start', {})
+        ]
+    return entry
+
+def build_plan(first_day, days, tenant=DEFAULT_TENANT, windows=False):
+    """Returns {date: {trigger, reason[, windows]}} for `days` days starting at first_day.
+
+    Days covered by the decision index are answered from it; the rest share a
+    single Calendar list call over the whole range.
+    """
+    tz = ZoneInfo(CALENDAR_TIMEZONE)
+    dates = [first_day + datetime.timedelta(days=i) for i in range(days)]
+    plan = {}
+    missing = []
+    for day in dates:
+        decision = None if windows else lookup_decision(day.isoformat(), tenant)
+        if decision:
+            plan[day.isoformat()] = {
+                'trigger': bool(decision.get('trigger')),
+                'reason': f"Study: {decision.get('location')}"
+            }
+        else:
+            missing.append(day)
+
+    if missing:
+        events = with_calendar(
+            tenant,
+            lambda service, calendar_id: get_events_for_day(service, calendar_id, missing[0], (missing[-1] - missing[0]).days + 1)
+        )
+        for day in missing:
+            plan[day.isoformat()] = plan_day(day, events, tz, windows)
+    return {day.isoformat(): plan[day.isoformat()] for day in dates}
+
+def plan_response(event, at, tenant, params):
+    """Range mode: a cacheable multi-day plan with an ETag, answering 304 when unchanged."""
+    try:
+        days = int(params['days'])
+    except ValueError:
+        days = 0
+    if not 1 <= days <= PLAN_MAX_DAYS:
+        return {'statusCode': 400, 'body': f"'days' must be between 1 and {PLAN_MAX_DAYS}"}
+    windows = (params.get('windows') or '').lower() in ('1', 'true', 'yes')
+
+    try:
+        plan = build_plan(at.date(), days, tenant, windows)
+    except Exception as e:
+        logger.error(f"Building the plan failed: {e}")
+        # Not cacheable, so the phone keeps deciding from the plan it already has
+        return {'statusCode': 502, 'headers': {'Cache-Control': 'no-store'}, 'body': json.dumps({'error': str(e)})}
+
+    body = json.dumps({'timezone': CALENDAR_TIMEZONE, 'days': plan}, separators=(',', ':'), sort_keys=True)
+    etag = f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'private, max-age={PLAN_MAX_AGE_SECONDS}',
+    }
+    request_headers = event.get('headers') or {}
+    if_none_match = request_headers.get('if-none-match') or request_headers.get('If-None-Match')
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return {'statusCode': 304, 'headers': headers}
+
+    logger.info(f"Plan for {days} days from {at.date().isoformat()}: {len(body)} bytes, ETag {etag}")
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', **headers},
+        'body': body
+    }
 
 def lambda_handler(event, context):
+    metrics.reset()
+    response = {'statusCode': 500}
+    try:
+        response = handle_request(event)
+        return response
+    finally:
+        metrics.emit(StatusCode=response.get('statusCode'))
+
+def handle_request(event):
     logger.info("Function started (Calendar Check Only).")
 
-    logger.info(get_secret(SECRET_HEADER))
-    EXPECTED_SECRET = json.loads(get_secret(SECRET_HEADER))[SECRET_HEADER]
-    
     # Check for the custom header in the 'headers' object
-    actual_secret = event.get('headers', {}).get('x-secret-header')
+    headers = event.get('headers') or {}
+    actual_secret = headers.get('x-secret-header')
+    tenant = get_tenant(headers.get('x-tenant'))
 
-    if actual_secret != EXPECTED_SECRET:
+    if tenant is not None:
+        metrics.properties['Tenant'] = tenant['name']
+    if tenant is None or not is_authorized(actual_secret, tenant['header_secret_name']):
         return {
             'statusCode': 403,
             'body': 'Unauthorized'
         }
 
-    # 1. Check Calendar
+    # Optional ?at=<ISO date/time> to evaluate another moment (e.g. precompute a day)
+    params = event.get('queryStringParameters') or {}
     try:
-        current_event_title = check_calendar_status()
-        logger.info(f"Current Calendar Event: {current_event_title}")
+        at = parse_at(params.get('at'))
+    except ValueError as e:
+        return {'statusCode': 400, 'body': f"Invalid 'at' parameter: {e}"}
+
+    # Range mode: ?days=N returns a plan the phone can cache and decide from offline
+    if params.get('days'):
+        return plan_response(event, at, tenant, params)
+
+    # 1. Precomputed decision for the day, if the updater published one
+    day = at.date().isoformat()
+    decision = lookup_decision(day, tenant)
+    metrics.properties['IndexHit'] = bool(decision)
+    if decision:
+        logger.info(f"Decision index hit for {day}: {decision}")
+        response = {
+            'trigger': bool(decision.get('trigger')),
+            'reason': f"Study: {decision.get('location')}"
+        }
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps(response)
+        }
+
+    # 2. Check Calendar
+    try:
+        current_event_title, next_event_title = check_calendar_status(at, tenant)
+        logger.info(f"Calendar Event at {at.isoformat()}: {current_event_title} (next: {next_event_title})")
     except Exception as e:
         logger.error(f"Calendar check failed: {e}")
         # Fail safe: Do NOT trigger location sharing if error
         return {'statusCode': 200, 'body': json.dumps({'trigger': False, 'error': str(e)})}
 
-    # 2. Logic Decision
-    title_lower = current_event_title.lower()
-    should_share = False
-
-    if "afeka" in title_lower or "college" in title_lower:
-        should_share = True
-
-    if "home" in title_lower:
-        should_share = False
-
-    # 3. Return JSON for Tasker
+    # 3. Logic Decision + JSON for Tasker
     response = {
-        'trigger': should_share,
-        'reason': current_event_title
+        'trigger': decide(current_event_title),
+        'reason': current_event_title,
+        'next': next_event_title
     }
 
     return {
@@ -0,0 +1,143 @@
+"""Runs the status checker as a long-lived HTTP service instead of a Lambda.
+
+Every request is turned into a Lambda Function URL event and answered by
+lambda_handler, so both deployments share one code path: same header check,
+tenants, decision index, Calendar fallback and plan mode. What changes is
+that the process never goes cold. Secrets, the Calendar client, the decision
+index and today's events stay in memory, and a background thread refreshes
+them. Requests run concurrently: one waiting on the Calendar (a day missing
+from the index) or on a refresh holds up only the requests that need that
+same entry, and the index is answered from memory while it is revalidated.
+
+    SECRETS_SOURCE=env SECRET_HEADER=... GOOGLE_CALENDAR_API_KEY="$(cat sa.json)" python server.py
+
+Secrets come from SECRETS_SOURCE (default here: 'file', one file per secret
+in SECRETS_DIR, default /run/secrets). GET /health answers 200 without auth.
+"""
+import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+# Defaults for the self-hosted mode; set before the handler reads its config
+os.environ.setdefault('SECRETS_SOURCE', 'file')
+os.environ.setdefault('METRICS_ENABLED', 'false')  # EMF lines only mean something in CloudWatch
+
+import lambda_function
+from lambda_function import logger
+
+STATUS_HOST = os.environ.get('STATUS_HOST', '0.0.0.0')
+STATUS_PORT = int(os.environ.get('STATUS_PORT', '8080'))
+# Requests answered at once; each worker keeps its own Calendar client
+STATUS_WORKERS = int(os.environ.get('STATUS_WORKERS', '16'))
+# Refresh well inside INDEX_REVALIDATE_SECONDS so requests find everything fresh
+WARM_INTERVAL_SECONDS = float(os.environ.get('WARM_INTERVAL_SECONDS', str(lambda_function.INDEX_REVALIDATE_SECONDS / 2)))
+
+
+def to_event(method, path, headers):
+    """The Lambda Function URL (payload v2) event for an HTTP request."""
+    url = urlparse(path)
+    return {
+        'version': '2.0',
+        'rawPath': url.path,
+        'rawQueryString': url.query,
+        'headers': {name.lower(): value for name, value in headers.items()},
+        'queryStringParameters': dict(parse_qsl(url.query)) or None,
+        'requestContext': {'http': {'method': method, 'path': url.path}},
+    }
+
+
+def handle(event):
+    # Safe to call from many threads: metrics are per thread, cache entries have their own locks
+    return lambda_function.lambda_handler(event, None)
+
+
+def warm():
+    """Fetches, for every tenant, what a request would otherwise wait for.
+
+    Each step only calls out when its cached copy is missing or stale, so
+    running this every WARM_INTERVAL_SECONDS is cheap.
+    """
+    lambda_function.metrics.reset()
+    lambda_function.prune_cache()
+    for tenant in lambda_function.load_tenants().values():
+        try:
+            lambda_function.get_expected_header_secret(tenant['header_secret_name'])
+            at = lambda_function.parse_at(None)
+            if lambda_function.lookup_decision(at.date().isoformat(), tenant) is None:
+                # Not in the index: today's events are what requests will need
+                lambda_function.check_calendar_status(at, tenant)
+        except Exception as e:
+            logger.warning(f"Warming tenant {tenant['name']} failed: {e}")
+
+
+def warm_forever():
+    while True:
+        time.sleep(WARM_INTERVAL_SECONDS)
+        warm()
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self._reply({'statusCode': 200, 'body': 'ok'})
+            return
+        try:
+            response = handle(to_event('GET', self.path, self.headers))
+        except Exception as e:
+            logger.error(f"Request failed: {e}")
+            response = {'statusCode': 500, 'body': 'Internal error'}
+        self._reply(response)
+
+    def _reply(self, response):
+        body = (response.get('body') or '').encode('utf-8')
+        self.send_response(response.get('statusCode', 500))
+        for name, value in (response.get('headers') or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The handler already logs every request
+        pass
+
+
+class StatusServer(ThreadingHTTPServer):
+    # socketserver's default backlog of 5 makes a burst of phones wait a
+    # second for the TCP handshake to be retried
+    request_queue_size = 64
+    daemon_threads = True
+
+    def __init__(self, *args, workers=STATUS_WORKERS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='status')
+
+    def process_request(self, request, client_address):
+        # Long-lived workers instead of a thread per request, so a worker's
+        # Calendar client (built per thread) is reused by its next requests
+        self._workers.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self._workers.shutdown(wait=False)
+
+
+def serve():
+    """Warms the caches, then answers status requests forever."""
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    started = time.perf_counter()
+    warm()
+    logger.info(f"Warmed up in {(time.perf_counter() - started) * 1000:.0f} ms")
+    threading.Thread(target=warm_forever, daemon=True).start()
+    server = StatusServer((STATUS_HOST, STATUS_PORT), StatusHandler)
+    logger.info(f"Status service listening on {STATUS_HOST}:{STATUS_PORT} (secrets from {lambda_function.SECRETS_SOURCE})")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve()